@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def expected_candle_ticks(start_ts, end_ts, interval, anchor_ts=0):
+    """[start_ts, end_ts) 内应该存在的K线时间戳(ms)，按 anchor_ts + k * interval 对齐"""
+    first_ts = anchor_ts + -(-(start_ts - anchor_ts) // interval) * interval
+    return np.arange(first_ts, end_ts, interval, dtype=np.int64)
+
+
+def find_missing_windows(timestamps, start_ts, end_ts, interval, batch_limit, merge_gap=0):
+    """找出 [start_ts, end_ts) 内缺失的K线，合并成最少的抓取窗口
+
+    Parameters
+    ----------
+    timestamps : array-like
+        已保存的K线时间戳(ms)，不要求有序
+    start_ts / end_ts : int
+        检查区间(ms)
+    interval : int
+        K线周期(ms)
+    batch_limit : int
+        每个窗口最多多少根
+    merge_gap : int, optional
+        两段缺失之间已存在的K线不超过这么多根时合并为一段，少发请求，by default 0
+
+    Returns
+    -------
+    [(since_ts, limit)]
+        需要补抓的窗口
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    # 已有数据时按已有数据对齐，兼容周线这种不从 epoch 对齐的周期
+    # 取大多数K线所在的网格，和顺序无关，个别不在网格上的时间戳不影响对齐
+    if timestamps.size > 0:
+        phases, counts = np.unique(timestamps % interval, return_counts=True)
+        anchor_ts = int(phases[np.argmax(counts)])
+    else:
+        anchor_ts = start_ts
+    ticks = expected_candle_ticks(start_ts, end_ts, interval, anchor_ts)
+    if ticks.size == 0:
+        return []
+
+    # 标记已有的 tick，不在网格上或不在区间内的忽略
+    offsets = timestamps - ticks[0]
+    on_grid = (offsets >= 0) & (offsets % interval == 0)
+    positions = offsets[on_grid] // interval
+    positions = positions[positions < ticks.size]
+    present = np.zeros(ticks.size, dtype=bool)
+    present[positions] = True
+
+    missing = np.flatnonzero(~present)
+    if missing.size == 0:
+        return []
+
+    # 缺失位置的 diff 大于 1 + merge_gap 处断开，得到每段 [run_start, run_end)
+    breaks = np.flatnonzero(np.diff(missing) > 1 + merge_gap) + 1
+    run_starts = missing[np.concatenate(([0], breaks))]
+    run_ends = missing[np.concatenate((breaks - 1, [missing.size - 1]))] + 1
+
+    # 每段再按 batch_limit 切
+    windows = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        starts = np.arange(run_start, run_end, batch_limit)
+        limits = np.minimum(batch_limit, run_end - starts)
+        windows.extend(zip(ticks[starts].tolist(), limits.tolist()))
+    return windows
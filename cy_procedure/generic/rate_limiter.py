@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import ccxt
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能进程内共享
+    fcntl = None
+
+
+class RateLimiter:
+    """限流器基类
+
+    acquire: 请求前取令牌，不够时阻塞
+    feedback: 请求后把结果(HTTP 状态码/响应头)反馈回来，用于自适应调整
+    出错(status 为空或 >= 400)时本进程指数退避，成功后重置，下次 acquire 会先等退避结束
+    """
+
+    _max_error_backoff = 30
+
+    __error_backoff = 0
+    __error_cooldown_until = 0
+
+    def acquire(self, weight=1):
+        raise NotImplementedError("Subclass")
+
+    def feedback(self, status=None, headers=None):
+        """记录本次结果，子类在此基础上调整速率"""
+        if status is not None and status < 400:
+            self.__error_backoff = 0
+            self.__error_cooldown_until = 0
+        else:
+            self.__error_backoff = min(self._max_error_backoff, self.__error_backoff * 2) if self.__error_backoff > 0 else 0.5
+            self.__error_cooldown_until = time.time() + self.__error_backoff
+
+    def _error_cooldown(self):
+        """还需要退避多少秒"""
+        return self.__error_cooldown_until - time.time()
+
+    def kline_weight(self, limit):
+        """K线请求的权重，默认每次请求算 1"""
+        return 1
+
+    def _last_headers(self):
+        """最近一次请求的响应头，子类按需提供"""
+        return None
+
+    def perform(self, func, weight=1):
+        """限流下执行一次请求，并根据结果反馈，失败时原样抛出异常"""
+        self.acquire(weight)
+        try:
+            result = func()
+        except Exception as e:
+            self.feedback(http_status_of_exception(e), self._last_headers())
+            raise
+        self.feedback(200, self._last_headers())
+        return result
+
+
+class TokenBucket(RateLimiter):
+    """令牌桶限流（线程安全，进程内）
+
+    rate: 每秒补充的令牌数，即稳定状态下每秒允许的请求权重
+    capacity: 桶容量，允许的最大突发权重，默认与 rate 相同
+    """
+
+    def __init__(self, rate, capacity=None):
+        assert rate > 0
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.__tokens = self.capacity
+        self.__last_refill = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last_refill) * self.rate)
+        self.__last_refill = now
+
+    def acquire(self, weight=1):
+        """取 `weight` 个令牌，不够时阻塞等待"""
+        weight = min(weight, self.capacity)
+        wait = self._error_cooldown()
+        if wait > 0:
+            time.sleep(wait)
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= weight:
+                    self.__tokens -= weight
+                    return
+                wait = (weight - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    """多进程共享的自适应令牌桶
+
+    1. 桶的状态存在文件里，读改写都加文件锁，同一台机器上用同一个 key 的进程共享一个额度;
+    2. AIMD 调速: 正常返回时加性增加速率，429/418 或已用权重接近上限时乘性降低;
+    3. 429/418 时按 Retry-After 设置全局冷却，所有进程一起停;
+    4. 其他异常只在本进程内退避(见 RateLimiter)。
+    """
+
+    _max_sleep_step = 1  # 单次最多睡多久再重新检查，冷却被其他进程改动时能尽快反应
+
+    def __init__(self, key, weight_per_minute=1200, burst_seconds=5, min_rate_ratio=0.05, increase_ratio=0.02,
+                 exchange_id=None, headers_source=None, state_dir=None):
+        """
+        Parameters
+        ----------
+        key : str
+            共享额度的 key，一般是 交易所_市场
+        weight_per_minute : int
+            交易所公布的每分钟权重上限
+        burst_seconds : int
+            桶容量，按最大速率能攒几秒的权重
+        min_rate_ratio : float
+            速率下限(相对最大速率)
+        increase_ratio : float
+            每次成功加多少速率(相对最大速率)
+        exchange_id : str, optional
+            ccxt 交易所 id，用来计算接口权重
+        headers_source : () -> dict, optional
+            取最近一次响应头
+        state_dir : str, optional
+            状态文件目录，默认在系统临时目录
+        """
+        self.key = key
+        self.weight_per_minute = weight_per_minute
+        self.max_rate = weight_per_minute / 60
+        self.min_rate = self.max_rate * min_rate_ratio
+        self.increase_step = self.max_rate * increase_ratio
+        self.capacity = max(1, self.max_rate * burst_seconds)
+        self.exchange_id = exchange_id
+        self.__headers_source = headers_source
+
+        state_dir = state_dir if state_dir is not None else os.path.join(tempfile.gettempdir(), 'cy_procedure_rate_limit')
+        os.makedirs(state_dir, exist_ok=True)
+        self.__path = os.path.join(state_dir, '{}.json'.format(key))
+
+        # 没有文件锁时退化为进程内共享
+        self.__local_lock = threading.Lock()
+        self.__local_state = None
+
+    # State
+
+    def __initial_state(self, now):
+        return {
+            'tokens': self.capacity,
+            'last_refill': now,
+            'rate': self.max_rate,
+            'cooldown_until': 0,
+        }
+
+    def __update_state(self, update):
+        """加锁 读 -> update(state, now) -> 写，返回 update 的结果"""
+        if fcntl is None:
+            with self.__local_lock:
+                now = time.time()
+                if self.__local_state is None:
+                    self.__local_state = self.__initial_state(now)
+                return update(self.__local_state, now)
+
+        with open(self.__path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                f.seek(0)
+                content = f.read()
+                try:
+                    state = json.loads(content) if content else self.__initial_state(now)
+                except ValueError:
+                    state = self.__initial_state(now)
+                result = update(state, now)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __take(self, state, now, weight):
+        """补充令牌并尝试取出，返回还需要等待的秒数"""
+        state['tokens'] = min(self.capacity, state['tokens'] + max(0, now - state['last_refill']) * state['rate'])
+        state['last_refill'] = now
+        if now < state['cooldown_until']:
+            return state['cooldown_until'] - now
+        if state['tokens'] >= weight:
+            state['tokens'] -= weight
+            return 0
+        return (weight - state['tokens']) / state['rate']
+
+    # Public
+
+    def acquire(self, weight=1):
+        """取 `weight` 个令牌，不够或冷却中时阻塞等待"""
+        weight = min(weight, self.capacity)
+        while True:
+            wait = self._error_cooldown()
+            if wait <= 0:
+                wait = self.__update_state(lambda state, now: self.__take(state, now, weight))
+            if wait <= 0:
+                return
+            time.sleep(min(wait, self._max_sleep_step))
+
+    def feedback(self, status=None, headers=None):
+        """根据请求结果调整共享速率"""
+        super().feedback(status, headers)
+        retry_after, used_weight = parse_rate_limit_headers(headers)
+
+        def update(state, now):
+            if status == 418:
+                # IP 被封，大幅降速，按 Retry-After 或 2 分钟冷却
+                state['rate'] = max(self.min_rate, state['rate'] * 0.25)
+                state['cooldown_until'] = max(state['cooldown_until'], now + (retry_after or 120))
+                state['tokens'] = 0
+            elif status == 429:
+                state['rate'] = max(self.min_rate, state['rate'] * 0.5)
+                state['cooldown_until'] = max(state['cooldown_until'], now + (retry_after or 1))
+                state['tokens'] = 0
+            elif used_weight is not None and used_weight >= self.weight_per_minute * 0.9:
+                state['rate'] = max(self.min_rate, state['rate'] * 0.5)
+            elif used_weight is not None and used_weight >= self.weight_per_minute * 0.7:
+                state['rate'] = max(self.min_rate, state['rate'] * 0.8)
+            elif status is not None and status < 400:
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase_step)
+            # 服务端统计的已用权重包含同 IP 下所有程序，本地令牌不能超过剩余额度
+            if used_weight is not None:
+                state['tokens'] = min(state['tokens'], max(0, self.weight_per_minute - used_weight))
+            return state['rate']
+
+        rate = self.__update_state(update)
+        if status in (418, 429):
+            print(f'[RateLimit] {self.key} {status}, rate -> {round(rate * 60)}/min, retry after {retry_after}')
+
+    def _last_headers(self):
+        return self.__headers_source() if self.__headers_source is not None else None
+
+    def kline_weight(self, limit):
+        return kline_request_weight(self.exchange_id, limit) if self.exchange_id is not None else 1
+
+
+# ======== Exchange ========
+
+# 各交易所/市场的每分钟权重上限
+EXCHANGE_WEIGHT_PER_MINUTE = {
+    'binance_spot': 1200,
+    'binance_future': 2400,
+    'binance_delivery': 2400,
+    'okex_spot': 600,
+}
+DEFAULT_WEIGHT_PER_MINUTE = 600
+
+
+def http_status_of_exception(e):
+    """ccxt 异常 -> HTTP 状态码，识别不了的返回 None"""
+    if isinstance(e, ccxt.DDoSProtection):  # RateLimitExceeded 是它的子类
+        return 418 if '418' in str(e) else 429
+    return None
+
+
+def parse_rate_limit_headers(headers):
+    """响应头 -> (Retry-After 秒数, 币安已用权重)"""
+    retry_after = None
+    used_weight = None
+    if not headers:
+        return retry_after, used_weight
+    for name, value in headers.items():
+        name = name.lower()
+        try:
+            if name == 'retry-after':
+                retry_after = float(value)
+            elif name.startswith('x-mbx-used-weight'):
+                used_weight = max(used_weight or 0, int(value))
+        except (TypeError, ValueError):
+            continue
+    return retry_after, used_weight
+
+
+def kline_request_weight(exchange_id, limit):
+    """K线接口单次请求的权重"""
+    if exchange_id.startswith('binance'):
+        if limit < 100:
+            return 1
+        elif limit < 500:
+            return 2
+        elif limit <= 1000:
+            return 5
+        return 10
+    return 1
+
+
+__limiters = dict()
+
+
+def rate_limiter_for(ccxt_provider):
+    """按 交易所_市场 取共享限流器，同一进程内复用"""
+    ccxt_object = ccxt_provider.ccxt_object_for_fetching
+    market_type = ccxt_object.options.get('defaultType', 'spot') if isinstance(ccxt_object.options, dict) else 'spot'
+    key = '{}_{}'.format(ccxt_object.id, market_type)
+    if key not in __limiters:
+        __limiters[key] = SharedRateLimiter(key,
+                                            EXCHANGE_WEIGHT_PER_MINUTE.get(key, DEFAULT_WEIGHT_PER_MINUTE),
+                                            exchange_id=ccxt_object.id,
+                                            headers_source=lambda: getattr(ccxt_object, 'last_response_headers', None))
+    return __limiters[key]
@@ -1,13 +1,18 @@
 from enum import IntEnum
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from cy_components.helpers.formatter import DateFormatter
 from cy_widgets.fetcher.exchange import *
+from .rate_limiter import TokenBucket, RateLimiter
+from .missing_candle import find_missing_windows
 
 
 class ExchangeFetchingType(IntEnum):
     HISTORICAL = 0,     # Historical candle data, from earliest date do backward fetching
     FILL_RECENTLY = 1,  # Fill data recently
-    CHECK_MISSING = 2,  # NOT IMPLEMENTED. Check missing candle
+    CHECK_MISSING = 2,  # Check missing candle, only refetch the gaps
     TRADING = 3,        # NOT IMPLEMENTED. For trading
+    WINDOWED = 4,       # Split [start, end) into windows up front, fetch them concurrently
 
 
 class ExchangeFetchingConfiguration:
@@ -17,6 +22,8 @@ class ExchangeFetchingConfiguration:
     3. TimeFrame;
     4. Begin date;
     5. Fetching duration (Sleep after a fetching operation)
+    6. Date range / workers / rate limit (WINDOWED / CHECK_MISSING)
+    7. Rate limiter (shared & adaptive, replaces sleep_duration when set)
     """
 
     def __init__(self,
@@ -25,11 +32,21 @@ class ExchangeFetchingConfiguration:
                  sleep_duration=5,
                  op_type=ExchangeFetchingType.HISTORICAL,
                  batch_limit=1000,
-                 debug=False):
+                 debug=False,
+                 start_date=None,
+                 end_date=None,
+                 workers=4,
+                 requests_per_second=10,
+                 missing_merge_gap=0,
+                 rate_limiter: RateLimiter = None,
+                 fetch_retries=3):
         super().__init__()
         assert coin_pair is not None
         assert time_frame is not None
         assert sleep_duration > 0
+        assert workers > 0
+        assert requests_per_second > 0
+        assert fetch_retries >= 0
 
         self.coin_pair = coin_pair
         self.time_frame = time_frame
@@ -37,6 +54,18 @@ class ExchangeFetchingConfiguration:
         self.sleep_duration = sleep_duration
         self.batch_limit = batch_limit if batch_limit > 20 else 50
         self.debug = debug
+        # WINDOWED / CHECK_MISSING 用到的参数，end_date 为空时到现在
+        # start_date 为空时，WINDOWED 从 get_latest_date 取，CHECK_MISSING 从 get_earliest_date 取
+        self.start_date = start_date
+        self.end_date = end_date
+        self.workers = workers
+        self.requests_per_second = requests_per_second
+        # CHECK_MISSING 两段缺失之间相隔不超过这么多根时合并成一个窗口
+        self.missing_merge_gap = missing_merge_gap
+        # 设置后所有请求都走这个限流器，不再固定 sleep
+        self.rate_limiter = rate_limiter
+        # 一次请求失败后原地重试的次数，用完抛出，由调用方(如 Retrier)处理；0 为不重试直接抛出
+        self.fetch_retries = fetch_retries
 
 
 class ExchangeFetchingProcedure:
@@ -47,7 +76,8 @@ class ExchangeFetchingProcedure:
                  configuration: ExchangeFetchingConfiguration,
                  get_earliest_date,
                  get_latest_date,
-                 save_df):
+                 save_df,
+                 get_candle_timestamps=None):
         """初始化
 
         Parameters
@@ -62,6 +92,8 @@ class ExchangeFetchingProcedure:
             获取最近K线的日期
         save_df : (df) -> Bool
             保存K线数据，返回是否继续抓取
+        get_candle_timestamps : (start_date, end_date) -> array, optional
+            只读取区间内已保存K线的时间戳(ms)，CHECK_MISSING 需要
         """
         assert fetcher is not None
         assert configuration is not None
@@ -73,23 +105,48 @@ class ExchangeFetchingProcedure:
         self.get_earliest_date = get_earliest_date
         self.get_latest_date = get_latest_date
         self.save_df = save_df
+        self.get_candle_timestamps = get_candle_timestamps
+
+        # 同一个 Procedure 的所有 worker 共用一个限流器，没配置的按 requests_per_second 进程内限流
+        self.rate_limiter = configuration.rate_limiter
+        if self.rate_limiter is None:
+            self.rate_limiter = TokenBucket(configuration.requests_per_second)
 
     # Data
 
-    def __perform_fetching(self, since_ts):
-        """fetching + saving"""
-        # Fetch
-        while True:
+    def __fetch_candles(self, since_ts, limit):
+        """限流下请求一次，出错时限流器负责退避"""
+        return self.rate_limiter.perform(lambda: self.fetcher.fetch_historical_candle_data(
+            self.configuration.coin_pair,
+            self.configuration.time_frame,
+            since_ts,
+            limit), self.rate_limiter.kline_weight(limit))
+
+    def __fetch_with_retries(self, since_ts, limit):
+        """请求失败时重试 fetch_retries 次，退避由限流器负责，还失败的抛出"""
+        for attempt in range(self.configuration.fetch_retries + 1):
             try:
-                df = self.fetcher.fetch_historical_candle_data(
-                    self.configuration.coin_pair,
-                    self.configuration.time_frame,
-                    since_ts,
-                    self.configuration.batch_limit)
-                return self.save_df(df)
+                return self.__fetch_candles(since_ts, limit)
             except Exception as e:
-                print(f'{self.configuration.coin_pair.formatted()}, {since_ts} failed.', str(e))
-                time.sleep(1.5)
+                print(f'{self.configuration.coin_pair.formatted()}, {since_ts} failed '
+                      f'({attempt + 1}/{self.configuration.fetch_retries + 1}).', str(e))
+                if attempt == self.configuration.fetch_retries:
+                    raise
+
+    def __sleep_between_batches(self):
+        """有限流器时由限流器控制节奏"""
+        if self.configuration.rate_limiter is None:
+            time.sleep(self.configuration.sleep_duration)
+
+    def __perform_fetching(self, since_ts):
+        """fetching + saving"""
+        df = self.__fetch_with_retries(since_ts, self.configuration.batch_limit)
+        # 保存失败不在这里重抓重存: 后台写入失败时之前放入的数据已经丢掉，只补存这一批会留下空洞，交给上层从已落盘的位置重来
+        try:
+            return self.save_df(df)
+        except Exception as e:
+            print(f'{self.configuration.coin_pair.formatted()}, {since_ts} save failed.', str(e))
+            raise
 
     def __fetch_historical_data(self):
         """获取历史记录"""
@@ -104,7 +161,7 @@ class ExchangeFetchingProcedure:
                 earliest_ts, self.configuration.batch_limit)
             # 需要继续的，暂停一会儿
             if self.__perform_fetching(since_ts):
-                time.sleep(self.configuration.sleep_duration)
+                self.__sleep_between_batches()
             else:
                 print('Historical.finished')
                 return
@@ -121,14 +178,113 @@ class ExchangeFetchingProcedure:
             since_ts = self.configuration.time_frame.timestamp_backward_offset(recent_ts, 10)
             # 需要继续的，暂停一会儿
             if self.__perform_fetching(since_ts):
-                time.sleep(self.configuration.sleep_duration)
+                self.__sleep_between_batches()
             else:
                 print('FillRecently.finished')
                 return
 
+    def __split_windows(self, start_ts, end_ts):
+        """把 [start_ts, end_ts) 切成 batch_limit 大小的窗口，返回 [(since_ts, limit)]"""
+        interval = self.configuration.time_frame.time_interval()
+        batch_limit = self.configuration.batch_limit
+        windows = []
+        since_ts = start_ts
+        while since_ts < end_ts:
+            limit = min(batch_limit, -(-(end_ts - since_ts) // interval))  # 最后一个窗口可能不满
+            windows.append((since_ts, limit))
+            since_ts += limit * interval
+        return windows
+
+    def __fetch_window(self, since_ts, limit):
+        """抓一个窗口，只保留窗口内的K线，失败重试 fetch_retries 次后抛出"""
+        until_ts = since_ts + limit * self.configuration.time_frame.time_interval()
+        df = self.__fetch_with_retries(since_ts, limit)
+        if df.shape[0] == 0:
+            return df
+        begin_times = df[COL_CANDLE_BEGIN_TIME]
+        in_window = (begin_times >= pd.to_datetime(since_ts, unit='ms', utc=True)) & \
+            (begin_times < pd.to_datetime(until_ts, unit='ms', utc=True))
+        return df[in_window]
+
+    def __save_in_order(self, futures):
+        """按窗口顺序拼接已抓到的结果，再保存"""
+        dfs = [future.result() for future in futures]
+        dfs = [df for df in dfs if df.shape[0] > 0]
+        if len(dfs) == 0:
+            return True
+        df = pd.concat(dfs, ignore_index=True)
+        df.drop_duplicates(subset=[COL_CANDLE_BEGIN_TIME], keep='last', inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return self.save_df(df)
+
+    def __date_range(self, default_start_date):
+        """WINDOWED / CHECK_MISSING 的 [start, end)"""
+        start_date = self.configuration.start_date
+        if start_date is None:
+            assert default_start_date is not None
+            start_date = default_start_date()
+        end_date = self.configuration.end_date if self.configuration.end_date is not None else datetime.now().astimezone()
+        return start_date, end_date
+
+    def __fetch_window_list(self, windows):
+        """有界线程池并发抓取窗口，按顺序保存，吞吐只受限于令牌桶"""
+        workers = self.configuration.workers
+        print(f'{self.configuration.coin_pair.formatted()} {len(windows)} windows, {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            windows = deque(windows)
+            pending = deque()
+            while len(windows) > 0 or len(pending) > 0:
+                # 保持在途请求数有界，避免结果在内存里堆积
+                while len(windows) > 0 and len(pending) < workers * 2:
+                    pending.append(executor.submit(self.__fetch_window, *windows.popleft()))
+                ready = [pending.popleft() for _ in range(min(workers, len(pending)))]
+                try:
+                    proceed = self.__save_in_order(ready)
+                except Exception:
+                    # 有窗口抓取或保存失败，没开始的不再抓，异常交给调用方
+                    for future in pending:
+                        future.cancel()
+                    raise
+                if not proceed:
+                    for future in pending:
+                        future.cancel()
+                    return
+
+    def __fetch_windows(self):
+        """预先把整个区间切好窗口，并发抓取"""
+        start_date, end_date = self.__date_range(self.get_latest_date)
+        start_ts = DateFormatter.convert_local_date_to_timestamp(start_date)
+        end_ts = DateFormatter.convert_local_date_to_timestamp(end_date)
+        self.__fetch_window_list(self.__split_windows(start_ts, end_ts))
+        print('Windowed.finished')
+
+    def __check_missing(self):
+        """只读时间戳找出缺失的K线，合并成最少的窗口，只补抓这些窗口"""
+        assert self.get_candle_timestamps is not None
+        assert self.configuration.time_frame != TimeFrame.Month_1  # 月线不等长，没法按 tick 检查
+        start_date, end_date = self.__date_range(self.get_earliest_date)
+        start_ts = DateFormatter.convert_local_date_to_timestamp(start_date)
+        end_ts = DateFormatter.convert_local_date_to_timestamp(end_date)
+        timestamps = self.get_candle_timestamps(start_date, end_date)
+        windows = find_missing_windows(timestamps,
+                                       start_ts,
+                                       end_ts,
+                                       self.configuration.time_frame.time_interval(),
+                                       self.configuration.batch_limit,
+                                       self.configuration.missing_merge_gap)
+        print(f'{self.configuration.coin_pair.formatted()} {len(timestamps)} saved, '
+              f'{sum(limit for _, limit in windows)} missing in {len(windows)} windows')
+        if len(windows) > 0:
+            self.__fetch_window_list(windows)
+        print('CheckMissing.finished')
+
     def run_task(self):
         """Dispatch task"""
         if self.configuration.op_type == ExchangeFetchingType.HISTORICAL:
             self.__fetch_historical_data()
         elif self.configuration.op_type == ExchangeFetchingType.FILL_RECENTLY:
             self.__fill_recently()
+        elif self.configuration.op_type == ExchangeFetchingType.CHECK_MISSING:
+            self.__check_missing()
+        elif self.configuration.op_type == ExchangeFetchingType.WINDOWED:
+            self.__fetch_windows()
@@ -1,3 +1,4 @@
+import math
 import pytz
 import time
 from multiprocessing.pool import Pool
@@ -7,6 +8,7 @@ from cy_widgets.fetcher.exchange import *
 from cy_components.helpers.formatter import *
 from .config_reader import *
 from ...generic.spot_fetching import *
+from ...generic.rate_limiter import rate_limiter_for
 
 
 class CandleRealtimeCrawler:
@@ -35,9 +37,14 @@ class CandleRealtimeCrawler:
         start_time = datetime.now().astimezone(tz=pytz.utc)
         time_frame = config.time_frame
         coin_pair = config.coin_pair
+        provider = self.__config_reader.ccxt_provider
+        # 同一交易所的所有抓取进程共享额度，实时K线每 200 根一次请求
+        rate_limiter = rate_limiter_for(provider)
+        weight = rate_limiter.kline_weight(min(self.__limit, 200)) * math.ceil(self.__limit / 200)
         for _ in range(5):  # 5 次，不行就算了
+            df = None
             try:
-                df = ExchangeFetcher(self.__config_reader.ccxt_provider).fetch_real_time_candle_data(coin_pair, time_frame, self.__limit)
+                df = rate_limiter.perform(lambda: ExchangeFetcher(provider).fetch_real_time_candle_data(coin_pair, time_frame, self.__limit), weight)
 
                 # 空的
                 if df.empty:
@@ -70,7 +77,8 @@ class CandleRealtimeCrawler:
             except Exception as e:
                 print('{} {} 出错'.format(config.coin_pair.formatted(), config.time_frame.value))
                 print(e)
-                time.sleep(5)
+                if df is not None:
+                    rate_limiter.feedback()  # 请求之外的错误，限流器里的请求错误已经退避过了
 
     def __dispatch_task(self, configs):
         """分配任务"""
@@ -0,0 +1,158 @@
+import time
+import sqlite3
+import traceback
+from datetime import datetime
+from multiprocessing.pool import Pool
+from cy_components.helpers.formatter import DateFormatter
+from cy_data_access.connection.connect import *
+from ...generic.spot_fetching import *
+from .historical_spot_candle import *
+
+
+class BackfillCheckpointStore:
+    """每个回补任务最后落盘的 candle_begin_time，存在本地 SQLite 里，多进程共用"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.__connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS checkpoint (
+                                job_id TEXT PRIMARY KEY,
+                                last_date TEXT,
+                                finished INTEGER DEFAULT 0,
+                                updated_at TEXT)""")
+
+    def __connect(self):
+        # 每次新开连接，写入回调在 sink 的后台线程里
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, job_id):
+        """-> (last_date or None, finished)"""
+        with self.__connect() as conn:
+            row = conn.execute('SELECT last_date, finished FROM checkpoint WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None, False
+        last_date = datetime.fromisoformat(row[0]) if row[0] is not None else None
+        return last_date, bool(row[1])
+
+    def save(self, job_id, last_date, finished=False):
+        with self.__connect() as conn:
+            conn.execute("""INSERT INTO checkpoint (job_id, last_date, finished, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(job_id) DO UPDATE SET
+                                last_date = excluded.last_date,
+                                finished = excluded.finished,
+                                updated_at = excluded.updated_at""",
+                         (job_id, last_date.isoformat() if last_date is not None else None, int(finished), datetime.now().isoformat()))
+
+
+class BackfillJob:
+    """一个 (币对, 周期) 的回补任务，只放可以 pickle 的简单字段"""
+
+    def __init__(self, coin_pair_str, time_frame_str, exchange_type, start_date, end_date, target, database, per_limit, workers,
+                 influx_host=None, influx_token='', influx_org=''):
+        self.coin_pair_str = coin_pair_str
+        self.time_frame_str = time_frame_str
+        self.exchange_type = exchange_type
+        self.start_date = start_date
+        self.end_date = end_date
+        self.target = target
+        self.database = database
+        self.per_limit = per_limit
+        self.workers = workers
+        self.influx_host = influx_host
+        self.influx_token = influx_token
+        self.influx_org = influx_org
+
+    @property
+    def job_id(self):
+        return '{}_{}_{}_{}'.format(self.target, int(self.exchange_type), self.coin_pair_str.replace('/', '_').lower(), self.time_frame_str)
+
+
+def run_backfill_job(job: BackfillJob, checkpoint_path):
+    """在子进程里跑一个任务，从 checkpoint 续上，每次落盘更新 checkpoint"""
+    store = BackfillCheckpointStore(checkpoint_path)
+    last_date, finished = store.load(job.job_id)
+    if finished:
+        return job.job_id, True, 0
+    start_time = time.time()
+    # 从最后落盘的那根开始，重抓这一根没有影响
+    start_date = DateFormatter.convert_local_date_to_string(last_date.astimezone(), '%Y-%m-%d %H:%M:%S') if last_date is not None else job.start_date
+    print(f'[Backfill] {job.job_id} from {start_date}')
+
+    def on_progress(durable_date):
+        store.save(job.job_id, durable_date)
+
+    try:
+        coin_pair = CoinPair.coin_pair_with(job.coin_pair_str)
+        time_frame = TimeFrame(job.time_frame_str)
+        if job.target == 'influx':
+            task = InfluxDBHistoricalSpotCandle(coin_pair, time_frame, job.exchange_type, start_date, job.end_date, job.per_limit,
+                                                database=job.database, op_type=ExchangeFetchingType.WINDOWED, on_progress=on_progress,
+                                                host=job.influx_host, token=job.influx_token, org=job.influx_org)
+        else:
+            connect_db_env(db_name=DB_MARKET)  # 子进程里自己连
+            task = DBHistoricalSpotCandle(coin_pair, time_frame, job.exchange_type, start_date, job.end_date, job.per_limit,
+                                          op_type=ExchangeFetchingType.WINDOWED, on_progress=on_progress)
+        task.config.workers = job.workers
+        success = task.run_task()
+        # 没有结束时间的任务每次都要补到最新，不标记完成
+        if success and job.end_date is not None:
+            store.save(job.job_id, task.durable_date, finished=True)
+    except Exception:
+        print(traceback.format_exc())
+        success = False
+    return job.job_id, success, time.time() - start_time
+
+
+class HistoricalBackfillOrchestrator:
+    """多币对 × 多周期的历史K线回补
+
+    1. 每个 (币对, 周期) 是一个任务，进度(最后落盘的 candle_begin_time)存在 SQLite，崩溃后从断点继续;
+    2. 任务分到进程池里跑，每个任务内部再用 WINDOWED 并发抓;
+    3. 同一交易所的所有进程共用 SharedRateLimiter 的额度，总请求速率不会超过交易所限制。
+    """
+
+    def __init__(self, coin_pairs, time_frames, exchange_type, start_date='2020-03-03 00:00:00', end_date=None,
+                 checkpoint_path='backfill_checkpoint.sqlite', processes=4, target='mongo', database='spot_market',
+                 per_limit=1000, workers_per_job=2, influx_host=None, influx_token='', influx_org=''):
+        """
+        Parameters
+        ----------
+        coin_pairs : [str]
+            币对，如 ['BTC/USDT', 'ETH/USDT']
+        time_frames : [str]
+            周期，如 ['1m', '5m']
+        exchange_type : ExchangeType
+            交易所
+        target : str
+            'mongo' / 'influx'
+        workers_per_job : int
+            每个任务内并发抓取的窗口数
+        influx_host / influx_token / influx_org : str
+            InfluxDB 连接，influx_host 为空时连 DEFAULT_INFLUX_HOST
+        """
+        assert target in ['mongo', 'influx']
+        self.jobs = [BackfillJob(cp, tf, exchange_type, start_date, end_date, target, database, per_limit, workers_per_job,
+                                 influx_host, influx_token, influx_org)
+                     for cp in coin_pairs for tf in time_frames]
+        self.checkpoint_path = checkpoint_path
+        self.processes = processes
+        # 先建表，避免子进程同时建
+        self.store = BackfillCheckpointStore(checkpoint_path)
+
+    def pending_jobs(self):
+        """还没完成的任务"""
+        return [job for job in self.jobs if not self.store.load(job.job_id)[1]]
+
+    def run(self):
+        jobs = self.pending_jobs()
+        print(f'[Backfill] {len(jobs)}/{len(self.jobs)} jobs pending, {self.processes} processes')
+        start_time = time.time()
+        failed = []
+        with Pool(processes=self.processes) as pool:
+            results = pool.starmap(run_backfill_job, [(job, self.checkpoint_path) for job in jobs], chunksize=1)
+        for job_id, success, cost in results:
+            print(f'[Backfill] {job_id} {"done" if success else "FAILED"} {round(cost, 1)}s')
+            if not success:
+                failed.append(job_id)
+        print(f'[Backfill] finished in {round(time.time() - start_time, 1)}s, {len(failed)} failed')
+        return failed
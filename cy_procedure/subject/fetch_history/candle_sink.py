@@ -0,0 +1,276 @@
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from cy_components.defines.column_names import *
+from cy_data_access.util.convert import convert_df_to_json_list
+
+_FLUSH = object()
+_STOP = object()
+
+
+class CandleSink:
+    """后台写入K线的 sink 基类
+
+    1. put: 放进有界队列，队列满时阻塞，给抓取端背压;
+    2. 后台线程把数据交给 _append 缓冲，_should_write 满足时再一次性写出，写入和下一次网络请求重叠;
+    3. flush: 写出所有已经 put 的数据，写入出错时在这里抛出;
+       写入出错后下一次 put 也会抛出，错误只抛一次，队列里出错前放入的数据都丢掉，上层从已落盘的位置重来，不会留下空洞;
+    4. listen(key, callback): 每次 key 写入成功后回调这次写入的最大 candle_begin_time，用来记录已落盘的进度。
+    """
+
+    def __init__(self, max_pending=4):
+        assert max_pending > 0
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__listeners = dict()
+        self.__error = None
+        self.__epoch = 0  # 每抛出一次错误加一，之前放入的数据不再写
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    # 子类实现
+
+    def _append(self, df: pd.DataFrame, key):
+        """放入写缓冲"""
+        raise NotImplementedError("Subclass")
+
+    def _should_write(self, idle):
+        """缓冲是否该写出了，idle: 队列里暂时没有更多数据"""
+        raise NotImplementedError("Subclass")
+
+    def _write_pending(self):
+        """写出缓冲，返回 {key: 写入的最大 candle_begin_time}"""
+        raise NotImplementedError("Subclass")
+
+    def _discard_pending(self):
+        """写入失败后丢掉缓冲"""
+        raise NotImplementedError("Subclass")
+
+    # Writer
+
+    def __write(self):
+        # 前面失败过的不再写，等 flush 把错误抛出去后由上层从已落盘的位置重来
+        if self.__error is not None:
+            self._discard_pending()
+            return
+        try:
+            last_dates = self._write_pending()
+        except Exception as e:
+            self.__error = e
+            self._discard_pending()
+            return
+        for key, last_date in last_dates.items():
+            if key in self.__listeners:
+                self.__listeners[key](last_date)
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is _STOP:
+                    self.__write()
+                    return
+                if item is _FLUSH:
+                    self.__write()
+                    continue
+                df, key, epoch = item
+                if self.__error is None and epoch == self.__epoch:
+                    self._append(df, key)
+                if self._should_write(self.__queue.empty()):
+                    self.__write()
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    # Public
+
+    def listen(self, key, callback):
+        """key 写入成功后回调 callback(last_date)"""
+        self.__listeners[key] = callback
+
+    def put(self, df: pd.DataFrame, key=None):
+        """放入一批，队列满时阻塞；之前的写入已经失败的抛出，并丢掉之前放入还没写的"""
+        if self.__error is not None:
+            self.__raise_error()
+        if df.shape[0] > 0:
+            self.__queue.put((df, key, self.__epoch))
+
+    def __raise_error(self):
+        self.__epoch += 1
+        error, self.__error = self.__error, None
+        raise error
+
+    def flush(self, raise_error=True):
+        """写出已放入的全部数据"""
+        self.__queue.put(_FLUSH)
+        self.__queue.join()
+        if self.__error is None:
+            return
+        if raise_error:
+            self.__raise_error()
+        self.__epoch += 1
+        self.__error = None
+
+    def close(self):
+        """写完剩下的并结束后台线程"""
+        self.__queue.put(_STOP)
+        self.__thread.join()
+        error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+
+def last_candle_date(df: pd.DataFrame):
+    """最大的 candle_begin_time，不排序"""
+    return pd.Timestamp(df[COL_CANDLE_BEGIN_TIME].values.max()).tz_localize('UTC')
+
+
+class MongoCandleSink(CandleSink):
+    """合并成大的 unordered bulk upsert 写 Mongo，队列空闲或攒够 coalesce_rows 时写出
+
+    candle_cache: 回补时传入，写完把本地K线缓存中对应的月份标记为需要重新取"""
+
+    def __init__(self, candle_cls, max_pending=4, coalesce_rows=20000, candle_cache=None):
+        self.candle_cls = candle_cls
+        self.candle_cache = candle_cache
+        self.coalesce_rows = coalesce_rows
+        self.__dfs = []
+        self.__rows = 0
+        super().__init__(max_pending)
+
+    def _append(self, df, key):
+        self.__dfs.append(df)
+        self.__rows += df.shape[0]
+
+    def _should_write(self, idle):
+        return self.__rows > 0 and (idle or self.__rows >= self.coalesce_rows)
+
+    def _write_pending(self):
+        if self.__rows == 0:
+            return {}
+        df = pd.concat(self.__dfs, ignore_index=True) if len(self.__dfs) > 1 else self.__dfs[0]
+        self._discard_pending()
+        last_date = last_candle_date(df)
+        json_list = convert_df_to_json_list(df, COL_CANDLE_BEGIN_TIME)
+        self.candle_cls.bulk_upsert_records(json_list)
+        if self.candle_cache is not None:
+            self.candle_cache.mark_written(self.candle_cls, df[COL_CANDLE_BEGIN_TIME].min(), last_date)
+        return {None: last_date}
+
+    def _discard_pending(self):
+        self.__dfs = []
+        self.__rows = 0
+
+
+# ======== InfluxDB ========
+
+
+def __escape_key(name):
+    """line protocol 的 measurement / tag / field key 转义"""
+    return str(name).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def __format_field_values(values: np.ndarray):
+    """整列转成 field value 字符串，NaN 返回空串"""
+    if values.dtype.kind == 'f':
+        text = values.astype(str)
+        return np.where(np.isfinite(values), text, '')
+    if values.dtype.kind in 'iu':
+        return np.char.add(values.astype(str), 'i')
+    if values.dtype.kind == 'b':
+        return np.where(values, 'true', 'false')
+    # 字符串(object / pandas 字符串列): 缺失值单独标记，其余转成 numpy 定长字符串再转义
+    values = np.asarray(values, dtype=object)
+    missing = np.asarray(pd.isna(values), dtype=bool)
+    text = np.where(missing, '', values).astype(str)
+    text = np.char.replace(np.char.replace(text, '\\', '\\\\'), '"', '\\"')
+    return np.where(missing, '', np.char.add(np.char.add('"', text), '"'))
+
+
+def build_line_protocol(df: pd.DataFrame, measurement, time_column=COL_CANDLE_BEGIN_TIME):
+    """DataFrame -> (时间戳 ns, line protocol 行)，按列整体拼接，不逐行格式化
+    所有 field 都是 NaN 的行会被去掉
+    """
+    timestamps = df[time_column].values.astype('datetime64[ns]').astype(np.int64)
+    fields = None
+    for column in df.columns:
+        if column == time_column:
+            continue
+        values = __format_field_values(df[column].values)
+        part = np.where(values == '', '', np.char.add(',{}='.format(__escape_key(column)), values))
+        fields = part if fields is None else np.char.add(fields, part)
+    if fields is None:
+        return timestamps[:0], np.array([], dtype=str)
+    # 每个 field 前面都带了 ','，去掉第一个
+    fields = np.char.lstrip(fields, ',')
+    lines = np.char.add(np.char.add(np.char.add(__escape_key(measurement) + ' ', fields), ' '), timestamps.astype(str))
+    valid = fields != ''
+    return timestamps[valid], lines[valid]
+
+
+class InfluxCandleSink(CandleSink):
+    """直接拼 line protocol 批量写 InfluxDB
+
+    1. 每个 measurement 分开缓冲，攒够 max_points 行或 max_bytes 字节才写;
+    2. 写之前按时间排序，再按 shard_duration 对齐切块，一次请求只落在一个 shard group 里;
+    3. gzip 压缩请求体。
+
+    host / token / org 由调用方传入，influxdb_client 只在用到 InfluxDB 时才导入。
+    """
+
+    def __init__(self, database, host, token='', org='', max_points=50000, max_bytes=8 * 1024 * 1024,
+                 shard_duration='7d', max_pending=8):
+        from influxdb_client import InfluxDBClient, WritePrecision
+        from influxdb_client.client.write_api import SYNCHRONOUS
+        self.database = database
+        self.host = host
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.shard_ns = pd.to_timedelta(shard_duration).value
+        self.__precision = WritePrecision.NS
+        self.__client = InfluxDBClient(url=host, token=token, org=org, enable_gzip=True)
+        self.__write_api = self.__client.write_api(write_options=SYNCHRONOUS)
+        self.__buffers = dict()  # measurement -> [(timestamps, lines)]
+        self.__points = 0
+        self.__bytes = 0
+        super().__init__(max_pending)
+
+    def _append(self, df, key):
+        timestamps, lines = build_line_protocol(df, key)
+        if len(lines) == 0:
+            return
+        self.__buffers.setdefault(key, []).append((timestamps, lines))
+        self.__points += len(lines)
+        self.__bytes += int(np.char.str_len(lines).sum()) + len(lines)
+
+    def _should_write(self, idle):
+        return self.__points >= self.max_points or self.__bytes >= self.max_bytes
+
+    def __write_lines(self, lines):
+        self.__write_api.write(bucket=self.database, record='\n'.join(lines.tolist()), write_precision=self.__precision)
+
+    def _write_pending(self):
+        last_dates = dict()
+        for measurement, parts in self.__buffers.items():
+            timestamps = np.concatenate([p[0] for p in parts])
+            lines = np.concatenate([p[1] for p in parts])
+            order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[order]
+            lines = lines[order]
+            # 在 shard 边界和 max_points 处切块
+            shard_ids = timestamps // self.shard_ns
+            bounds = np.flatnonzero(np.diff(shard_ids)) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [len(lines)]))
+            for start, end in zip(starts, ends):
+                for chunk_start in range(start, end, self.max_points):
+                    self.__write_lines(lines[chunk_start:min(end, chunk_start + self.max_points)])
+            last_dates[measurement] = pd.Timestamp(int(timestamps[-1]), tz='UTC')
+        self._discard_pending()
+        return last_dates
+
+    def _discard_pending(self):
+        self.__buffers = dict()
+        self.__points = 0
+        self.__bytes = 0
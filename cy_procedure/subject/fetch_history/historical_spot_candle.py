@@ -1,17 +1,23 @@
 import os
-import time
+import numpy as np
 from datetime import datetime
 from cy_components.helpers.formatter import CandleFormatter, DateFormatter
 from cy_data_access.connection.influxdb import *
 from cy_data_access.models.market import *
-from cy_data_access.util.convert import convert_df_to_json_list
 from ...generic.spot_fetching import *
+from ...generic.rate_limiter import rate_limiter_for
+from ...util.retry import Retrier, RetryPolicy
+from ...util.candle_cache import default_candle_cache
+from .candle_sink import MongoCandleSink, InfluxCandleSink, last_candle_date
 
+# 没有指定 InfluxDB 连接时用的地址，和 cy_data_access.connection.influxdb 的默认值一致
+DEFAULT_INFLUX_HOST = 'http://localhost:8086'
 
-class DBHistoricalSpotCandle:
-    """外部连接数据库，内部只负责写入"""
 
-    def __init__(self, coin_pair, time_frame, exchange_type, start_date='2020-03-03 00:00:00', end_date=None, per_limit=1000):
+class HistoricalSpotCandleBase:
+    """历史K线抓取的公共流程：抓取 -> 后台 sink 写入 -> 出错从已落盘的位置重试"""
+
+    def __init__(self, coin_pair, time_frame, exchange_type, start_date, end_date, per_limit, op_type, on_progress, retry_policy):
         # 时间区间
         self.start_date = DateFormatter.convert_string_to_local_date(start_date).astimezone()
         self.end_date = DateFormatter.convert_string_to_local_date(end_date) if end_date is not None else datetime.now()
@@ -19,20 +25,59 @@ class DBHistoricalSpotCandle:
         # 抓取使用的配置
         self.provider = CCXTProvider("", "", exchange_type)
         self.config = ExchangeFetchingConfiguration(
-            coin_pair, time_frame, 1, ExchangeFetchingType.FILL_RECENTLY, batch_limit=per_limit)
+            coin_pair, time_frame, 1, op_type, batch_limit=per_limit, start_date=self.start_date, end_date=self.end_date,
+            rate_limiter=rate_limiter_for(self.provider), fetch_retries=0)  # 请求失败直接交给 Retrier，按它的预算重试、统计
         self.fetcher = ExchangeFetcher(self.provider)
-        # table name
-        self.candle_cls = candle_record_class_with_components(self.provider.display_name, coin_pair, time_frame)
+        # 已落盘的最新日期
+        self.durable_date = self.start_date
+        self.on_progress = on_progress  # (durable_date) -> None，每次落盘后回调
+        self.retry_policy = retry_policy
+        self.retry_metrics = None
 
-    def run_task(self, retry=10):
-        # 开始抓取
+    @property
+    def _sink(self):
+        raise NotImplementedError("Subclass")
+
+    @property
+    def _sink_key(self):
+        """在 sink 里区分数据的 key"""
+        return None
+
+    def _get_candle_timestamps(self, start_date, end_date):
+        """CHECK_MISSING 用，只读时间戳"""
+        raise NotImplementedError("Subclass")
+
+    def _did_write(self, last_date):
+        self.durable_date = max(self.durable_date, last_date)
+        # 有进展，连续失败清零
+        if self.__retrier is not None:
+            self.__retrier.progress()
+        if self.on_progress is not None:
+            self.on_progress(self.durable_date)
+
+    __retrier = None
+
+    def __run_once(self):
         try:
-            procedure = ExchangeFetchingProcedure(self.fetcher, self.config, None, self.__get_latest_date, self.__save_df)
+            procedure = ExchangeFetchingProcedure(self.fetcher, self.config, None, self.__get_latest_date, self.__save_df, self._get_candle_timestamps)
             procedure.run_task()
-        except Exception as e:
-            print("Fetche Failed", e)
-            time.sleep(3)
-            self.run_task(retry - 1)
+            # 等后台写完才算结束
+            self._sink.flush()
+        except Exception:
+            # 丢掉没写成功的，从已落盘的位置重新抓
+            self._sink.flush(raise_error=False)
+            self.start_date = self.durable_date
+            if self.config.op_type == ExchangeFetchingType.WINDOWED:
+                self.config.start_date = self.durable_date
+            raise
+
+    def run_task(self, retry=10):
+        """抓取直到结束，返回是否成功；重试在循环里做，有进展时重试次数重新计算"""
+        policy = self.retry_policy if self.retry_policy is not None else RetryPolicy(max_retries=retry)
+        self.__retrier = Retrier(policy, '{} {}'.format(self.config.coin_pair.formatted(), self.config.time_frame.value))
+        success, _ = self.__retrier.run(self.__run_once)
+        self.retry_metrics = self.__retrier.metrics
+        return success
 
     def __get_latest_date(self):
         print("lastest date: {}".format(self.start_date))
@@ -42,50 +87,83 @@ class DBHistoricalSpotCandle:
         if df.shape[0] == 0:
             return False
         # 最后日期
-        self.start_date = df.sort_values(COL_CANDLE_BEGIN_TIME, ascending=False)[COL_CANDLE_BEGIN_TIME].iloc[0]
-        # 保存
-        json_list = convert_df_to_json_list(df, COL_CANDLE_BEGIN_TIME)
-        self.candle_cls.bulk_upsert_records(json_list)
+        self.start_date = last_candle_date(df)
+        # 交给后台写入，队列满时在这里等
+        self._sink.put(df, self._sink_key)
         return self.start_date < self.end_date
 
 
-class InfluxDBHistoricalSpotCandle:
+class DBHistoricalSpotCandle(HistoricalSpotCandleBase):
     """外部连接数据库，内部只负责写入"""
 
-    def __init__(self, coin_pair: CoinPair, time_frame, exchange_type, start_date='2020-03-03 00:00:00', end_date=None, per_limit=1000, database='spot_market'):
-        # 时间区间
-        self.start_date = DateFormatter.convert_string_to_local_date(start_date).astimezone()
-        self.end_date = DateFormatter.convert_string_to_local_date(end_date) if end_date is not None else datetime.now()
-        self.end_date = self.end_date.astimezone()
-        # 抓取使用的配置
-        self.provider = CCXTProvider("", "", exchange_type)
-        self.config = ExchangeFetchingConfiguration(
-            coin_pair, time_frame, 1, ExchangeFetchingType.FILL_RECENTLY, batch_limit=per_limit)
-        self.fetcher = ExchangeFetcher(self.provider)
+    def __init__(self, coin_pair, time_frame, exchange_type, start_date='2020-03-03 00:00:00', end_date=None, per_limit=1000, op_type=ExchangeFetchingType.FILL_RECENTLY, on_progress=None, retry_policy: RetryPolicy = None):
+        super().__init__(coin_pair, time_frame, exchange_type, start_date, end_date, per_limit, op_type, on_progress, retry_policy)
+        # table name
+        self.candle_cls = candle_record_class_with_components(self.provider.display_name, coin_pair, time_frame)
+        # 后台写入，回补写进已缓存区间中间的K线时通知本地缓存(FILL_RECENTLY 只写尾部，缓存自己会刷新)
+        candle_cache = default_candle_cache() if op_type != ExchangeFetchingType.FILL_RECENTLY else None
+        self.__sink = MongoCandleSink(self.candle_cls, candle_cache=candle_cache)
+        self.__sink.listen(None, self._did_write)
+
+    @property
+    def _sink(self):
+        return self.__sink
+
+    def _get_candle_timestamps(self, start_date, end_date):
+        """只取 _id，在库里转成毫秒时间戳"""
+        pipeline = [{
+            '$match': {
+                '_id': {
+                    '$gte': start_date,
+                    '$lt': end_date
+                }
+            }
+        }, {
+            '$project': {
+                '_id': 0,
+                'ts': {
+                    '$toLong': '$_id'
+                }
+            }
+        }]
+        cursor = self.candle_cls._mongometa.collection.aggregate(pipeline, batchSize=100000)
+        return np.fromiter((doc['ts'] for doc in cursor), dtype=np.int64)
+
+
+class InfluxDBHistoricalSpotCandle(HistoricalSpotCandleBase):
+    """外部连接数据库，内部只负责写入"""
+
+    def __init__(self, coin_pair: CoinPair, time_frame, exchange_type, start_date='2020-03-03 00:00:00', end_date=None, per_limit=1000, database='spot_market', op_type=ExchangeFetchingType.FILL_RECENTLY, sink: InfluxCandleSink = None, on_progress=None, retry_policy: RetryPolicy = None,
+                 host=None, token='', org=''):
+        """host / token / org: InfluxDB 连接，不传 sink 时用来建 sink，host 为空时和 cy_data_access 一样连 DEFAULT_INFLUX_HOST"""
+        super().__init__(coin_pair, time_frame, exchange_type, start_date, end_date, per_limit, op_type, on_progress, retry_policy)
         # table name
         self.measurement_name = influx_market_measurement_name(self.provider.display_name, coin_pair.formatted('_'), 'spot', time_frame.value)
         self.database_name = database
+        # 批量写入，多个币对可以共用一个 sink，按 measurement 分开攒批
+        if sink is None:
+            sink = InfluxCandleSink(database, host if host is not None else DEFAULT_INFLUX_HOST, token, org)
+        self.__sink = sink
+        self.host = host if host is not None else sink.host
+        self.__sink.listen(self.measurement_name, self._did_write)
 
-    def run_task(self, retry=10):
-        # 开始抓取
-        try:
-            procedure = ExchangeFetchingProcedure(self.fetcher, self.config, None, self.__get_latest_date, self.__save_df)
-            procedure.run_task()
-        except Exception as e:
-            print("Fetche Failed", e)
-            if retry > 0:
-                time.sleep(3)
-                self.run_task(retry - 1)
+    @property
+    def _sink(self):
+        return self.__sink
 
-    def __get_latest_date(self):
-        print("lastest date: {}".format(self.start_date))
-        return self.start_date
+    @property
+    def _sink_key(self):
+        return self.measurement_name
 
-    def __save_df(self, df: pd.DataFrame):
-        if df.shape[0] == 0:
-            return False
-        # 最后日期
-        self.start_date = df.sort_values(COL_CANDLE_BEGIN_TIME, ascending=False)[COL_CANDLE_BEGIN_TIME].iloc[0]
-        # 保存
-        influx_client_write_data_frame(df=df, df_time_index_name='candle_begin_time', database=self.database_name, measurement_name=self.measurement_name)
-        return self.start_date < self.end_date
+    def _get_candle_timestamps(self, start_date, end_date):
+        """只查 close 一个 field 的 _time"""
+        query = f'from(bucket: "{self.database_name}")' \
+            f' |> range(start: {start_date.isoformat()}, stop: {end_date.isoformat()})' \
+            f' |> filter(fn: (r) => r._measurement == "{self.measurement_name}" and r._field == "close")' \
+            ' |> keep(columns: ["_time"])'
+        result = influx_client_query_data_frame(host=self.host, query=query)
+        if isinstance(result, list):
+            result = pd.concat(result, ignore_index=True) if len(result) > 0 else pd.DataFrame()
+        if result.shape[0] == 0:
+            return np.array([], dtype=np.int64)
+        return pd.to_datetime(result['_time'], utc=True).values.astype('datetime64[ms]').astype(np.int64)
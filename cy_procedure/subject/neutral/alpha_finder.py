@@ -1,19 +1,29 @@
 import os
-import talib as ta
+import json
+import time
+import multiprocessing as mp
 import traceback
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from fracdiff import fdiff
-from joblib import Parallel, delayed
+import matplotlib
+from joblib import Parallel, delayed, effective_n_jobs
 from . import functions as fs
+from .selection import SelectionPanel, nan_cumprod
+from .factor_store import FactorStore, FactorStoreWriter, cross_section_name, precompute_cross_section
+from .factor_registry import FactorEvaluator
+from .resample import resample_offsets
+from .report import EquityCurve, EquityRenderer, render_grid, render_html
+from .ga import DnaPanel, FitnessCache, dna_key, mutation_rate, mutate, crossover, tournament_select
 from cy_components.defines.enums import RuleType
-from cy_components.helpers.formatter import CandleFormatter as cfr, DateFormatter as dfr
+from cy_components.helpers.formatter import CandleFormatter as cfr
 from cy_data_access.connection.connect import *
 from cy_data_access.models.market import *
 from cy_data_access.util.convert import *
-from cy_procedure.util.helper import ProcedureHelper as ph
+from cy_procedure.util.candle_cache import default_candle_cache
+from cy_procedure.util.candle_loader import load_candle_df, CANDLE_FIELDS
+
+# resample 的对齐起点，所有币种的周期都从这里按持币周期切分，不依赖各自第一根K线的时间
+__RESAMPLE_ORIGIN = pd.Timestamp('2020-01-01 00:00:00', tz='UTC')
 
 # ======== Phase 1 ========
 
@@ -23,14 +33,8 @@ def __read_df(coin_pair_str, time_interval_str):
     candle_collection_name = 'binance_{}_{}'.format(coin_pair_str.replace('/', '_').lower(), time_interval_str.lower())
     candle_cls = candle_record_class(candle_collection_name)
     try:
-        df = pd.DataFrame(list(candle_cls.objects.raw({
-            '_id': {
-                '$gte': pd.to_datetime('2020-01-01').tz_localize(pytz.utc),
-            }
-        }).order_by([('_id', 1)]).all().values()))
-        # Tidy candle
-        if df is not None:
-            ph.tidy_candle_from_database(df)
+        # 走本地缓存，只从库里取新增的
+        df = default_candle_cache().read(candle_cls, start_date=pd.to_datetime('2020-01-01').tz_localize(pytz.utc))
         # 增加两列数据
         df['symbol'] = coin_pair_str.split('/')[0].lower()  # symbol
         df['avg_price'] = df['quote_volume'] / df['volume']  # 均价
@@ -63,15 +67,15 @@ def __deal_coin_pair_to_1h(coin_pair_str):
         'taker_buy_quote_asset_volume': 'sum',
         'avg_price_5m': 'first'
     }
-    df = df.resample(rule='1H').agg(agg_dict)
+    df = df.resample(rule='1h', origin=__RESAMPLE_ORIGIN).agg(agg_dict)
 
     # =针对1小时数据，补全空缺的数据。保证整张表没有空余数据
-    df['symbol'].fillna(method='ffill', inplace=True)
+    df['symbol'] = df['symbol'].ffill()
     # 对开、高、收、低、价格进行补全处理
-    df['close'].fillna(method='ffill', inplace=True)
-    df['open'].fillna(value=df['close'], inplace=True)
-    df['high'].fillna(value=df['close'], inplace=True)
-    df['low'].fillna(value=df['close'], inplace=True)
+    df['close'] = df['close'].ffill()
+    df['open'] = df['open'].fillna(value=df['close'])
+    df['high'] = df['high'].fillna(value=df['close'])
+    df['low'] = df['low'].fillna(value=df['close'])
     # 将停盘时间的某些列，数据填补为0
     fill_0_list = ['volume', 'quote_volume', 'trade_num',
                    'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume']
@@ -83,8 +87,8 @@ def __deal_coin_pair_to_1h(coin_pair_str):
 
     # =计算最终的均价
     df['avg_price'] = df['avg_price_1m']  # 默认使用1分钟均价
-    df['avg_price'].fillna(value=df['avg_price_5m'], inplace=True)  # 没有1分钟均价就使用5分钟均价
-    df['avg_price'].fillna(value=df['open'], inplace=True)  # 没有5分钟均价就使用开盘价
+    df['avg_price'] = df['avg_price'].fillna(value=df['avg_price_5m'])  # 没有1分钟均价就使用5分钟均价
+    df['avg_price'] = df['avg_price'].fillna(value=df['open'])  # 没有5分钟均价就使用开盘价
     del df['avg_price_5m']
     del df['avg_price_1m']
 
@@ -115,30 +119,7 @@ def generate_panel_data(coin_pair_str):
 
 # ======== Phase 2 ========
 
-def __add_diff(_df, _d_list, _name, _agg_dict, _agg_type, _add=True):
-    """ 为 数据列 添加 差分数据列
-    :param _add:
-    :param _df: 原数据 DataFrame
-    :param _d_list: 差分阶数 [0.3, 0.5, 0.7]
-    :param _name: 需要添加 差分值 的数据列 名称
-    :param _agg_dict:
-    :param _agg_type:
-    :param _add:
-    :return: """
-    if _add:
-        for _d_num in _d_list:
-            if len(_df) >= 12:  # 数据行数大于等于12才进行差分操作
-                _diff_ar = fdiff(_df[_name], n=_d_num, window=10, mode="valid")  # 列差分，不使用未来数据
-                _paddings = len(_df) - len(_diff_ar)  # 差分后数据长度变短，需要在前面填充多少数据
-                _diff = np.nan_to_num(np.concatenate((np.full(_paddings, 0), _diff_ar)), nan=0)  # 将所有nan替换为0
-                _df[_name + f'_diff_{_d_num}'] = _diff  # 将差分数据记录到 DataFrame
-            else:
-                _df[_name + f'_diff_{_d_num}'] = np.nan  # 数据行数不足12的填充为空数据
-
-            _agg_dict[_name + f'_diff_{_d_num}'] = _agg_type
-
-
-def __prepare_one_hold(df, _back_hours, _hold_hour, diff_d=[0.3, 0.5]):
+def __prepare_one_hold(df, _back_hours, _hold_hour, diff_d=[0.3, 0.5], _profile=False, _factors=None):
     """ 为一个币种一个持币周期添加所有回溯周期的因子数据，并添加该持币周期的所有offset，返回一个 DataFrame
     :param _pkl_file: 整理好基础数据的一个币种的 pkl 文件路径
     :param _back_hours: 回溯周期列表 [3, 4, 6, 8, 12, 24, 48, 60, 72, 96]  关联因子周期
@@ -146,232 +127,26 @@ def __prepare_one_hold(df, _back_hours, _hold_hour, diff_d=[0.3, 0.5]):
     :param _hold_hour: 持币周期 '2H', '3H', '4H', '6H', '8H', '12H', '24H', '36H', '48H', '60H', '72H'
         上述周期中之一， 关联 添加 offset 标签列
         如果持币周为 2H offset 为 0, 1; 如果持币周为 3H offset 为 0, 1, 2;
+    :param _profile: 打印每组因子的耗时和 rolling 缓存省下的时间
+    :param _factors: 只计算这些因子列(如 ['bias_bh_12', 'RSI_bh_24_diff_0.3'])，默认全部注册的因子
     :return: """
 
     df['涨跌幅'] = df['close'].pct_change()  # 计算涨跌幅
     df['下个周期_avg_price'] = df['avg_price'].shift(-1)  # 计算下根K线开盘买入涨跌幅
     df.loc[df['volume'] == 0, '是否交易'] = 0  # 找出不交易的周期
-    df['是否交易'].fillna(value=1, inplace=True)
+    df['是否交易'] = df['是否交易'].fillna(value=1)
 
-    """ ******************** 以下是需要修改的代码 ******************** """
     # =====计算各项选币指标
-    extra_agg_dict = dict()
-
-    # =====技术指标
-    # --- KDJ ---
-    for n in _back_hours:
-        # 正常K线数据 计算 KDJ
-        low_list = df['low'].rolling(n, min_periods=1).min()  # 过去n(含当前行)行数据 最低价的最小值
-        high_list = df['high'].rolling(n, min_periods=1).max()  # 过去n(含当前行)行数据 最高价的最大值
-        rsv = (df['close'] - low_list) / (high_list - low_list) * 100  # 未成熟随机指标值
-        df[f'K_bh_{n}'] = rsv.ewm(com=2).mean().shift(1)  # K
-        extra_agg_dict[f'K_bh_{n}'] = 'first'
-        df[f'D_bh_{n}'] = df[f'K_bh_{n}'].ewm(com=2).mean()  # D
-        extra_agg_dict[f'D_bh_{n}'] = 'first'
-        df[f'J_bh_{n}'] = 3 * df[f'K_bh_{n}'] - 2 * df[f'D_bh_{n}']  # J
-        extra_agg_dict[f'J_bh_{n}'] = 'first'
-
-        #  差分
-        # 使用差分后的K线数据 计算 KDJ  --- 标准差变大，数据更不稳定，放弃
-        # 用计算后的KDJ指标，再差分  --- 标准差变小，数据更稳定，采纳
-        for _ind in ['K', 'D', 'J']:
-            __add_diff(_df=df, _d_list=diff_d, _name=f'{_ind}_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- RSI ---  在期货市场很有效
-    close_dif = df['close'].diff()
-    df['up'] = np.where(close_dif > 0, close_dif, 0)
-    df['down'] = np.where(close_dif < 0, abs(close_dif), 0)
-    for n in _back_hours:
-        a = df['up'].rolling(n).sum()
-        b = df['down'].rolling(n).sum()
-        df[f'RSI_bh_{n}'] = (a / (a + b)).shift(1)  # RSI
-        extra_agg_dict[f'RSI_bh_{n}'] = 'first'
-
-        # 差分
-        # 用计算后的RSI指标，再差分  --- 标准差变小，数据更稳定，采纳
-        __add_diff(_df=df, _d_list=diff_d, _name=f'RSI_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    del df['up'], df['down']  # 删除过程数据
-
-    # ===常见变量
-    # --- 均价 ---  对应低价股策略(预计没什么用)
-    # 策略改进思路：以下所有用到收盘价的因子，都可尝试使用均价代替
-    for n in _back_hours:
-        df[f'均价_bh_{n}'] = (df['quote_volume'].rolling(n).sum() / df['volume'].rolling(n).sum()).shift(1)
-        extra_agg_dict[f'均价_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'均价_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 涨跌幅 ---
-    for n in _back_hours:
-        df[f'涨跌幅_bh_{n}'] = df['close'].pct_change(n).shift(1)
-        extra_agg_dict[f'涨跌幅_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'涨跌幅_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- bias ---  涨跌幅更好的表达方式 bias 币价偏离均线的比例。
-    for n in _back_hours:
-        ma = df['close'].rolling(n, min_periods=1).mean()
-        df[f'bias_bh_{n}'] = (df['close'] / ma - 1).shift(1)
-        extra_agg_dict[f'bias_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'bias_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 振幅 ---  最高价最低价
-    for n in _back_hours:
-        high = df['high'].rolling(n, min_periods=1).max()
-        low = df['low'].rolling(n, min_periods=1).min()
-        df[f'振幅_bh_{n}'] = (high / low - 1).shift(1)
-        extra_agg_dict[f'振幅_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'振幅_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 振幅2 ---  收盘价、开盘价
-    high = df[['close', 'open']].max(axis=1)
-    low = df[['close', 'open']].min(axis=1)
-    for n in _back_hours:
-        high = high.rolling(n, min_periods=1).max()
-        low = low.rolling(n, min_periods=1).min()
-        df[f'振幅2_bh_{n}'] = (high / low - 1).shift(1)
-        extra_agg_dict[f'振幅2_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'振幅2_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 涨跌幅std ---  振幅的另外一种形式
-    change = df['close'].pct_change()
-    for n in _back_hours:
-        df[f'涨跌幅std_bh_{n}'] = change.rolling(n).std().shift(1)
-        extra_agg_dict[f'涨跌幅std_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'涨跌幅std_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 涨跌幅skew ---  在商品期货市场有效
-    # skew偏度rolling最小周期为3才有数据
-    for n in _back_hours:
-        df[f'涨跌幅skew_bh_{n}'] = change.rolling(n).skew().shift(1)
-        extra_agg_dict[f'涨跌幅skew_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'涨跌幅skew_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 成交额 ---  对应小市值概念
-    for n in _back_hours:
-        df[f'成交额_bh_{n}'] = df['quote_volume'].rolling(n, min_periods=1).sum().shift(1)
-        extra_agg_dict[f'成交额_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'成交额_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 成交额std ---  191选股因子中最有效的因子
-    for n in _back_hours:
-        df[f'成交额std_bh_{n}'] = df['quote_volume'].rolling(n, min_periods=2).std().shift(1)
-        extra_agg_dict[f'成交额std_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'成交额std_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 资金流入比例 --- 币安独有的数据
-    for n in _back_hours:
-        volume = df['quote_volume'].rolling(n, min_periods=1).sum()
-        buy_volume = df['taker_buy_quote_asset_volume'].rolling(n, min_periods=1).sum()
-        df[f'资金流入比例_bh_{n}'] = (buy_volume / volume).shift(1)
-        extra_agg_dict[f'资金流入比例_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'资金流入比例_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 量比 ---
-    for n in _back_hours:
-        df[f'量比_bh_{n}'] = (df['quote_volume'] / df['quote_volume'].rolling(n, min_periods=1).mean()).shift(1)
-        extra_agg_dict[f'量比_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'量比_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 成交笔数 ---
-    for n in _back_hours:
-        df[f'成交笔数_bh_{n}'] = df['trade_num'].rolling(n, min_periods=1).sum().shift(1)
-        extra_agg_dict[f'成交笔数_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'成交笔数_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- 量价相关系数 ---  量价相关选股策略
-    for n in _back_hours:
-        df[f'量价相关系数_bh_{n}'] = df['close'].rolling(n).corr(df['quote_volume']).shift(1)
-        extra_agg_dict[f'量价相关系数_bh_{n}'] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=f'量价相关系数_bh_{n}', _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # --- Angle ---
-    for n in _back_hours:
-        column_name = f'Angle_bh_{n}'
-        ma = df['close'].rolling(window=n, min_periods=1).mean()
-        df[column_name] = ta.LINEARREG_ANGLE(ma, n)
-        df[column_name] = df[column_name].shift(1)
-        extra_agg_dict[column_name] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=column_name, _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # ---- GapTrue ----
-    for n in _back_hours:
-        ma = df['close'].rolling(window=n, min_periods=1).mean()
-        wma = ta.WMA(df['close'], n)
-        gap = wma - ma
-        column_name = f'GapTrue_bh_{n}'
-        df[column_name] = gap / abs(gap).rolling(window=n).sum()
-        df[column_name] = df[column_name].shift(1)
-        extra_agg_dict[column_name] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=column_name, _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # ---- 癞子 ----
-    for n in _back_hours:
-        diff = df['close'] / df['close'].shift(1) - 1
-        column_name = f'癞子_bh_{n}'
-        df[column_name] = diff / abs(diff).rolling(window=n).sum()
-        df[column_name] = df[column_name].shift(1)
-        extra_agg_dict[column_name] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=column_name, _agg_dict=extra_agg_dict, _agg_type='first')
-
-    # ---- CCI ----
-    for n in _back_hours:
-        oma = ta.WMA(df.open, n)
-        hma = ta.WMA(df.high, n)
-        lma = ta.WMA(df.low, n)
-        cma = ta.WMA(df.close, n)
-        tp = (hma + lma + cma + oma) / 4
-        ma = ta.WMA(tp, n)
-        md = ta.WMA(abs(cma - ma), n)
-
-        column_name = f'CCI_bh_{n}'
-        df[column_name] = (tp - ma) / md
-        df[column_name] = df[column_name].shift(1)
-        extra_agg_dict[column_name] = 'first'
-
-        # 差分
-        __add_diff(_df=df, _d_list=diff_d, _name=column_name, _agg_dict=extra_agg_dict, _agg_type='first')
-
-    """ ******************** 以上是需要修改的代码 ******************** """
-    # ===将数据转化为需要的周期
-    # 在数据最前面，增加一行数据，这是为了在对>24h的周期进行resample时，保持数据的一致性。
-    df = df.loc[0:0, :].append(df, ignore_index=True)
-    df.loc[0, 'candle_begin_time'] = dfr.convert_string_to_local_date('2020-01-01 00:00:00').replace(tzinfo=pytz.utc)
+    # 因子在 factor_registry 中声明，只算要的列和它们依赖的中间数据
+    evaluator = FactorEvaluator(df, _back_hours, diff_d)
+    factor_df, extra_agg_dict = evaluator.evaluate(_factors)
+    df = pd.concat([df, factor_df], axis=1)
+    if _profile:
+        print(evaluator.report())
 
+    # ===将数据转化为需要的周期
     # 转换周期
     df['周期开始时间'] = df['candle_begin_time']
-    df.set_index('candle_begin_time', inplace=True)
 
     # 必备字段
     agg_dict = {
@@ -401,167 +176,326 @@ def __prepare_one_hold(df, _back_hours, _hold_hour, diff_d=[0.3, 0.5]):
     # 对于持币周期大于一天的来说，持币周期内相当于一天，例如48H，还是有48个offset 共计48批换仓点
     # 所以在固定长度日期范围内，所有持币周期都将有相同的数据行数
     # 所以不管何种持币周期，生成的合并 pkl 大小基本相同
-    period_df_list = []
-    for offset in range(int(_hold_hour[:-1])):
-        # 转换持币周期的 df 其列为 必备字段 + 因子字段
-        # 开始时间为 2010-01-01 00:00:00  在有交易数据的之前 除candle_begin_time列皆为 NaN
-
-        # 在24h之内 base 和 offset 一样
-        # period_df = df.resample(_hold_hour, offset=f'{offset}h').agg(agg_dict)
-        period_df = df.resample(_hold_hour, base=offset).agg(agg_dict)
-
-        # 上一行代码对数据转换完周期后，刚开始会有大量的空数据，没有必要对这些数据进行删除，因为后面会删除18年之前的数据。
-        # 添加 offset 标签列
-        # 如果持币周为 2 offset 为 0, 1; 如果持币周为 3 offset 为 0, 1, 2;
-        period_df['offset'] = offset
-
-        # 原版自适应布林通道
-        n = 34
-        period_df['close_shift'] = period_df['close'].shift(1)
-        period_df['median'] = period_df['close_shift'].rolling(window=n).mean()
-        period_df['std'] = period_df['close_shift'].rolling(n, min_periods=1).std(ddof=0)  # ddof代表标准差自由度
-        period_df['z_score'] = abs(period_df['close_shift'] - period_df['median']) / period_df['std']
-        period_df['up'] = period_df['z_score'].rolling(window=n, min_periods=1).max().shift(1)
-        period_df['dn'] = period_df['z_score'].rolling(window=n, min_periods=1).min().shift(1)
-        period_df['upper'] = period_df['median'] + period_df['std'] * period_df['up']
-        period_df['lower'] = period_df['median'] - period_df['std'] * period_df['up']
-        period_df['condition_long'] = period_df['close_shift'] >= period_df['lower']  # 破下轨，不做多
-        period_df['condition_short'] = period_df['close_shift'] <= period_df['upper']  # 破上轨，不做空
-
-        period_df.reset_index(inplace=True)
-
-        # 合并数据
-        period_df_list.append(period_df)
-
-    # 将不同offset的数据，合并到一张表
-    period_df = pd.concat(period_df_list, ignore_index=True)
-    period_df.reset_index(inplace=True)
+
+    # 所有 offset 一次转换，周期对齐到 __RESAMPLE_ORIGIN + offset，>24h 的持币周期在所有币种之间也是一致的
+    # 不再在数据最前面插一行 2020-01-01 的假数据来对齐，不用复制整张宽表
+    hold = int(_hold_hour[:-1])
+    period_df = resample_offsets(df, agg_dict, f'{hold}h', __RESAMPLE_ORIGIN, offsets=[f'{offset}h' for offset in range(hold)])
+    __add_bollinger(period_df)
 
     # 删除一些数据
-    period_df = period_df.iloc[24:]  # 刚开始交易前24个周期删除
+    # 原来的 iloc[24:] 删的是对齐用的假数据之后的前24个周期，都在 2020-09-01 之前，下面的过滤已经包含
     period_df = period_df[period_df['candle_begin_time'] >= pd.to_datetime('2020-09-01').tz_localize(pytz.utc)]
     period_df.reset_index(drop=True, inplace=True)
-    del period_df['index']
     return period_df
 
 
-def prepare_symbol_hold(symbol, hold_hour, back_hour_list, diff_d):
-    """读取数据，计算各持仓周期"""
+def __add_bollinger(period_df, n=34):
+    """ 原版自适应布林通道，每个 offset 各自计算，按 offset 分组 rolling，不用逐个 offset 切出来算 """
+    group = period_df['offset']
+
+    def rolling(series, window, min_periods=None):
+        return series.groupby(group).rolling(window, min_periods=min_periods)
+
+    def ungroup(series):
+        return series.reset_index(level=0, drop=True).sort_index()
+
+    period_df['close_shift'] = period_df['close'].groupby(group).shift(1)
+    period_df['median'] = ungroup(rolling(period_df['close_shift'], n).mean())
+    period_df['std'] = ungroup(rolling(period_df['close_shift'], n, 1).std(ddof=0))  # ddof代表标准差自由度
+    period_df['z_score'] = abs(period_df['close_shift'] - period_df['median']) / period_df['std']
+    period_df['up'] = ungroup(rolling(period_df['z_score'], n, 1).max()).groupby(group).shift(1)
+    period_df['dn'] = ungroup(rolling(period_df['z_score'], n, 1).min()).groupby(group).shift(1)
+    period_df['upper'] = period_df['median'] + period_df['std'] * period_df['up']
+    period_df['lower'] = period_df['median'] - period_df['std'] * period_df['up']
+    period_df['condition_long'] = period_df['close_shift'] >= period_df['lower']  # 破下轨，不做多
+    period_df['condition_short'] = period_df['close_shift'] <= period_df['upper']  # 破上轨，不做空
+
+
+__PANEL_START = pd.to_datetime('2020-08-08').tz_localize(pytz.utc)
+
+
+def __read_symbol_panel(symbol):
+    """读一个币种的面板数据"""
+    # 只取需要的字段，candle_begin_time 直接是 UTC datetime64
+    return load_candle_df(NeutralPanelCandleRecord._mongometa.collection,
+                          {'symbol': symbol, 'candle_begin_time': {'$gt': __PANEL_START}},
+                          fields=['symbol'] + CANDLE_FIELDS + ['avg_price'], time_field='candle_begin_time', sort=None)
+
+
+def prepare_symbol_hold(symbol, hold_hour, back_hour_list, diff_d, factors=None):
+    """读取数据，计算各持仓周期，factors 为只计算的因子列，默认全部"""
     connect_db_env(db_name=DB_MARKET)
-    df = pd.DataFrame(list(NeutralPanelCandleRecord.objects.raw({'symbol': symbol,
-                                                                 'candle_begin_time': {'$gt': pd.to_datetime('2020-08-08').tz_localize(pytz.utc)}}).values()))
-    del df['_id']
-    del df['_cls']
+    df = __read_symbol_panel(symbol)
+
+    return __prepare_one_hold(df, back_hour_list, hold_hour, diff_d, _factors=factors)
 
-    # 这里因为里面会增加一个2020-01-01，要把 bson 的 datetime 转为 utc datetime，否则 index 会变成 Index
-    dsIndex = pd.Index(df['candle_begin_time'])
-    dsIndex = dsIndex.tz_localize(tz=None)
-    df['candle_begin_time'] = dsIndex.tz_localize(tz='UTC')
 
-    return __prepare_one_hold(df, back_hour_list, hold_hour, diff_d)
+def prepare_hold_to_store(symbols, hold_hour, back_hour_list, diff_d, data_path, factors=None):
+    """逐个币种计算，结果追加写入该持币周期的因子库，不在内存里合并所有币种"""
+    with FactorStoreWriter(FactorStore.for_hold(data_path, hold_hour)) as writer:
+        for symbol in symbols:
+            s_time = time.time()
+            writer.append(prepare_symbol_hold(symbol, hold_hour, back_hour_list, diff_d, factors))
+            print(f'{symbol} {hold_hour} 写入因子库完成，花费时间：{round(time.time() - s_time, 1)}s')
+
+
+# ===== Phase 2 并行: 币种 × 持币周期 分到进程池，每个任务写自己的分片，最后合并
+
+__db_semaphore = None
+
+
+def __phase2_worker_init(db_semaphore):
+    """子进程初始化，连接数据库，保存读库的信号量"""
+    global __db_semaphore
+    __db_semaphore = db_semaphore
+    connect_db_env(db_name=DB_MARKET)
+
+
+def __symbol_fingerprint(symbol, hold_hour, back_hour_list, diff_d, factors=None):
+    """输入数据(行数、首尾时间、close 之和)和参数的指纹，没变就不用重算"""
+    pipeline = [{
+        '$match': {'symbol': symbol, 'candle_begin_time': {'$gt': __PANEL_START}}
+    }, {
+        '$group': {
+            '_id': None,
+            'count': {'$sum': 1},
+            'first': {'$min': '$candle_begin_time'},
+            'last': {'$max': '$candle_begin_time'},
+            'close_sum': {'$sum': '$close'},
+        }
+    }]
+    stats = list(NeutralPanelCandleRecord._mongometa.collection.aggregate(pipeline))
+    stats = stats[0] if len(stats) > 0 else {}
+    return json.dumps([symbol, hold_hour, list(back_hour_list), list(diff_d), factors, stats.get('count'),
+                       stats.get('first'), stats.get('last'), stats.get('close_sum')], ensure_ascii=False, default=str)
+
+
+def __shard_store(data_path, hold_hour, symbol):
+    return FactorStore(os.path.join(data_path, f'factor_shards_{hold_hour}', symbol))
+
+
+def __phase2_task(symbol, hold_hour, back_hour_list, diff_d, data_path, factors=None):
+    """计算一个 币种 × 持币周期，写到自己的分片，返回 (symbol, hold_hour, 状态, 耗时)"""
+    s_time = time.time()
+    try:
+        shard = __shard_store(data_path, hold_hour, symbol)
+        # 读库的进程数有限制
+        with __db_semaphore:
+            fingerprint = __symbol_fingerprint(symbol, hold_hour, back_hour_list, diff_d, factors)
+            if shard.exists() and shard.meta.get('fingerprint') == fingerprint:
+                return symbol, hold_hour, 'skip', time.time() - s_time
+            df = __read_symbol_panel(symbol)
+        df = __prepare_one_hold(df, back_hour_list, hold_hour, diff_d, _factors=factors)
+        with FactorStoreWriter(shard) as writer:
+            writer.append(df)
+            shard.meta['fingerprint'] = fingerprint
+        return symbol, hold_hour, 'done', time.time() - s_time
+    except Exception:
+        print(traceback.format_exc())
+        return symbol, hold_hour, 'failed', time.time() - s_time
+
+
+def merge_factor_shards(data_path, hold_hour, symbols, skip=()):
+    """按 symbols 的顺序把分片合并成该持币周期的因子库
+    :param skip: 不合并的币种，如这次计算失败的，磁盘上可能还留着旧参数算的分片 """
+    store = FactorStore.for_hold(data_path, hold_hour)
+    skip = set(skip)
+    with FactorStoreWriter(store) as writer:
+        for symbol in symbols:
+            if symbol in skip:
+                print(f'{symbol} {hold_hour} 计算失败，不合并')
+                continue
+            shard = __shard_store(data_path, hold_hour, symbol)
+            if not shard.exists() or not shard.rows:
+                continue
+            writer.append(shard.frame(shard.factor_names))
+    return store
+
+
+def prepare_all_holds(symbols, hold_hours, back_hour_list, diff_d, data_path, processes=None, max_db_readers=4, factors=None, cross_section=None):
+    """ Phase 2 驱动: 所有 币种 × 持币周期 并行计算因子并写入因子库
+    :param factors: 只计算这些因子列，如 GA 要用的 factors + dna_range，默认全部
+    :param cross_section: 合并后预先算好的横截面变换，如 ('rank', 'zscore')，默认不算
+    :param processes: 进程数，默认所有核
+    :param max_db_readers: 同时读库的进程数上限
+    :return: 失败的 [(symbol, hold_hour)] """
+    processes = processes or os.cpu_count()
+    factors = list(factors) if factors is not None else None
+    tasks = [(symbol, hold_hour, back_hour_list, diff_d, data_path, factors) for hold_hour in hold_hours for symbol in symbols]
+    print(f'Phase 2: {len(symbols)} 个币种 × {len(hold_hours)} 个持币周期，{processes} 个进程，{max_db_readers} 个读库')
+    s_time = time.time()
+    changed = set()
+    failed = []
+    db_semaphore = mp.Semaphore(max_db_readers)
+    with mp.Pool(processes=processes, initializer=__phase2_worker_init, initargs=(db_semaphore,)) as pool:
+        for symbol, hold_hour, status, cost in pool.imap_unordered(__phase2_task_star, tasks):
+            print(f'{symbol} {hold_hour} {status}，花费时间：{round(cost, 1)}s')
+            if status == 'done':
+                changed.add(hold_hour)
+            elif status == 'failed':
+                failed.append((symbol, hold_hour))
+                changed.add(hold_hour)  # 旧的因子库里可能有这个币种的旧分片，要重新合并
+
+    # 分片有变化或者还没有合并过的才合并
+    for hold_hour in hold_hours:
+        if hold_hour in changed or not FactorStore.for_hold(data_path, hold_hour).exists():
+            m_time = time.time()
+            store = merge_factor_shards(data_path, hold_hour, symbols, skip=[x for x, h in failed if h == hold_hour])
+            print(f'{hold_hour} 合并完成，{store.rows} 行，花费时间：{round(time.time() - m_time, 1)}s')
+        # 因子库里缺少的横截面变换列都补上，不只是刚合并的
+        store = FactorStore.for_hold(data_path, hold_hour)
+        if cross_section and store.exists():
+            missing = [x for x in store.factor_names if ':' not in x
+                       and not all(store.has_column(cross_section_name(t, x)) for t in cross_section)]
+            if missing:
+                c_time = time.time()
+                precompute_cross_section(store, names=missing, transforms=cross_section)
+                print(f'{hold_hour} 横截面变换 {len(missing)} 个因子，花费时间：{round(time.time() - c_time, 1)}s')
+    print(f'Phase 2 完成，失败 {len(failed)} 个，花费时间：{round(time.time() - s_time, 1)}s')
+    return failed
+
+
+def __phase2_task_star(args):
+    return __phase2_task(*args)
 
 
 # ============ Phase 3 =============
 
 matplotlib_font = 'SimHei'  # SimHei  AR PL UKai CN
-plt.rcParams['font.sans-serif'] = [matplotlib_font]
-plt.rcParams['axes.unicode_minus'] = False
+matplotlib.rcParams['font.sans-serif'] = [matplotlib_font]
+matplotlib.rcParams['axes.unicode_minus'] = False
 os.environ['NUMEXPR_MAX_THREADS'] = "8"
 
+# figsize -> EquityRenderer，Figure 只建一次
+__renderers = dict()
 
-def plot_main(factor_set, output_path, _fgsz=(10, 5), ind1=None, ind2=None, ind3=None, ind4=None, ind5=None, ind6=None, select_c=None):
-    """画图
-    factor_set: ['3H', 'bias_bh...', offset, reverse]
-    """
+
+def __renderer(figsize):
+    if figsize not in __renderers:
+        __renderers[figsize] = EquityRenderer(figsize)
+    return __renderers[figsize]
+
+
+def __curve_title(factor_set, ind1, ind2, ind3, ind4, ind5, ind6):
     title = f"Factor:{factor_set[1]}  Hold Period:{factor_set[0]}  offset:{factor_set[2]}"
     title += f"\nEquity Curve:{ind1}  Max Drawdown:{ind2}  Win Rate:{ind3}"
     title += f"\nProfit/Loss:{ind4}  Max Consecutive Wins:{ind5}  Max Consecutive Losses:{ind6}"
+    return title
+
 
-    # ===画图
-    plt.figure(figsize=_fgsz)
-    plt.title(title)
-    plt.plot(select_c['candle_begin_time'], select_c['资金曲线'], label='Equity Curve')
-    plt.legend(loc='best')
-    plt.grid(True, linestyle='-.', dashes=(5, 5), linewidth=0.5)
-    plt.subplots_adjust(left=0.06, right=0.98, bottom=0.07, top=0.86)
-    pic_file1 = f'{output_path}/{factor_set[0]}_{factor_set[1]}_[{factor_set[3]}]_offset{factor_set[2]}_curve.png'
-    plt.savefig(pic_file1), plt.close('all')
-
-    plt.figure(figsize=_fgsz)
-    plt.title(title)
-    plt.plot(select_c['candle_begin_time'], np.log(select_c['资金曲线']), label='EquityCurve_log')
-    plt.legend(loc='best')
-    plt.grid(True, linestyle='-.', dashes=(5, 5), linewidth=0.5)
-    plt.subplots_adjust(left=0.06, right=0.98, bottom=0.07, top=0.86)
-    pic_file2 = f'{output_path}/{factor_set[0]}_{factor_set[1]}_[{factor_set[3]}]_offset{factor_set[2]}_curve2.png'
-    plt.savefig(pic_file2), plt.close('all')
-
-    # ===合并图像并显示
-    pic1 = np.array(Image.open(pic_file1))
-    pic2 = np.array(Image.open(pic_file2))
-    pic = np.concatenate((pic1, pic2), axis=0)
+def plot_main(factor_set, output_path, _fgsz=(10, 5), ind1=None, ind2=None, ind3=None, ind4=None, ind5=None, ind6=None, select_c=None):
+    """画图，资金曲线和对数资金曲线上下两个子图，一次画完写进 _cl.png
+    factor_set: ['3H', 'bias_bh...', offset, reverse]
+    """
+    title = __curve_title(factor_set, ind1, ind2, ind3, ind4, ind5, ind6)
+    curve = EquityCurve(title, select_c['candle_begin_time'].values, select_c['资金曲线'].values)
     pic_file = f'{output_path}/{factor_set[0]}_{factor_set[1]}_[{factor_set[3]}]_offset{factor_set[2]}_cl.png'
-    plt.imsave(pic_file, arr=pic, format='png'), plt.close('all')
-    os.system(f'chrome {pic_file}')
-    os.remove(pic_file1)
-    os.remove(pic_file2)
+    __renderer(tuple(_fgsz)).save(curve, pic_file)
+    return pic_file
+
+
+def hold_curves(data_path, _hold_hour, rtn_df, c_rate, select_coin_num):
+    """cal_one_hold 的结果(每行 持币周期、offset、因子名称、是否反转 + 指标) -> 每行的资金曲线
+    头文件每个 offset 只整理一次，因子列从因子库 memmap 读 """
+    store = FactorStore.for_hold(data_path, _hold_hour)
+    panels = {x[0]: x for x in __offset_panels(_hold_hour, store.header())}
+    curves = []
+    for _, row in rtn_df.iterrows():
+        _offset, rows, panel = panels[int(row['offset'])]
+        factor_set = [_hold_hour, row['因子名称'], _offset, row['是否反转']]
+        selection = panel.select(store.column(row['因子名称'])[rows], select_coin_num, bool(row['是否反转']), c_rate)
+        inds = [row[x] for x in ['累积净值', '最大回撤', '胜率', '盈亏收益比', '最大连盈', '最大连亏']]
+        name = f'{factor_set[0]}_{factor_set[1]}_[{factor_set[3]}]_offset{factor_set[2]}'
+        curves.append(EquityCurve(__curve_title(factor_set, *inds), panel.times, selection.equity, name=name,
+                                  info=dict(zip(['累积净值', '最大回撤', '胜率', '盈亏收益比', '最大连盈', '最大连亏'], inds))))
+    return curves
+
+
+def plot_hold(data_path, output_path, _hold_hour, c_rate, select_coin_num, rtn_df=None, top=20, fmt='html', _fgsz=(10, 5)):
+    """一个持币周期的回测结果一次出图，不逐个打开图片
+    :param rtn_df: cal_one_hold 的结果，None 读 cal_one_hold 保存的 csv
+    :param top: 按累积净值取前 top 行，None 为全部
+    :param fmt: 'html' 一个内嵌所有图片的 HTML 文件; 'grid' 一张缩略图网格 PNG
+    :return: 输出文件 """
+    if rtn_df is None:
+        rtn_df = pd.read_csv(f'{output_path}/{_hold_hour}_select_{select_coin_num}.csv', encoding='utf-8-sig', index_col=0)
+    rtn_df = rtn_df.sort_values(by=['累积净值'], ascending=False)
+    if top is not None:
+        rtn_df = rtn_df.head(top)
+    curves = hold_curves(data_path, _hold_hour, rtn_df, c_rate, select_coin_num)
+    if fmt == 'html':
+        path = f'{output_path}/{_hold_hour}_select_{select_coin_num}.html'
+        return render_html(curves, path, title=f'持币周期 {_hold_hour} 选币数 {select_coin_num}', renderer=__renderer(tuple(_fgsz)))
+    if fmt == 'grid':
+        return render_grid(curves, f'{output_path}/{_hold_hour}_select_{select_coin_num}_grid.png')
+    raise ValueError(f'不支持的格式 {fmt}')
 
 # ============ Phase 4 =============
 
 
+def __offset_panels(_hold_hour, _df_head):
+    """每个 offset 过滤一次，整理成 SelectionPanel，返回 [(offset, 行号, panel)]"""
+    panels = []
+    for _offset in range(int(_hold_hour[:-1])):
+        # =删除某些行数据: 该周期不交易的币种，最后几行数据下个周期_avg_price为空
+        mask = (_df_head['offset'] == _offset) & (_df_head['volume'] > 0) & _df_head['下个周期_avg_price'].notna()
+        rows = np.flatnonzero(mask.values)
+        panels.append((_offset, rows, SelectionPanel(_df_head.iloc[rows])))
+    return panels
+
+
+def __format_one_rtn(values):
+    """数值结果 -> 输出的 [累积净值, 最大回撤, 胜率, 盈亏收益比, 最大连盈, 最大连亏]"""
+    rtn = fs.format_ind(values)
+    return [rtn[x].values[0] for x in ['累积净值', '最大回撤', '胜率', '盈亏收益比', '最大连续盈利周期数', '最大连续亏损周期数']]
+
+
+def cal_one_hold_factors(data_path, _hold_hour, _df_head, factors, c_rate, select_coin_num, batch_size=16):
+    """ 一个持币周期的多个因子一起回测，正反两个方向
+    头文件每个 offset 只过滤、整理一次，因子列从因子库 memmap 读，同一 offset 下 batch_size 个因子一起选币
+    :return: [[持币周期, offset, 因子名称, 是否反转, 累积净值, 最大回撤, 胜率, 盈亏收益比, 最大连盈, 最大连亏]] """
+    print(data_path, _hold_hour, len(factors), c_rate, select_coin_num)
+    store = FactorStore.for_hold(data_path, _hold_hour)
+    panels = __offset_panels(_hold_hour, _df_head)
+    rtn_list = []
+    for batch_start in range(0, len(factors), batch_size):
+        batch_factors = factors[batch_start:batch_start + batch_size]
+        factor_values = [store.column(x) for x in batch_factors]
+        for _offset, rows, panel in panels:
+            stack = np.stack([panel.matrix(x[rows]) for x in factor_values])
+            normal, reverse = panel.batch_returns(stack, select_coin_num, c_rate)
+            for i, _factor in enumerate(batch_factors):
+                for _reverse, returns in [(True, reverse[i]), (False, normal[i])]:
+                    values = fs.ind_values(nan_cumprod(returns + 1), returns, panel.times)
+                    rtn_list.append([_hold_hour, _offset, _factor, _reverse] + __format_one_rtn(values))
+        print(_hold_hour, f'{min(batch_start + batch_size, len(factors))}/{len(factors)} 个因子完成')
+    return rtn_list
+
+
 def cal_one_hold_one_factor(data_path, _hold_hour, _df_head, _factor, _reverse, c_rate, select_coin_num):
-    print(data_path, _hold_hour, _df_head, _factor, _reverse, c_rate, select_coin_num)
-    rtn_one_hold_one_factor_list = []
-    # 添加因子列
-    data_pkl = _df_head.copy()
-    data_pkl[_factor] = pd.read_pickle(f'{data_path}/all_coin_data_hold_hour_{_hold_hour}_{_factor}.pkl')
-
-    for _offset in [_ for _ in range(int(_hold_hour[:-1]))]:
-        data_offset = data_pkl[data_pkl['offset'] == _offset].copy()
-        # =删除某些行数据
-        data_offset = data_offset[data_offset['volume'] > 0]  # 该周期不交易的币种
-        data_offset.dropna(subset=['下个周期_avg_price'], inplace=True)  # 最后几行数据，下个周期_avg_price为空
-        df = data_offset.copy()
-
-        select_c = fs.gen_select_df(_df=df, _c_rate=c_rate, _select_num=select_coin_num, _factor=_factor, _reverse=_reverse)
-        # =====计算统计指标
-        rtn = fs.cal_ind(_select_c=select_c)
-        ind1 = rtn['累积净值'].values[0]
-        ind2 = rtn['最大回撤'].values[0]
-        ind3 = rtn['胜率'].values[0]
-        ind4 = rtn['盈亏收益比'].values[0]
-        ind5 = rtn['最大连续盈利周期数'].values[0]
-        ind6 = rtn['最大连续亏损周期数'].values[0]
-
-        print(_hold_hour, 'offset', _offset, ' ', _factor, _reverse)
-        print('累积净值', ind1)
-        print('最大回撤', ind2)
-        print('胜率', ind3)
-        print('盈亏比', ind4)
-        print('最大连盈', ind5)
-        print('最大连亏', ind6)
-        print('\n')
-
-        rtn_one_hold_one_factor_list.append([_hold_hour, _offset, _factor, _reverse, ind1, ind2, ind3, ind4, ind5, ind6])
-
-    return rtn_one_hold_one_factor_list
+    rtn_list = cal_one_hold_factors(data_path, _hold_hour, _df_head, [_factor], c_rate, select_coin_num)
+    return [x for x in rtn_list if x[3] == _reverse]
 
 
 def cal_one_hold(data_path, output_path, _hold_hour, factors_name, n_jobs, c_rate, select_coin_num):
     rtn_factor_list = []
 
-    # 读取 指定交易类型 指定持币周期的 头文件列 pkl
-    head_pkl: pd.DataFrame = pd.read_pickle(f'{data_path}/all_coin_data_hold_hour_{_hold_hour}_0.pkl')
+    # 读取 指定持币周期的 头文件列，各进程共享因子库的 memmap
+    head_pkl: pd.DataFrame = FactorStore.for_hold(data_path, _hold_hour).header()
 
+    # 因子分成 n_jobs 份，每个进程批量回测自己的一份
+    factors_name = list(factors_name)
+    n_chunks = effective_n_jobs(n_jobs)
+    chunks = [factors_name[i::n_chunks] for i in range(n_chunks) if len(factors_name[i::n_chunks]) > 0]
     rtn_factor_list += Parallel(n_jobs=n_jobs)(
-        delayed(cal_one_hold_one_factor)(data_path, _hold_hour=_hold_hour, _df_head=head_pkl, _factor=factor, _reverse=reverse, c_rate=c_rate, select_coin_num=select_coin_num)
-        for factor in factors_name
-        for reverse in [True, False])
+        delayed(cal_one_hold_factors)(data_path, _hold_hour=_hold_hour, _df_head=head_pkl, factors=chunk, c_rate=c_rate, select_coin_num=select_coin_num)
+        for chunk in chunks)
 
     # 展平list
     rtn_list = []
-    for _one_factor_rtn in rtn_factor_list:
-        for _one_offset_rtn in _one_factor_rtn:
+    for _one_chunk_rtn in rtn_factor_list:
+        for _one_offset_rtn in _one_chunk_rtn:
             rtn_list.append(_one_offset_rtn)
 
     # 将回测结果保存到文件
@@ -578,85 +512,70 @@ def cal_one_hold(data_path, output_path, _hold_hour, factors_name, n_jobs, c_rat
 # =====函数  从已有的种子中随机选择作为初始种子
 
 
-def cal_one_factor(_df, _c_rate, _select_num, _factor, _reverse, _hold_hour, _offset):
-    select_c = fs.gen_select_df(_df=_df, _c_rate=_c_rate, _select_num=_select_num,
-                                _factor=_factor, _reverse=_reverse)
-    # =====计算统计指标
-    rtn = fs.cal_ind(_select_c=select_c)
-    r1 = rtn['累积净值'].values[0]
-    r2 = rtn['最大回撤'].values[0]
-    r2 = abs(float(r2.replace('%', '').strip()) / 100.)
+def __fitness(equity, returns):
+    # =====计算统计指标，直接用数值结果
+    rtn = fs.ind_kernel(equity, returns)
+    r1 = rtn['累积净值']
+    r2 = abs(rtn['最大回撤'])
     _ind = 0.1 * r1 / r2  # 优化指标 0.1 * 累积净值 / abs(最大回撤)
 
     return _ind
 
 
+def cal_one_factor(_df, _c_rate, _select_num, _factor, _reverse, _hold_hour, _offset):
+    selection = SelectionPanel(_df).select(_df[_factor].values, _select_num, _reverse, _c_rate)
+    return __fitness(selection.equity, selection.returns)
+
+
 # =====函数  产生子代  只变异不交叉
 def make_kid(_parent, _dna_range, ppp_csv_path):
-    ppp = pd.read_csv(ppp_csv_path)['ppp'].values[0]
-    print('ppp', ppp)
+    ppp = mutation_rate(ppp_csv_path)  # 文件修改过才重新读
 
     _kid = _parent.copy()
-    for _ in range(len(_parent)):
-        if np.random.rand() < ppp:  # 变异概率
-            _dna_little_range = list(set(_dna_range) - set(list([_parent[_]])))  # 在dna取值范围中 排除当前位的值
-            _kid[_] = np.random.choice(_dna_little_range, 1)[0]
-
+    _kid[:] = mutate(_parent, _dna_range, ppp)
     return _kid
 
 
 def find_factors_ind(_dna, hold_hour, data_path, factors, head_pkl, c_rate, select_coin_num):
-    # ===构造新因子
-    factor = 'new_factor'
-    data_pkl = head_pkl.copy()
-
-    # 读取需要的 主因子列
-    for fct in factors:
-        data_pkl[fct] = pd.read_pickle(
-            f'{data_path}/all_coin_data_hold_hour_{hold_hour}_{fct}.pkl')
-
-    # 读取 dna中的因子列
-    for _ in _dna:
-        data_pkl[_] = pd.read_pickle(
-            f'{data_path}/all_coin_data_hold_hour_{hold_hour}_{_}.pkl')
-
-    data_pkl[factor] =\
-        data_pkl[factors[0]] * (data_pkl[_dna[0]] + data_pkl[_dna[1]]) +\
-        data_pkl[factors[1]] * (data_pkl[_dna[2]] + data_pkl[_dna[3]])
-
-    factor_r = []
-    for _offset in range(int(hold_hour[:-1])):
-        data_offset = data_pkl[data_pkl['offset'] == _offset].copy()
-        # =删除某些行数据
-        data_offset = data_offset[data_offset['volume'] > 0]  # 该周期不交易的币种
-        data_offset.dropna(subset=['下个周期_avg_price'], inplace=True)  # 最后几行数据，下个周期_avg_price为空
-        df = data_offset.copy()
-
-        new_r = cal_one_factor(_df=df, _c_rate=c_rate, _select_num=select_coin_num,
-                               _factor=factor, _reverse=False, _hold_hour='3H', _offset=_offset)
-        factor_r.append(new_r)
-
-    final_r = np.array(factor_r).mean()
-
-    return final_r
+    """单独算一个 DNA 的适应度，直接用因子库的 memmap 列，不复制整张表；循环里用 ea() 的 DnaPanel + FitnessCache
+    新因子为 linear_template: DNA 按主因子个数平分，Σ f_i * (d_i0 + d_i1 + ...)，DNA 长度不限"""
+    store = FactorStore.for_hold(data_path, hold_hour)
+    ga = DnaPanel(store, factors, _dna, __offset_panels(hold_hour, head_pkl), c_rate, select_coin_num, __fitness, preload=False)
+    return ga.fitness(_dna)
 
 
 # =====循环进化
-def ea(_filename, ga_output_path, ppp_csv_path, hold_hour, data_path, factors, head_pkl, c_rate, select_coin_num, dna_range, fixed_seeds, using_fixed_seeds):
+def ea(_filename, ga_output_path, ppp_csv_path, hold_hour, data_path, factors, head_pkl, c_rate, select_coin_num, dna_range, fixed_seeds, using_fixed_seeds,
+       cache_size=1000000, cache_path=None, dna_length=4):
+    """ (1+1) 进化
+    1. 因子库用到的列(factors + dna_range)和每个 offset 的选币面板只在开始时加载一次;
+    2. 适应度按 DNA 的规范形式(每组内排序)缓存，父代沿用上一轮的值，重复出现的子代不重算;
+    :param cache_size: 适应度缓存的个数上限，LRU 淘汰
+    :param cache_path: 适应度缓存落盘的文件，重跑时接着用，None 为不落盘
+    :param dna_length: dna位数，需要是主因子个数的整数倍 """
     opt_value = 0  # 记录 最优值
     opt_record = {}  # 记录 曾经出现的最优个体
     opt_df = pd.DataFrame()
-    dna_length = 4  # dna位数
+
+    s_time = time.time()
+    store = FactorStore.for_hold(data_path, hold_hour)
+    ga = DnaPanel(store, factors, dna_range, __offset_panels(hold_hour, head_pkl), c_rate, select_coin_num, __fitness)
+    context = [hold_hour, list(factors), c_rate, select_coin_num, store.rows]
+    cache = FitnessCache(cache_size, cache_path, context)
+    print(f'GA 数据加载完成，缓存 {len(cache)} 个，花费时间：{round(time.time() - s_time, 1)}s')
+
+    def evaluate(dna):
+        return cache.get(ga.key(dna), lambda: ga.fitness(dna))
 
     parent = fixed_seeds if using_fixed_seeds else np.random.choice(dna_range, dna_length, replace=True)  # 父代
+    ind_parent = evaluate(parent)
 
     # =====循环进化
     for epoch in range(1000000):
         kid = make_kid(parent.copy(), dna_range, ppp_csv_path)  # 产生子代
 
-        # 计算父代和子代的适应度，算出的指标即可作为适应度
-        ind_parent = find_factors_ind(parent, hold_hour, data_path, factors, head_pkl, c_rate, select_coin_num)
-        ind_kid = find_factors_ind(kid, hold_hour, data_path, factors, head_pkl, c_rate, select_coin_num)
+        # 计算子代的适应度，父代的沿用上一轮，算出的指标即可作为适应度
+        ind_kid = evaluate(kid)
 
         # =====记录最优值
         # === 判断父代和子代谁更优秀
@@ -685,10 +604,130 @@ def ea(_filename, ga_output_path, ppp_csv_path, hold_hour, data_path, factors, h
             opt_df.sort_values(by=['ind'], inplace=True)
             opt_df.reset_index(drop=True, inplace=True)
             opt_df.to_csv(f'{ga_output_path}/{_filename}.csv', encoding='utf-8-sig')
+            cache.save()
 
         print('parent:', ind_parent, '    kid:', ind_kid)
-        print(f"epochs {epoch}  历史最优个体 {opt_record['操作值']}")
+        print(f"epochs {epoch}  历史最优个体 {opt_record['操作值']}  缓存命中 {cache.hits} / 计算 {cache.misses}")
         print(opt_record['历史最优个体'], '\n\n\n')
 
         # 确定新的父代
-        parent = kid if ind_kid > ind_parent else parent
+        if ind_kid > ind_parent:
+            parent, ind_parent = kid, ind_kid
+        cache.save(every=1000)
+
+
+# ===== 种群进化: 每代一批个体，没算过的分到进程池并行算适应度
+
+__ga_panel = None
+
+
+def __ga_worker_init(data_path, hold_hour, factors, c_rate, select_coin_num):
+    """子进程初始化，因子库用 memmap 打开，各进程共享系统的页缓存"""
+    global __ga_panel
+    store = FactorStore.for_hold(data_path, hold_hour)
+    panels = __offset_panels(hold_hour, store.header())
+    __ga_panel = DnaPanel(store, factors, [], panels, c_rate, select_coin_num, __fitness, preload=False)
+
+
+def __ga_task(dnas):
+    """一批 DNA，批内共同的子表达式只算一次"""
+    return __ga_panel.fitness_many(dnas)
+
+
+def __ranked_fitness(value):
+    """NaN / inf(空曲线、回撤为 0)记为 -inf，排序、锦标赛、缓存里都排在最后"""
+    return float(value) if np.isfinite(value) else -np.inf
+
+
+def ea_population(_filename, ga_output_path, ppp_csv_path, hold_hour, data_path, factors, c_rate, select_coin_num, dna_range,
+                  population_size=32, generations=10000, tournament_size=3, crossover_rate=0.7, elite_size=2, processes=None,
+                  fixed_seeds=None, cache_size=1000000, cache_path=None, dna_length=4):
+    """ 种群进化: 锦标赛选择 + 均匀交叉 + 变异，保留 elite_size 个最优个体
+    :param population_size: 种群大小
+    :param generations: 代数
+    :param tournament_size: 锦标赛每次比较的个体数
+    :param crossover_rate: 交叉概率，不交叉的直接复制选中的父代再变异
+    :param elite_size: 直接进入下一代的最优个体数
+    :param processes: 进程数，默认所有核，1 为在当前进程算
+    :param fixed_seeds: 放进初始种群的种子 [dna]
+    :param dna_length: dna位数，需要是主因子个数的整数倍
+    :return: (最优个体, 适应度) """
+    processes = processes or os.cpu_count()
+    store = FactorStore.for_hold(data_path, hold_hour)
+    cache = FitnessCache(cache_size, cache_path, [hold_hour, list(factors), c_rate, select_coin_num, store.rows])
+
+    population = [list(x) for x in (fixed_seeds or [])][:population_size]
+    while len(population) < population_size:
+        population.append(list(np.random.choice(dna_range, dna_length, replace=True)))
+
+    pool = None
+    if processes > 1:
+        pool = mp.Pool(processes=processes, initializer=__ga_worker_init, initargs=(data_path, hold_hour, factors, c_rate, select_coin_num))
+    else:
+        __ga_worker_init(data_path, hold_hour, factors, c_rate, select_coin_num)
+
+    opt_value, opt_dna = None, None
+    opt_df = pd.DataFrame()
+    try:
+        for generation in range(generations):
+            s_time = time.time()
+            # 只算缓存里没有的，同一代里重复的只算一次
+            known, todo = dict(), dict()
+            for dna in population:
+                key = dna_key(dna, factors)
+                if key in known or key in todo:
+                    continue
+                if key in cache:
+                    known[key] = __ranked_fitness(cache.get(key, None))
+                else:
+                    todo[key] = dna
+            candidates = list(todo.values())
+            if pool is not None:
+                chunks = [candidates[i::processes] for i in range(processes) if len(candidates[i::processes]) > 0]
+                values = [None] * len(candidates)
+                for i, chunk_values in enumerate(pool.map(__ga_task, chunks)):
+                    values[i::processes] = chunk_values
+            else:
+                values = __ga_task(candidates)
+            for key, value in zip(todo.keys(), values):
+                value = __ranked_fitness(value)
+                cache.put(key, value)
+                known[key] = value
+            scores = [known[dna_key(x, factors)] for x in population]
+
+            # 记录最优个体
+            best = int(np.argmax(scores))
+            if opt_value is None or scores[best] > opt_value:
+                opt_value, opt_dna = scores[best], population[best]
+                print('========== 新的历史值', opt_value)
+                to_save = pd.DataFrame()
+                to_save['w'] = opt_dna
+                to_save = to_save.T
+                to_save.reset_index(drop=True, inplace=True)
+                to_save['ind'] = opt_value
+                opt_df = pd.concat([opt_df, to_save], ignore_index=True)
+                opt_df.sort_values(by=['ind'], inplace=True)
+                opt_df.reset_index(drop=True, inplace=True)
+                opt_df.to_csv(f'{ga_output_path}/{_filename}.csv', encoding='utf-8-sig')
+                cache.save()
+            print(f'generation {generation}  新算 {len(todo)} 个  本代最优 {scores[best]}  历史最优 {opt_value}  '
+                  f'花费时间：{round(time.time() - s_time, 1)}s')
+            print(opt_dna, '\n')
+
+            # 下一代: 精英 + 锦标赛选出的父代交叉、变异
+            ppp = mutation_rate(ppp_csv_path)
+            ranked = sorted(range(len(population)), key=lambda i: scores[i], reverse=True)
+            next_population = [population[i] for i in ranked[:elite_size]]
+            while len(next_population) < population_size:
+                kid = tournament_select(population, scores, tournament_size)
+                if np.random.rand() < crossover_rate:
+                    kid = crossover(kid, tournament_select(population, scores, tournament_size))
+                next_population.append(mutate(kid, dna_range, ppp))
+            population = next_population
+            cache.save(every=1000)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        cache.save()
+    return opt_dna, opt_value
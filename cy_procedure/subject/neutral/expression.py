@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import numpy as np
+
+# 表达式是嵌套的 tuple: ('col', 因子列名) / (运算, 子表达式...)，运算都在 时间 × 币种 矩阵上，横截面运算按行(同一时间)
+
+
+def cross_rank(values):
+    """横截面百分比排名，和 pandas rank(pct=True, method='average') 一样，相同的值取平均名次，NaN 不参与"""
+    values = np.asarray(values, dtype=np.float64)
+    rows, cols = values.shape
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    # 有效值在前按值排序，NaN 排最后，±inf 也是有效值
+    order = np.lexsort((values, ~valid), axis=1)
+    ordered = np.take_along_axis(values, order, axis=1)
+
+    # 每行内相同值为一组，组的开始位置按行拼平，组内名次取 (首 + 尾) / 2
+    flat = ordered.ravel()
+    start = np.ones(flat.size, dtype=bool)
+    start[1:] = flat[1:] != flat[:-1]
+    start[::cols] = True
+    group = np.cumsum(start) - 1
+    first = np.flatnonzero(start)
+    last = np.r_[first[1:], flat.size] - 1
+    position = np.tile(np.arange(cols), rows)
+    average = (position[first] + position[last]) / 2 + 1
+
+    result = np.empty_like(values)
+    np.put_along_axis(result, order, average[group].reshape(rows, cols), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = result / count[:, np.newaxis]
+    result[~valid] = np.nan
+    return result
+
+
+def cross_zscore(values):
+    """横截面标准化 (x - 均值) / 标准差(ddof=1)，不足两个值或标准差为 0 的为 NaN"""
+    values = np.asarray(values, dtype=np.float64)
+    count = (~np.isnan(values)).sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=1, keepdims=True) / count
+        std = np.sqrt(np.nansum((values - mean) ** 2, axis=1, keepdims=True) / (count - 1))
+        result = (values - mean) / std
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+def __accumulate(ufunc):
+    """n 元 加/乘: 复制第一个，其余原地累加，子表达式的结果(可能在缓存里)不会被改"""
+    def func(*args):
+        out = np.array(args[0], dtype=np.float64, copy=True)
+        for x in args[1:]:
+            ufunc(out, x, out=out)
+        return out
+    return func
+
+
+def __divide(a, b):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.divide(a, b)
+    result[np.isinf(result)] = np.nan
+    return result
+
+
+# 运算 -> (函数, 参数个数，None 为不限)
+OPERATORS = {
+    'add': (__accumulate(np.add), None),
+    'mul': (__accumulate(np.multiply), None),
+    'sub': (np.subtract, 2),
+    'div': (__divide, 2),
+    'neg': (np.negative, 1),
+    'abs': (np.abs, 1),
+    'rank': (cross_rank, 1),
+    'zscore': (cross_zscore, 1),
+}
+# 满足交换律、结合律的运算，规范化时展平、排序
+COMMUTATIVE = {'add', 'mul'}
+
+
+def col(name):
+    return 'col', str(name)
+
+
+def parse_gene(gene):
+    """DNA 的一位 -> 表达式，'rank:bias_bh_12' 为 rank(bias_bh_12)，一元运算可以叠加"""
+    gene = str(gene)
+    op, sep, rest = gene.partition(':')
+    if sep and op in OPERATORS and OPERATORS[op][1] == 1:
+        return op, parse_gene(rest)
+    return col(gene)
+
+
+def linear_template(factors, dna):
+    """主因子 × DNA 分组之和: DNA 按主因子个数平分，new_factor = Σ f_i * (d_i0 + d_i1 + ...)
+
+    两个主因子、4 位 DNA 就是原来的 f0 * (d0 + d1) + f1 * (d2 + d3) """
+    if len(dna) == 0 or len(dna) % len(factors) != 0:
+        raise ValueError(f'DNA 长度 {len(dna)} 不是主因子个数 {len(factors)} 的整数倍')
+    size = len(dna) // len(factors)
+    terms = []
+    for i, factor in enumerate(factors):
+        genes = [parse_gene(x) for x in dna[i * size:(i + 1) * size]]
+        terms.append(('mul', col(factor), ('add',) + tuple(genes) if len(genes) > 1 else genes[0]))
+    return ('add',) + tuple(terms) if len(terms) > 1 else terms[0]
+
+
+def canonical(expr):
+    """规范形式: add/mul 展平并排序子表达式，结果相同的表达式规范形式相同，作为缓存的 key"""
+    op = expr[0]
+    if op == 'col':
+        return expr
+    children = [canonical(x) for x in expr[1:]]
+    if op in COMMUTATIVE:
+        flat = []
+        for child in children:
+            flat += list(child[1:]) if child[0] == op else [child]
+        if len(flat) == 1:
+            return flat[0]
+        return (op,) + tuple(sorted(flat, key=repr))
+    return (op,) + tuple(children)
+
+
+def leaves(expr):
+    """表达式用到的因子列"""
+    if expr[0] == 'col':
+        return {expr[1]}
+    return set().union(*[leaves(x) for x in expr[1:]])
+
+
+def to_string(expr):
+    op = expr[0]
+    if op == 'col':
+        return expr[1]
+    return '{}({})'.format(op, ', '.join(to_string(x) for x in expr[1:]))
+
+
+class ExpressionEvaluator:
+    """在 时间 × 币种 矩阵上计算表达式，子表达式的结果按 (scope, 规范形式) 缓存，一批 DNA 共同的部分只算一次
+
+    :param leaf: (因子列名, scope) -> 矩阵，scope 如 offset 的序号
+    :param max_bytes: 子表达式缓存的内存上限，超过按最久没用到的淘汰
+    :param precomputed: (表达式, scope) -> 矩阵或 None，已经预先算好的子表达式(如因子库里的 rank:因子 列)直接用 """
+
+    def __init__(self, leaf, max_bytes=512 * 1024 ** 2, precomputed=None):
+        self.leaf = leaf
+        self.precomputed = precomputed
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+        self.__bytes = 0
+
+    def __put(self, key, value):
+        self.__cache[key] = value
+        self.__bytes += value.nbytes
+        while self.__bytes > self.max_bytes and len(self.__cache) > 0:
+            _, evicted = self.__cache.popitem(last=False)
+            self.__bytes -= evicted.nbytes
+
+    def evaluate(self, expr, scope=None):
+        """expr 需要是规范形式(canonical)，否则相同的子表达式认不出来"""
+        if expr[0] == 'col':
+            return self.leaf(expr[1], scope)
+        if self.precomputed is not None:
+            value = self.precomputed(expr, scope)
+            if value is not None:
+                return value
+        key = (scope, expr)
+        if key in self.__cache:
+            self.hits += 1
+            self.__cache.move_to_end(key)
+            return self.__cache[key]
+        self.misses += 1
+        func, arity = OPERATORS[expr[0]]
+        args = [self.evaluate(x, scope) for x in expr[1:]]
+        if arity is not None and len(args) != arity:
+            raise ValueError(f'{expr[0]} 需要 {arity} 个参数: {to_string(expr)}')
+        value = func(*args)
+        self.__put(key, value)
+        return value
+
+    def clear(self):
+        self.__cache.clear()
+        self.__bytes = 0
@@ -0,0 +1,397 @@
+import re
+import numpy as np
+import pandas as pd
+import talib as ta
+from .rolling_cache import RollingCache
+from .frac_diff import frac_diff_block
+
+# 因子列名: {因子}_bh_{回溯周期}，差分列再加 _diff_{阶数}
+__COLUMN_PATTERN = re.compile(r'^(?P<prefix>.+)_bh_(?P<n>\d+)(?:_diff_(?P<d>.+))?$')
+
+
+class FactorDef:
+    """一个因子的声明
+
+    :param prefix: 列名前缀，如 K，列为 K_bh_{n}
+    :param func: (ctx, n) -> Series，n 为回溯周期
+    :param family: 所属的一组因子，如 K/D/J 都属于 KDJ，用于排列顺序和耗时统计
+    :param requires: 同一回溯周期下依赖的其他因子前缀，如 D 依赖 K
+    :param inputs: 用到的原始数据列，只做说明
+    :param diff: 是否添加差分列
+    :param agg: resample 时的聚合方式 """
+
+    def __init__(self, prefix, func, family=None, requires=(), inputs=(), diff=True, agg='first'):
+        self.prefix = prefix
+        self.func = func
+        self.family = family or prefix
+        self.requires = tuple(requires)
+        self.inputs = tuple(inputs)
+        self.diff = diff
+        self.agg = agg
+
+
+# 前缀 -> FactorDef，按声明顺序
+FACTOR_REGISTRY = dict()
+# 中间数据名 -> (ctx) -> Series，多个因子共用，用到才算
+INTERMEDIATES = dict()
+
+
+def factor(prefix, family=None, requires=(), inputs=(), diff=True, agg='first'):
+    """声明因子的装饰器"""
+    def wrapper(func):
+        FACTOR_REGISTRY[prefix] = FactorDef(prefix, func, family, requires, inputs, diff, agg)
+        return func
+    return wrapper
+
+
+def intermediate(name):
+    """声明中间数据的装饰器"""
+    def wrapper(func):
+        INTERMEDIATES[name] = func
+        return func
+    return wrapper
+
+
+def factor_column(prefix, n, d=None):
+    return f'{prefix}_bh_{n}' if d is None else f'{prefix}_bh_{n}_diff_{d}'
+
+
+class FactorContext:
+    """一个币种的计算上下文: 原始数据、rolling 缓存、已算的中间数据和因子"""
+
+    def __init__(self, df: pd.DataFrame, back_hours):
+        self.df = df
+        self.back_hours = list(back_hours)
+        self.rc = RollingCache(self.column)
+        self.__intermediates = dict()
+        self.__values = dict()
+
+    def column(self, name):
+        """原始数据列或中间数据"""
+        if name in self.df.columns:
+            return self.df[name]
+        if name not in self.__intermediates:
+            self.__intermediates[name] = INTERMEDIATES[name](self)
+        return self.__intermediates[name]
+
+    def memo(self, key, func):
+        """因子内部的中间结果，如 振幅2 的链式 rolling"""
+        if key not in self.__intermediates:
+            self.__intermediates[key] = func()
+        return self.__intermediates[key]
+
+    def value(self, prefix, n):
+        """已经算好的因子，依赖的因子在调用前已按 DAG 顺序算完"""
+        key = (prefix, n)
+        if key not in self.__values:
+            self.__values[key] = FACTOR_REGISTRY[prefix].func(self, n)
+        return self.__values[key]
+
+    def previous_window(self, n):
+        """回溯周期列表中 n 的前一个，第一个返回 None"""
+        if n not in self.back_hours:
+            raise ValueError(f'回溯周期 {n} 不在 {self.back_hours} 中')
+        i = self.back_hours.index(n)
+        return self.back_hours[i - 1] if i > 0 else None
+
+    def series(self, values):
+        """talib 的结果统一成和 df 对齐的 Series"""
+        return pd.Series(np.asarray(values, dtype=np.float64), index=self.df.index)
+
+
+def all_factor_columns(back_hours, diff_d, prefixes=None):
+    """全部因子列名，按 组 -> 回溯周期 -> 组内因子 -> 差分 的顺序"""
+    prefixes = prefixes if prefixes is not None else list(FACTOR_REGISTRY)
+    families = dict()
+    for prefix in prefixes:
+        families.setdefault(FACTOR_REGISTRY[prefix].family, []).append(prefix)
+    columns = []
+    for members in families.values():
+        for n in back_hours:
+            columns += [factor_column(prefix, n) for prefix in members]
+            for prefix in members:
+                if FACTOR_REGISTRY[prefix].diff:
+                    columns += [factor_column(prefix, n, d) for d in diff_d]
+    return columns
+
+
+def parse_factor_column(name, diff_d):
+    """列名 -> (前缀, 回溯周期, 差分阶数或 None)，不是注册的因子列抛 KeyError"""
+    match = __COLUMN_PATTERN.match(name)
+    if match is None or match.group('prefix') not in FACTOR_REGISTRY:
+        raise KeyError(f'{name} 不是注册的因子列')
+    d = match.group('d')
+    if d is not None:
+        d = next((x for x in diff_d if f'{x}' == d), None)
+        if d is None or not FACTOR_REGISTRY[match.group('prefix')].diff:
+            raise KeyError(f'{name} 的差分阶数不在 {diff_d} 中')
+    return match.group('prefix'), int(match.group('n')), d
+
+
+class FactorEvaluator:
+    """按需计算因子: 把要的列展开成 DAG(差分 -> 因子 -> 依赖的因子)，按依赖顺序只算用到的
+
+    :param df: 一个币种的 1h 数据，需要已有 涨跌幅 列
+    :param back_hours: 回溯周期列表，振幅2 按这个顺序链式 rolling
+    :param diff_d: 差分阶数列表 """
+
+    def __init__(self, df: pd.DataFrame, back_hours, diff_d):
+        self.df = df
+        self.back_hours = list(back_hours)
+        self.diff_d = list(diff_d)
+        self.ctx = FactorContext(df, back_hours)
+
+    def __resolve(self, columns):
+        """-> 按依赖排好序的节点 [(前缀, n, d)]，d 为 None 是因子本身"""
+        ordered = []
+        visited = set()
+
+        def visit(node):
+            if node in visited:
+                return
+            visited.add(node)
+            prefix, n, d = node
+            if d is not None:
+                visit((prefix, n, None))
+            else:
+                for required in FACTOR_REGISTRY[prefix].requires:
+                    visit((required, n, None))
+            ordered.append(node)
+
+        for name in columns:
+            visit(parse_factor_column(name, self.diff_d))
+        return ordered
+
+    def __diff_values(self, values, diff_nodes):
+        """-> {(前缀, n, d): 差分值}"""
+        if len(self.df) < 12:  # 数据行数大于等于12才进行差分操作，不足12的填充为空数据
+            return {node: np.nan for node in diff_nodes}
+        bases = list(dict.fromkeys((prefix, n) for prefix, n, _ in diff_nodes))
+        d_list = [d for d in self.diff_d if any(node[2] == d for node in diff_nodes)]
+        block = np.empty((len(bases), len(self.df)))
+        for i, (prefix, n) in enumerate(bases):
+            block[i] = values[(prefix, n, None)]
+        out = frac_diff_block(block, d_list)
+        base_index = {base: i for i, base in enumerate(bases)}
+        return {(prefix, n, d): out[base_index[(prefix, n)], :, d_list.index(d)] for prefix, n, d in diff_nodes}
+
+    def evaluate(self, columns=None):
+        """计算因子列，一次拼成 DataFrame，不逐列插入 df
+
+        :param columns: 要的因子列名，默认全部注册的因子
+        :return: (因子 DataFrame，index 和 df 一致, 列名 -> resample 聚合方式)，列的顺序和 columns 一致 """
+        columns = all_factor_columns(self.back_hours, self.diff_d) if columns is None else list(columns)
+        values = dict()
+        rc = self.ctx.rc
+        diff_nodes = []
+        for prefix, n, d in self.__resolve(columns):
+            if d is not None:
+                diff_nodes.append((prefix, n, d))
+                continue
+            with rc.family(FACTOR_REGISTRY[prefix].family):
+                values[(prefix, n, d)] = self.ctx.value(prefix, n)
+
+        # 差分放到最后，所有要差分的列拼成一块一起算
+        if len(diff_nodes) > 0:
+            with rc.family('差分'):
+                values.update(self.__diff_values(values, diff_nodes))
+
+        data = dict()
+        agg_dict = dict()
+        for name in columns:
+            prefix, n, d = parse_factor_column(name, self.diff_d)
+            data[name] = values[(prefix, n, d)]
+            agg_dict[name] = FACTOR_REGISTRY[prefix].agg
+        return pd.DataFrame(data, index=self.df.index), agg_dict
+
+    def report(self):
+        return self.ctx.rc.report()
+
+
+# ======== 中间数据 ========
+
+@intermediate('up')
+def __up(ctx):
+    close_dif = ctx.df['close'].diff()
+    return pd.Series(np.where(close_dif > 0, close_dif, 0), index=ctx.df.index)
+
+
+@intermediate('down')
+def __down(ctx):
+    close_dif = ctx.df['close'].diff()
+    return pd.Series(np.where(close_dif < 0, abs(close_dif), 0), index=ctx.df.index)
+
+
+@intermediate('癞子_diff')
+def __close_change(ctx):
+    return ctx.df['close'] / ctx.df['close'].shift(1) - 1
+
+
+# ======== 技术指标 ========
+
+# --- KDJ ---
+# 使用差分后的K线数据 计算 KDJ  --- 标准差变大，数据更不稳定，放弃
+# 用计算后的KDJ指标，再差分  --- 标准差变小，数据更稳定，采纳
+@factor('K', family='KDJ', inputs=('low', 'high', 'close'))
+def __k(ctx, n):
+    low_list = ctx.rc.get('low', n, 'min', 1)  # 过去n(含当前行)行数据 最低价的最小值
+    high_list = ctx.rc.get('high', n, 'max', 1)  # 过去n(含当前行)行数据 最高价的最大值
+    rsv = (ctx.df['close'] - low_list) / (high_list - low_list) * 100  # 未成熟随机指标值
+    return rsv.ewm(com=2).mean().shift(1)
+
+
+@factor('D', family='KDJ', requires=('K',))
+def __d(ctx, n):
+    return ctx.value('K', n).ewm(com=2).mean()
+
+
+@factor('J', family='KDJ', requires=('K', 'D'))
+def __j(ctx, n):
+    return 3 * ctx.value('K', n) - 2 * ctx.value('D', n)
+
+
+# --- RSI ---  在期货市场很有效
+@factor('RSI', inputs=('close',))
+def __rsi(ctx, n):
+    a = ctx.rc.get('up', n, 'sum')
+    b = ctx.rc.get('down', n, 'sum')
+    return (a / (a + b)).shift(1)
+
+
+# ======== 常见变量 ========
+
+# --- 均价 ---  对应低价股策略(预计没什么用)
+# 策略改进思路：以下所有用到收盘价的因子，都可尝试使用均价代替
+@factor('均价', inputs=('quote_volume', 'volume'))
+def __avg_price(ctx, n):
+    return (ctx.rc.get('quote_volume', n, 'sum') / ctx.rc.get('volume', n, 'sum')).shift(1)
+
+
+# --- 涨跌幅 ---
+@factor('涨跌幅', inputs=('close',))
+def __change(ctx, n):
+    return ctx.df['close'].pct_change(n).shift(1)
+
+
+# --- bias ---  涨跌幅更好的表达方式 bias 币价偏离均线的比例。
+@factor('bias', inputs=('close',))
+def __bias(ctx, n):
+    ma = ctx.rc.get('close', n, 'mean', 1)
+    return (ctx.df['close'] / ma - 1).shift(1)
+
+
+# --- 振幅 ---  最高价最低价
+@factor('振幅', inputs=('high', 'low'))
+def __amplitude(ctx, n):
+    high = ctx.rc.get('high', n, 'max', 1)
+    low = ctx.rc.get('low', n, 'min', 1)
+    return (high / low - 1).shift(1)
+
+
+def __oc_range(ctx, n):
+    """振幅2 的高低价: 在前一个回溯周期的结果上再 rolling(链式)，和原来按回溯周期顺序循环的结果一致"""
+    def compute():
+        previous = ctx.previous_window(n)
+        if previous is None:
+            high = ctx.df[['close', 'open']].max(axis=1)
+            low = ctx.df[['close', 'open']].min(axis=1)
+        else:
+            high, low = __oc_range(ctx, previous)
+        return high.rolling(n, min_periods=1).max(), low.rolling(n, min_periods=1).min()
+    return ctx.memo(('振幅2', n), compute)
+
+
+# --- 振幅2 ---  收盘价、开盘价
+@factor('振幅2', inputs=('close', 'open'))
+def __amplitude2(ctx, n):
+    high, low = __oc_range(ctx, n)
+    return (high / low - 1).shift(1)
+
+
+# --- 涨跌幅std ---  振幅的另外一种形式
+# close.pct_change() 就是 涨跌幅 列
+@factor('涨跌幅std', inputs=('涨跌幅',))
+def __change_std(ctx, n):
+    return ctx.rc.get('涨跌幅', n, 'std').shift(1)
+
+
+# --- 涨跌幅skew ---  在商品期货市场有效
+# skew偏度rolling最小周期为3才有数据
+@factor('涨跌幅skew', inputs=('涨跌幅',))
+def __change_skew(ctx, n):
+    return ctx.rc.get('涨跌幅', n, 'skew').shift(1)
+
+
+# --- 成交额 ---  对应小市值概念
+@factor('成交额', inputs=('quote_volume',))
+def __quote_volume(ctx, n):
+    return ctx.rc.get('quote_volume', n, 'sum', 1).shift(1)
+
+
+# --- 成交额std ---  191选股因子中最有效的因子
+@factor('成交额std', inputs=('quote_volume',))
+def __quote_volume_std(ctx, n):
+    return ctx.rc.get('quote_volume', n, 'std', 2).shift(1)
+
+
+# --- 资金流入比例 --- 币安独有的数据
+@factor('资金流入比例', inputs=('quote_volume', 'taker_buy_quote_asset_volume'))
+def __taker_buy_ratio(ctx, n):
+    volume = ctx.rc.get('quote_volume', n, 'sum', 1)
+    buy_volume = ctx.rc.get('taker_buy_quote_asset_volume', n, 'sum', 1)
+    return (buy_volume / volume).shift(1)
+
+
+# --- 量比 ---
+@factor('量比', inputs=('quote_volume',))
+def __volume_ratio(ctx, n):
+    return (ctx.df['quote_volume'] / ctx.rc.get('quote_volume', n, 'mean', 1)).shift(1)
+
+
+# --- 成交笔数 ---
+@factor('成交笔数', inputs=('trade_num',))
+def __trade_num(ctx, n):
+    return ctx.rc.get('trade_num', n, 'sum', 1).shift(1)
+
+
+# --- 量价相关系数 ---  量价相关选股策略
+@factor('量价相关系数', inputs=('close', 'quote_volume'))
+def __price_volume_corr(ctx, n):
+    return ctx.df['close'].rolling(n).corr(ctx.df['quote_volume']).shift(1)
+
+
+# --- Angle ---
+@factor('Angle', inputs=('close',))
+def __angle(ctx, n):
+    ma = ctx.rc.get('close', n, 'mean', 1)
+    return ctx.series(ta.LINEARREG_ANGLE(ma, n)).shift(1)
+
+
+# ---- GapTrue ----
+@factor('GapTrue', inputs=('close',))
+def __gap_true(ctx, n):
+    ma = ctx.rc.get('close', n, 'mean', 1)
+    wma = ctx.series(ta.WMA(ctx.df['close'], n))
+    gap = wma - ma
+    return (gap / abs(gap).rolling(window=n).sum()).shift(1)
+
+
+# ---- 癞子 ----
+@factor('癞子', inputs=('close',))
+def __laizi(ctx, n):
+    diff = ctx.column('癞子_diff')
+    return (diff / abs(diff).rolling(window=n).sum()).shift(1)
+
+
+# ---- CCI ----
+@factor('CCI', inputs=('open', 'high', 'low', 'close'))
+def __cci(ctx, n):
+    df = ctx.df
+    oma = ctx.series(ta.WMA(df.open, n))
+    hma = ctx.series(ta.WMA(df.high, n))
+    lma = ctx.series(ta.WMA(df.low, n))
+    cma = ctx.series(ta.WMA(df.close, n))
+    tp = (hma + lma + cma + oma) / 4
+    ma = ctx.series(ta.WMA(tp, n))
+    md = ctx.series(ta.WMA(abs(cma - ma), n))
+    return ((tp - ma) / md).shift(1)
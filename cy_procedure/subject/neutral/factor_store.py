@@ -0,0 +1,340 @@
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+from .expression import cross_rank, cross_zscore
+
+# 头文件列，选币和统计需要的基础数据
+HEADER_COLUMNS = ['candle_begin_time', 'symbol', 'offset', 'volume', 'avg_price', '下个周期_avg_price']
+# 头文件列固定的类型，symbol 存编码
+HEADER_DTYPES = {
+    'candle_begin_time': np.int64,
+    'symbol': np.int32,
+    'offset': np.int8,
+    'volume': np.float64,
+    'avg_price': np.float64,
+    '下个周期_avg_price': np.float64,
+}
+
+
+def compact_float(values, tolerance=1e-6):
+    """float64 在 float32 能表示的范围内、相对误差不超过 tolerance 时转为 float32，否则原样返回"""
+    values = np.asarray(values)
+    if values.dtype != np.float64:
+        return values
+    with np.errstate(over='ignore'):
+        compact = values.astype(np.float32)
+    finite = np.isfinite(values)
+    # 溢出成 inf 的不行
+    if not np.array_equal(finite, np.isfinite(compact)):
+        return values
+    x = values[finite]
+    y = compact[finite].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error = np.abs(y - x) / np.abs(x)
+    # x 为 0 时 y 也是 0，error 为 nan；下溢成 0 的 error 为 1
+    error = error[x != 0]
+    if error.size > 0 and error.max() > tolerance:
+        return values
+    return compact
+
+
+# 预先算好的横截面变换，列名为 '{变换}:{因子}'，和 DNA 里 'rank:bias_bh_12' 的写法一致
+CROSS_SECTION_TRANSFORMS = {
+    'rank': cross_rank,
+    'zscore': cross_zscore,
+}
+
+
+def cross_section_name(transform, name):
+    return f'{transform}:{name}'
+
+
+class FactorStore:
+    """按列存储的因子库，一个持币周期一个目录
+
+    1. 每一列一个连续的二进制文件，读的时候用 np.memmap 打开，多个进程共享系统的页缓存，不用每个进程反序列化一份;
+    2. 头文件列(HEADER_COLUMNS)和因子列行对齐，candle_begin_time 存 int64 的 UTC ns，symbol 存编码，offset 存 int8;
+    3. meta.json 记录行数、列名 -> 文件名/类型 和 symbol 编码表。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__meta = None
+        self.__columns = dict()
+
+    @classmethod
+    def for_hold(cls, data_path, hold_hour):
+        """data_path 下某个持币周期的库"""
+        return cls(os.path.join(data_path, f'factor_store_{hold_hour}'))
+
+    # Meta
+
+    @property
+    def meta(self):
+        if self.__meta is None:
+            meta_path = os.path.join(self.path, 'meta.json')
+            if os.path.exists(meta_path):
+                with open(meta_path, encoding='utf-8') as f:
+                    self.__meta = json.load(f)
+            else:
+                self.__meta = {'rows': None, 'files': {}, 'dtypes': {}, 'symbols': []}
+        return self.__meta
+
+    def save_meta(self):
+        """写 meta.json，批量 write_column(save_meta=False) 后调用"""
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, 'meta.json'))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'meta.json'))
+
+    def reset(self):
+        """清空"""
+        if os.path.exists(self.path):
+            for file_name in os.listdir(self.path):
+                if file_name.endswith('.bin') or file_name.startswith('meta.json'):
+                    os.remove(os.path.join(self.path, file_name))
+        self.__meta = None
+        self.__columns = dict()
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    @property
+    def symbols(self):
+        return self.meta['symbols']
+
+    @property
+    def factor_names(self):
+        return [x for x in self.meta['files'] if x not in HEADER_COLUMNS]
+
+    def has_column(self, name):
+        return name in self.meta['files']
+
+    def file_path(self, name):
+        return os.path.join(self.path, self.meta['files'][name])
+
+    # Read
+
+    def column(self, name):
+        """只读的 memmap，进程内缓存"""
+        if name not in self.__columns:
+            if name not in self.meta['files']:
+                raise KeyError(f'{name} 不在因子库 {self.path} 中')
+            dtype = np.dtype(self.meta['dtypes'][name])
+            if self.rows == 0:
+                self.__columns[name] = np.empty(0, dtype=dtype)
+            else:
+                self.__columns[name] = np.memmap(self.file_path(name), dtype=dtype, mode='r', shape=(self.rows,))
+        return self.__columns[name]
+
+    def header(self):
+        """头文件列组成的 DataFrame，数值列不复制"""
+        data = {
+            'candle_begin_time': pd.DatetimeIndex(self.column('candle_begin_time').view('datetime64[ns]')).tz_localize('UTC'),
+            'symbol': pd.Categorical.from_codes(self.column('symbol'), categories=self.symbols),
+        }
+        for name in HEADER_COLUMNS[2:]:
+            data[name] = self.column(name)
+        return pd.DataFrame(data, copy=False)
+
+    def frame(self, factor_names):
+        """头文件列 + 指定的因子列"""
+        df = self.header()
+        for name in factor_names:
+            df[name] = self.column(name)
+        return df
+
+    # Write
+
+    def new_file_name(self, name):
+        """列名 -> 文件名，只用序号和安全字符，列名可以是中文、带小数点"""
+        if name in self.meta['files']:
+            return self.meta['files'][name]
+        safe_name = re.sub(r'[^0-9A-Za-z_.-]', '_', name)
+        return '{:04d}_{}.bin'.format(len(self.meta['files']), safe_name)
+
+    def write_column(self, name, values, save_meta=True):
+        """写一整列，已有的覆盖"""
+        values = np.ascontiguousarray(values)
+        if self.rows is None:
+            self.meta['rows'] = len(values)
+        assert len(values) == self.rows, f'{name} 行数 {len(values)} 和因子库 {self.rows} 不一致'
+        os.makedirs(self.path, exist_ok=True)
+        file_name = self.new_file_name(name)
+        tmp_path = os.path.join(self.path, file_name + '.tmp')
+        values.tofile(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+        self.__columns.pop(name, None)
+        self.meta['files'][name] = file_name
+        self.meta['dtypes'][name] = values.dtype.str
+        if save_meta:
+            self.save_meta()
+
+    def write_frame(self, df: pd.DataFrame, downcast=True):
+        """整张表写入，会清空已有的数据"""
+        with FactorStoreWriter(self, downcast=downcast) as writer:
+            writer.append(df)
+
+
+class FactorStoreWriter:
+    """Phase 2 的结果按币种追加写入因子库，不用先在内存里合并所有币种
+
+    1. 每次 append 一个币种的 DataFrame，每列追加到各自文件末尾，写完更新 meta，中途停掉已写的也能读;
+    2. 因子列能无损(相对误差 tolerance 内)放进 float32 的存 float32，后面出现放不下的再整列升回 float64;
+    3. symbol 存编码，offset 存 int8;
+    4. 非数值的列(如 周期开始时间)不存，前面的币种没有的列补 NaN。
+    """
+
+    def __init__(self, store: FactorStore, downcast=True, tolerance=1e-6):
+        self.store = store
+        self.downcast = downcast
+        self.tolerance = tolerance
+        store.reset()
+        store.meta['rows'] = 0
+        self.__symbol_codes = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __append_file(self, name, values):
+        with open(os.path.join(self.store.path, self.store.meta['files'][name]), 'ab') as f:
+            np.ascontiguousarray(values).tofile(f)
+
+    def __promote(self, name, dtype):
+        """已写的整列转成更宽的类型"""
+        meta = self.store.meta
+        path = self.store.file_path(name)
+        old = np.fromfile(path, dtype=np.dtype(meta['dtypes'][name]))
+        tmp_path = path + '.tmp'
+        old.astype(dtype).tofile(tmp_path)
+        os.replace(tmp_path, path)
+        meta['dtypes'][name] = np.dtype(dtype).str
+
+    def __add_column(self, name, dtype, rows):
+        """新列，前面已有的 rows 行补 NaN"""
+        meta = self.store.meta
+        meta['files'][name] = self.store.new_file_name(name)
+        meta['dtypes'][name] = np.dtype(dtype).str
+        open(self.store.file_path(name), 'wb').close()
+        if rows > 0:
+            self.__append_file(name, np.full(rows, np.nan, dtype=dtype))
+
+    def __factor_values(self, values):
+        """因子列的类型: bool/整数转 float，float64 尽量转 float32"""
+        values = np.asarray(values)
+        if values.dtype != np.float64 and values.dtype != np.float32:
+            values = values.astype(np.float64)
+        if self.downcast and values.dtype == np.float64:
+            values = compact_float(values, self.tolerance)
+        return values
+
+    def __header_values(self, df, name):
+        if name == 'candle_begin_time':
+            return pd.to_datetime(df[name], utc=True).values.astype('datetime64[ns]').view(np.int64)
+        if name == 'symbol':
+            # 只对去重后的币种查编号，每行只做一次数组取值
+            local_codes, uniques = pd.factorize(df[name].astype(str).values)
+            mapping = np.empty(len(uniques), dtype=np.int32)
+            for i, symbol in enumerate(uniques):
+                code = self.__symbol_codes.get(symbol)
+                if code is None:
+                    code = self.__symbol_codes[symbol] = len(self.store.meta['symbols'])
+                    self.store.meta['symbols'].append(symbol)
+                mapping[i] = code
+            return mapping[local_codes]
+        return df[name].values.astype(HEADER_DTYPES[name])
+
+    def append(self, df: pd.DataFrame):
+        """追加一个币种(或一批行)"""
+        meta = self.store.meta
+        rows = meta['rows']
+        os.makedirs(self.store.path, exist_ok=True)
+
+        # 头文件列
+        for name in HEADER_COLUMNS:
+            if name not in meta['files']:
+                self.__add_column(name, HEADER_DTYPES[name], 0)
+            self.__append_file(name, self.__header_values(df, name))
+
+        # 因子列，只要数值列
+        written = set(HEADER_COLUMNS)
+        for name in df.columns:
+            if name in written or not (pd.api.types.is_numeric_dtype(df[name]) or pd.api.types.is_bool_dtype(df[name])):
+                continue
+            values = self.__factor_values(df[name].values)
+            if name not in meta['files']:
+                self.__add_column(name, values.dtype, rows)
+            current = np.dtype(meta['dtypes'][name])
+            if current != values.dtype:
+                if current == np.float32:
+                    self.__promote(name, np.float64)
+                else:
+                    values = values.astype(current)
+            self.__append_file(name, values)
+            written.add(name)
+
+        # 这次没有的列补 NaN
+        for name in list(meta['files']):
+            if name not in written:
+                self.__append_file(name, np.full(len(df), np.nan, dtype=np.dtype(meta['dtypes'][name])))
+
+        meta['rows'] = rows + len(df)
+        self.store.save_meta()
+
+    def close(self):
+        self.store.save_meta()
+
+
+def import_pickles(data_path, hold_hour, store: FactorStore = None, downcast=True):
+    """把 all_coin_data_hold_hour_{h}_{factor}.pkl 转成因子库，_0.pkl 为头文件"""
+    store = store if store is not None else FactorStore.for_hold(data_path, hold_hour)
+    prefix = f'all_coin_data_hold_hour_{hold_hour}_'
+    head = pd.read_pickle(os.path.join(data_path, f'{prefix}0.pkl'))
+    with FactorStoreWriter(store, downcast=downcast) as writer:
+        writer.append(head[HEADER_COLUMNS])
+    del head
+    for file_name in sorted(os.listdir(data_path)):
+        if not file_name.startswith(prefix) or not file_name.endswith('.pkl') or file_name == f'{prefix}0.pkl':
+            continue
+        name = file_name[len(prefix):-len('.pkl')]
+        values = pd.read_pickle(os.path.join(data_path, file_name)).values
+        store.write_column(name, compact_float(values) if downcast else values, save_meta=False)
+    store.save_meta()
+    return store
+
+
+def precompute_cross_section(store: FactorStore, names=None, transforms=('rank', 'zscore'), downcast=True):
+    """为因子列预先算好每个时间的横截面 rank / zscore，写成 '{变换}:{因子}' 列
+
+    1. 按 (时间, 币种) 把一列散到 时间 × 币种 矩阵，每个时间一行，排序/统计按行一次算完，再取回原来的行顺序;
+    2. 只在可交易的行(volume > 0 且 下个周期_avg_price 不为空)上算，和选币时的横截面一致，其他行为 NaN;
+    3. 时间决定了 offset，同一时间的行都属于同一个 offset。
+
+    :param names: 要变换的因子列，默认所有还不是变换结果的因子列
+    :param transforms: CROSS_SECTION_TRANSFORMS 中的变换 """
+    names = names if names is not None else [x for x in store.factor_names if ':' not in x]
+    time_codes, times = pd.factorize(store.column('candle_begin_time'), sort=True)
+    symbol_codes = np.asarray(store.column('symbol'))
+    mask = (np.asarray(store.column('volume')) > 0) & ~np.isnan(store.column('下个周期_avg_price'))
+    rows, cols = time_codes[mask], symbol_codes[mask]
+    shape = (len(times), len(store.symbols))
+
+    for name in names:
+        matrix = np.full(shape, np.nan)
+        matrix[rows, cols] = store.column(name)[mask]
+        for transform in transforms:
+            values = np.full(store.rows, np.nan)
+            values[mask] = CROSS_SECTION_TRANSFORMS[transform](matrix)[rows, cols]
+            store.write_column(cross_section_name(transform, name), compact_float(values) if downcast else values, save_meta=False)
+    store.save_meta()
+    return store
@@ -0,0 +1,41 @@
+from functools import lru_cache
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+@lru_cache(maxsize=None)
+def frac_diff_weights(d, window=10):
+    """分数阶差分的二项式权重 w0 = 1, wk = w(k-1) * (k - 1 - d) / k，和 fracdiff.fdiff 的系数一致"""
+    weights = np.empty(window)
+    weights[0] = 1
+    for k in range(1, window):
+        weights[k] = weights[k - 1] * (k - 1 - d) / k
+    weights.flags.writeable = False
+    return weights
+
+
+def frac_diff_block(block, d_list, window=10, out=None):
+    """一批因子列一起做分数阶差分，不使用未来数据
+
+    1. 每个 d 的权重只算一次，拼成 window × len(d_list) 的矩阵;
+    2. 用 sliding_window_view 得到 因子列 × 时间 × window 的窗口视图(不复制)，和权重矩阵一次 matmul，所有列、所有 d 一起算，结果直接写进预分配的 out;
+    3. 和 fdiff(mode='valid') 一样只有完整窗口才有值，前面 window - 1 行为 0，nan 替换为 0，±inf 替换为最大的有限值。
+
+    :param block: 因子列 × 时间 的 float64 数组，每列连续
+    :param d_list: 差分阶数 [0.3, 0.5]
+    :param out: 可选，因子列 × 时间 × len(d_list) 的 float64 数组
+    :return: out """
+    block = np.ascontiguousarray(block, dtype=np.float64)
+    columns, rows = block.shape
+    if out is None:
+        out = np.empty((columns, rows, len(d_list)))
+    out[:, :window - 1] = 0
+    if rows < window:
+        out[:] = 0
+        return out
+    # valid 卷积: out[t] = sum(w[k] * x[t - k])，窗口里时间是正序的，权重要倒过来
+    weights = np.stack([frac_diff_weights(d, window)[::-1] for d in d_list], axis=1)
+    with np.errstate(invalid='ignore'):  # 有 inf 的窗口为 ±inf 或 nan，后面和原来的 nan_to_num 一样处理
+        np.matmul(sliding_window_view(block, window, axis=1), weights, out=out[:, window - 1:])
+    np.nan_to_num(out, copy=False, nan=0)
+    return out
@@ -0,0 +1,194 @@
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from .expression import ExpressionEvaluator, canonical, linear_template, parse_gene
+from .factor_store import CROSS_SECTION_TRANSFORMS, cross_section_name
+
+
+def dna_key(dna, factors, template=linear_template):
+    """DNA 的规范形式: 模板展开后的表达式规范化，如 f0 * (d0 + d1) 中 d0、d1 对调结果一样，key 也一样"""
+    return canonical(template(factors, list(dna)))
+
+
+class FitnessCache:
+    """DNA -> 适应度 的 LRU 缓存，可选落盘，重跑时接着用
+
+    :param maxsize: 最多缓存多少个，超过按最久没用到的淘汰
+    :param path: 落盘的文件，None 为只在内存
+    :param context: 计算适应度的参数(持币周期、因子、手续费、选币数...)，和文件里记录的不一致时不加载 """
+
+    def __init__(self, maxsize=1000000, path=None, context=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.context = context
+        self.hits = 0
+        self.misses = 0
+        self.__values = OrderedDict()
+        self.__unsaved = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.__values)
+
+    def get(self, key, compute):
+        """有缓存直接返回，没有调用 compute() 计算并缓存"""
+        if key in self.__values:
+            self.hits += 1
+            self.__values.move_to_end(key)
+            return self.__values[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.__values[key] = value
+        self.__values.move_to_end(key)
+        while len(self.__values) > self.maxsize:
+            self.__values.popitem(last=False)
+        self.__unsaved += 1
+
+    def __contains__(self, key):
+        return key in self.__values
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved.get('context') != self.context:
+            print(f'{self.path} 的参数和本次不一致，不加载')
+            return
+        for key, value in saved['values']:
+            self.put(key, value)
+        self.__unsaved = 0
+
+    def save(self, every=1):
+        """落盘，未保存的新值少于 every 个时跳过"""
+        if self.path is None or self.__unsaved < every:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'context': self.context, 'values': list(self.__values.items())}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.__unsaved = 0
+
+
+class DnaPanel:
+    """GA 用的数据，只加载一次，每个 DNA 只做 构造新因子 + 选币
+
+    新因子由 template(factors, dna) 得到的表达式在 时间 × 币种 矩阵上计算，不生成中间的 DataFrame 列，
+    一批 DNA 共同的子表达式(如同一个 f0 * (d0 + d1))只算一次。
+
+    :param store: 因子库
+    :param factors: 主因子 [f0, f1, ...]
+    :param dna_range: DNA 每一位的取值范围(因子列名，可以带一元运算，如 'rank:bias_bh_12')
+    :param offset_panels: [(offset, 行号, SelectionPanel)]
+    :param fitness: (equity, returns) -> 适应度
+    :param preload: True 把用到的列按 offset 整理成 时间 × 币种 矩阵放进内存，单进程跑得最快;
+        False 每次从 memmap 取，多个进程共享系统的页缓存
+    :param template: (factors, dna) -> 表达式，默认 linear_template
+    :param cache_bytes: 子表达式缓存的内存上限 """
+
+    def __init__(self, store, factors, dna_range, offset_panels, c_rate, select_coin_num, fitness, preload=True,
+                 template=linear_template, cache_bytes=512 * 1024 ** 2):
+        self.store = store
+        self.factors = list(factors)
+        self.offset_panels = offset_panels
+        self.c_rate = c_rate
+        self.select_coin_num = select_coin_num
+        self.fitness_func = fitness
+        self.preload = preload
+        self.template = template
+        self.evaluator = ExpressionEvaluator(self.matrix, cache_bytes, self.__precomputed)
+        self.__matrices = dict()
+        if preload:
+            names = set(self.factors).union(*[self.__columns(parse_gene(x)) for x in dna_range])
+            for name in sorted(names):
+                values = store.column(name)
+                self.__matrices[name] = [panel.matrix(values[rows]) for _, rows, panel in offset_panels]
+
+    def __precomputed_name(self, expr):
+        """rank(因子) / zscore(因子) 在因子库里有预先算好的列时，返回列名"""
+        if expr[0] in CROSS_SECTION_TRANSFORMS and len(expr) == 2 and expr[1][0] == 'col':
+            name = cross_section_name(expr[0], expr[1][1])
+            if self.store.has_column(name):
+                return name
+        return None
+
+    def __precomputed(self, expr, i):
+        name = self.__precomputed_name(expr)
+        return self.matrix(name, i) if name is not None else None
+
+    def __columns(self, expr):
+        """表达式要读的列，有预先算好的横截面变换就读变换后的列"""
+        name = self.__precomputed_name(expr)
+        if name is not None:
+            return {name}
+        if expr[0] == 'col':
+            return {expr[1]}
+        return set().union(*[self.__columns(x) for x in expr[1:]])
+
+    def matrix(self, name, i):
+        """第 i 个 offset 的 时间 × 币种 矩阵"""
+        if name in self.__matrices:
+            return self.__matrices[name][i]
+        _, rows, panel = self.offset_panels[i]
+        return panel.matrix(self.store.column(name)[rows])
+
+    def key(self, dna):
+        return dna_key(dna, self.factors, self.template)
+
+    def fitness(self, dna):
+        """所有 offset 适应度的平均"""
+        return self.fitness_many([dna])[0]
+
+    def fitness_many(self, dnas):
+        """一批 DNA 的适应度，按 offset 外层循环，同一 offset 下共同的子表达式只算一次"""
+        expressions = [self.key(x) for x in dnas]
+        result = np.empty((len(dnas), len(self.offset_panels)))
+        for i, (_, _, panel) in enumerate(self.offset_panels):
+            for j, expr in enumerate(expressions):
+                new_factor = self.evaluator.evaluate(expr, i)
+                selection = panel.select(new_factor, self.select_coin_num, False, self.c_rate)
+                result[j, i] = self.fitness_func(selection.equity, selection.returns)
+        return list(result.mean(axis=1))
+
+
+# ===== 种群进化
+
+__mutation_rates = dict()
+
+
+def mutation_rate(path):
+    """变异概率，文件修改时间变了才重新读"""
+    mtime = os.path.getmtime(path)
+    cached = __mutation_rates.get(path)
+    if cached is None or cached[0] != mtime:
+        value = pd.read_csv(path)['ppp'].values[0]
+        print('ppp', value)
+        cached = __mutation_rates[path] = (mtime, value)
+    return cached[1]
+
+
+def mutate(dna, dna_range, rate):
+    """每一位以 rate 的概率变成取值范围中的其他值"""
+    kid = list(dna)
+    for i in range(len(kid)):
+        if np.random.rand() < rate:  # 变异概率
+            little_range = list(set(dna_range) - {kid[i]})  # 在dna取值范围中 排除当前位的值
+            kid[i] = np.random.choice(little_range, 1)[0]
+    return kid
+
+
+def crossover(a, b):
+    """均匀交叉，每一位随机来自两个父代之一"""
+    mask = np.random.rand(len(a)) < 0.5
+    return [x if m else y for x, y, m in zip(a, b, mask)]
+
+
+def tournament_select(population, scores, size):
+    """随机选 size 个，返回适应度最高的"""
+    index = np.random.choice(len(population), size, replace=len(population) < size)
+    return population[max(index, key=lambda i: scores[i])]
@@ -15,7 +15,7 @@ from cy_data_access.models.market import *
 from cy_data_access.models.position import *
 from cy_data_access.util.convert import *
 from ...exchange.binance import *
-from ....util.helper import ProcedureHelper as ph
+from ....util.candle_cache import default_candle_cache
 from ....util.logger import *
 
 pd.options.display.max_columns = None
@@ -203,25 +203,8 @@ class BinanceSwapNeutral:
     def fetch_candle_for_strategy(self, coin_pair: CoinPair, time_frame: TimeFrame, limit, run_time):
         """取策略需要用的K线"""
         candle_cls = candle_record_class_with_components(self._ccxt_provider.ccxt_object_for_fetching.name, coin_pair, time_frame, '_swap')
-        # 取最后的 limit 条
-        pipeline = [{
-            '$sort': {
-                '_id': -1
-            }
-        }, {
-            '$match': {
-                'volume': {
-                    '$gt': 0
-                }
-            }
-        }, {
-            "$limit": limit + 10
-        }, {
-            '$sort': {
-                '_id': 1
-            }
-        }]
-        df = pd.DataFrame(list(candle_cls.objects.aggregate(*pipeline)))
+        # 取最后 limit + 10 条 volume > 0 的，走本地缓存，只从库里取新增的
+        df = default_candle_cache().read(candle_cls, last_n=limit + 10, row_filter=lambda x: x['volume'] > 0)
 
         # 数据不够，不要了
         symbol = coin_pair.formatted().upper()
@@ -229,9 +212,6 @@ class BinanceSwapNeutral:
             print(f'{symbol} 数据太少')
             return None, None
 
-        # Tidy candle
-        ph.tidy_candle_from_database(df)
-
         # 删除runtime那行的数据，如果有的话
         candle_begin_time = run_time.astimezone(tz=pytz.utc)
         df = df[df['candle_begin_time'] < candle_begin_time]
@@ -0,0 +1,114 @@
+import io
+import math
+import base64
+import html
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+class EquityCurve:
+    """一条资金曲线和它的标题
+
+    :param title: 标题，可以多行
+    :param times: 时间
+    :param equity: 资金曲线
+    :param name: 文件名、HTML 锚点用
+    :param info: 列名 -> 值，HTML 报告里显示在图下面 """
+
+    def __init__(self, title, times, equity, name=None, info=None):
+        self.title = title
+        self.times = times
+        self.equity = np.asarray(equity, dtype=np.float64)
+        self.name = name or title.split('\n')[0]
+        self.info = info or {}
+
+    @property
+    def log_equity(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(self.equity)
+
+
+class EquityRenderer:
+    """不依赖界面和浏览器的资金曲线渲染，Agg 后端，Figure 建一次反复用
+
+    一张图上下两个子图: 资金曲线 / 对数资金曲线 """
+
+    def __init__(self, figsize=(10, 5), dpi=100):
+        self.figure = Figure(figsize=(figsize[0], figsize[1] * 2), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.subplots(2, 1)
+        self.figure.subplots_adjust(left=0.06, right=0.98, bottom=0.035, top=0.93, hspace=0.12)
+
+    @staticmethod
+    def __draw(ax, times, values, label):
+        ax.cla()
+        ax.plot(times, values, label=label)
+        ax.legend(loc='best')
+        ax.grid(True, linestyle='-.', dashes=(5, 5), linewidth=0.5)
+
+    def render(self, curve: EquityCurve):
+        self.__draw(self.axes[0], curve.times, curve.equity, 'Equity Curve')
+        self.__draw(self.axes[1], curve.times, curve.log_equity, 'EquityCurve_log')
+        self.axes[0].set_title(curve.title)
+
+    def png(self, curve: EquityCurve):
+        """-> PNG bytes"""
+        self.render(curve)
+        buffer = io.BytesIO()
+        self.canvas.print_png(buffer)
+        return buffer.getvalue()
+
+    def save(self, curve: EquityCurve, path):
+        self.render(curve)
+        self.canvas.print_png(path)
+
+
+def render_grid(curves, path, columns=4, cell_size=(4, 2.5), dpi=80):
+    """所有曲线画成一张缩略图网格 PNG，每格上面是资金曲线，下面是对数资金曲线，一次绘制"""
+    rows = max(1, math.ceil(len(curves) / columns))
+    figure = Figure(figsize=(cell_size[0] * columns, cell_size[1] * 2 * rows), dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    grid = figure.add_gridspec(rows * 2, columns, left=0.03, right=0.99, bottom=0.02, top=0.98, hspace=0.35, wspace=0.2)
+    for i, curve in enumerate(curves):
+        row, column = divmod(i, columns)
+        ax1 = figure.add_subplot(grid[row * 2, column])
+        ax2 = figure.add_subplot(grid[row * 2 + 1, column], sharex=ax1)
+        ax1.plot(curve.times, curve.equity, linewidth=0.8)
+        ax2.plot(curve.times, curve.log_equity, linewidth=0.8, color='tab:orange')
+        ax1.set_title(curve.name, fontsize=8)
+        ax1.tick_params(labelbottom=False)
+        locator = AutoDateLocator()
+        ax2.xaxis.set_major_locator(locator)
+        ax2.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+        for ax in (ax1, ax2):
+            ax.tick_params(labelsize=6)
+            ax.grid(True, linestyle='-.', linewidth=0.3)
+    canvas.print_png(path)
+    return path
+
+
+def render_html(curves, path, title='资金曲线', renderer: EquityRenderer = None):
+    """所有曲线写成一个 HTML 文件，图片 base64 内嵌，不依赖其他文件"""
+    renderer = renderer or EquityRenderer()
+    parts = [
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>{}</title>'.format(html.escape(title)),
+        '<style>body{font-family:sans-serif;margin:20px}section{margin-bottom:32px}'
+        'table{border-collapse:collapse;font-size:13px}td,th{border:1px solid #ccc;padding:2px 8px}img{max-width:100%}</style>',
+        '</head><body><h1>{}</h1><ol>'.format(html.escape(title)),
+    ]
+    parts += ['<li><a href="#c{}">{}</a></li>'.format(i, html.escape(x.name)) for i, x in enumerate(curves)]
+    parts.append('</ol>')
+    for i, curve in enumerate(curves):
+        image = base64.b64encode(renderer.png(curve)).decode('ascii')
+        parts.append('<section id="c{}"><h3>{}</h3>'.format(i, html.escape(curve.name)))
+        if curve.info:
+            parts.append('<table><tr>{}</tr><tr>{}</tr></table>'.format(
+                ''.join('<th>{}</th>'.format(html.escape(str(k))) for k in curve.info),
+                ''.join('<td>{}</td>'.format(html.escape(str(v))) for v in curve.info.values())))
+        parts.append('<img src="data:image/png;base64,{}"></section>'.format(image))
+    parts.append('</body></html>')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(parts))
+    return path
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+
+# first/last 的宽表按列分块算，限制下标矩阵的内存
+__CHUNK_COLUMNS = 64
+
+
+class OffsetBuckets:
+    """所有 offset 的分桶: 每行数据在每个 offset 下属于哪个周期
+
+    周期 k 为 [origin + offset + k * freq, origin + offset + (k + 1) * freq)，和 resample(freq, origin=origin, offset=offset) 一致，
+    每个 offset 输出从第一行所在周期到最后一行所在周期的所有周期(没有数据的也输出)。
+    所有 offset 的非空周期拼在一起，记录每段在原数据中的 [start, end) 和在输出中的行号。
+
+    :param times: 升序的时间，datetime64 或 DatetimeIndex
+    :param freq: 周期，如 '72h'
+    :param origin: 对齐的起点
+    :param offsets: offset 列表，如 ['0h', '1h', ...] """
+
+    def __init__(self, times, freq, origin, offsets):
+        times = pd.DatetimeIndex(times)
+        origin = pd.Timestamp(origin)
+        if times.tz is not None:
+            origin = origin.tz_localize(times.tz) if origin.tzinfo is None else origin.tz_convert(times.tz)
+        self.tz = times.tz
+        self.rows = len(times)
+        freq_ns = pd.Timedelta(freq).value
+        relative = times.values.astype('datetime64[ns]').view(np.int64) - origin.value
+        assert self.rows == 0 or (np.diff(relative) >= 0).all(), '时间需要升序'
+
+        starts, ends, output_rows, labels, offset_ids = [], [], [], [], []
+        total = 0
+        for i, offset in enumerate(offsets if self.rows > 0 else []):
+            offset_ns = pd.Timedelta(offset).value
+            bucket = np.floor_divide(relative - offset_ns, freq_ns)
+            start = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+            first, last = bucket[0], bucket[-1]
+            starts.append(start)
+            ends.append(np.r_[start[1:], self.rows])
+            output_rows.append(total + bucket[start] - first)
+            count = last - first + 1
+            labels.append(origin.value + offset_ns + (first + np.arange(count)) * freq_ns)
+            offset_ids.append(np.full(count, i))
+            total += count
+
+        def concat(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if len(arrays) > 0 else np.empty(0, dtype=dtype)
+
+        self.starts = concat(starts, np.int64)
+        self.ends = concat(ends, np.int64)
+        self.output_rows = concat(output_rows, np.int64)
+        self.labels = concat(labels, np.int64)
+        self.offset_ids = concat(offset_ids, np.int64)
+        self.output_size = total
+        # 每个 offset 的非空周期段，sum/max/min 按 offset 分别 reduceat
+        self.__offset_segments = []
+        position = 0
+        for start in starts:
+            self.__offset_segments.append((position, position + len(start)))
+            position += len(start)
+
+    def label_index(self):
+        index = pd.DatetimeIndex(self.labels.view('datetime64[ns]'))
+        return index.tz_localize('UTC').tz_convert(self.tz) if self.tz is not None else index
+
+    # 下标
+
+    def first_valid(self, valid):
+        """每段第一个有效行的下标，没有为 -1，valid 为 行 × 列 的 bool"""
+        index = np.where(valid, np.arange(self.rows).reshape(-1, 1), self.rows)
+        next_valid = np.minimum.accumulate(index[::-1], axis=0)[::-1]
+        picked = next_valid[self.starts]
+        return np.where(picked < self.ends[:, np.newaxis], picked, -1)
+
+    def last_valid(self, valid):
+        """每段最后一个有效行的下标，没有为 -1"""
+        index = np.where(valid, np.arange(self.rows).reshape(-1, 1), -1)
+        prev_valid = np.maximum.accumulate(index, axis=0)
+        picked = prev_valid[self.ends - 1]
+        return np.where(picked >= self.starts[:, np.newaxis], picked, -1)
+
+    # 聚合
+
+    def gather(self, values, how):
+        """first/last: 行 × 列 的 float64 -> 输出行 × 列，没有数据的为 NaN"""
+        values = np.asarray(values, dtype=np.float64)
+        picker = self.first_valid if how == 'first' else self.last_valid
+        picked = picker(~np.isnan(values))
+        gathered = values[np.maximum(picked, 0), np.arange(values.shape[1])]
+        result = np.full((self.output_size, values.shape[1]), np.nan)
+        result[self.output_rows] = np.where(picked >= 0, gathered, np.nan)
+        return result
+
+    def gather_object(self, values, how):
+        """first/last: 非数值的一列(如 symbol、时间)，没有数据的为缺失值"""
+        valid = np.asarray(pd.notna(values)).reshape(-1, 1)
+        picker = self.first_valid if how == 'first' else self.last_valid
+        picked = picker(valid)[:, 0]
+        index = np.full(self.output_size, -1, dtype=np.int64)
+        index[self.output_rows] = picked
+        return take(values, index, allow_fill=True)
+
+    def reduce(self, values, how):
+        """sum/max/min: 一列按段 reduceat，和 pandas 一样跳过 NaN，空周期 sum 为 0，max/min 为 NaN"""
+        values = np.asarray(values, dtype=np.float64)
+        if how == 'sum':
+            ufunc, empty = np.add, 0.0
+            values = np.nan_to_num(values, nan=0)
+        else:
+            ufunc, empty = (np.fmax if how == 'max' else np.fmin), np.nan
+        result = np.full(self.output_size, empty)
+        for begin, end in self.__offset_segments:
+            if end > begin:
+                result[self.output_rows[begin:end]] = ufunc.reduceat(values, self.starts[begin:end])
+        return result
+
+
+def resample_offsets(df: pd.DataFrame, agg_dict, freq, origin, offsets=('0h',), time_column='candle_begin_time'):
+    """一次算出所有 offset 的 resample 结果，不对宽表做 len(offsets) 次 resample
+
+    1. 分桶只在时间列上按 offset 循环;
+    2. first/last 的列拼成矩阵，用每行 下一个/上一个 有效行 的下标一次取出所有 offset 所有周期的值;
+    3. sum/max/min 的列(很少)按 offset 做 reduceat。
+
+    :param agg_dict: 列 -> 'first' / 'last' / 'sum' / 'max' / 'min'
+    :param freq: 周期，如 '72h'
+    :param origin: 对齐的起点
+    :param offsets: offset 列表，如 [f'{i}h' for i in range(72)]
+    :return: time_column(周期开始时间) + agg_dict 的列 + offset(offsets 中的序号)，按 offset、时间 排序 """
+    buckets = OffsetBuckets(df[time_column], freq, origin, offsets)
+    result = {time_column: buckets.label_index()}
+
+    # 数值的 first/last 列分块一起取
+    numeric = dict()
+    for name, how in agg_dict.items():
+        if how in ('first', 'last') and pd.api.types.is_numeric_dtype(df[name]) and not pd.api.types.is_bool_dtype(df[name]):
+            numeric.setdefault(how, []).append(name)
+    gathered = dict()
+    for how, names in numeric.items():
+        for i in range(0, len(names), __CHUNK_COLUMNS):
+            chunk = names[i:i + __CHUNK_COLUMNS]
+            values = buckets.gather(df[chunk].to_numpy(dtype=np.float64), how)
+            for j, name in enumerate(chunk):
+                gathered[name] = values[:, j]
+
+    for name, how in agg_dict.items():
+        if name in gathered:
+            result[name] = gathered[name]
+        elif how in ('first', 'last'):
+            result[name] = buckets.gather_object(df[name].array, how)
+        elif how in ('sum', 'max', 'min'):
+            result[name] = buckets.reduce(df[name].values, how)
+        else:
+            raise ValueError(f'不支持的聚合方式 {how}')
+    result['offset'] = buckets.offset_ids
+    return pd.DataFrame(result)
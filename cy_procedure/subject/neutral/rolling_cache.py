@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+
+class RollingCache:
+    """rolling 基础计算的缓存，按 (列, 窗口, 运算, min_periods) 缓存，一个币种内每个基础计算只算一次
+
+    因子分组计算时用 family(name) 包起来，report() 给出每组的耗时、命中次数和省下的时间(命中的基础计算第一次算的耗时之和)。
+
+    :param source: DataFrame，或 列名 -> Series 的函数(可以取到不在 df 里的中间数据) """
+
+    def __init__(self, source):
+        self.__column = source.__getitem__ if isinstance(source, pd.DataFrame) else source
+        self.__cache = dict()
+        self.__cost = dict()
+        self.__family = None
+        self.__stats = dict()
+
+    def get(self, column, window, op, min_periods=None):
+        """df[column].rolling(window, min_periods).op()"""
+        key = (column, window, op, min_periods)
+        stats = self.__stats.get(self.__family)
+        if key in self.__cache:
+            if stats is not None:
+                stats['hits'] += 1
+                stats['saved'] += self.__cost[key]
+            return self.__cache[key]
+        start = time.perf_counter()
+        result = getattr(self.__column(column).rolling(window, min_periods=min_periods), op)()
+        self.__cost[key] = time.perf_counter() - start
+        self.__cache[key] = result
+        if stats is not None:
+            stats['misses'] += 1
+        return result
+
+    @contextmanager
+    def family(self, name):
+        """统计一组因子的耗时"""
+        stats = self.__stats.setdefault(name, {'time': 0, 'hits': 0, 'misses': 0, 'saved': 0})
+        previous, self.__family = self.__family, name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats['time'] += time.perf_counter() - start
+            self.__family = previous
+
+    def report(self):
+        """每组因子: 耗时(s) / 命中 / 计算 / 省下(s)"""
+        report = pd.DataFrame.from_dict(self.__stats, orient='index')
+        report.columns = ['耗时', '命中', '计算', '省下']
+        return report
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+
+def nan_cumprod(values):
+    """和 pandas 的 cumprod 一样跳过 NaN，NaN 的位置结果还是 NaN"""
+    result = np.nancumprod(values)
+    result[np.isnan(values)] = np.nan
+    return result
+
+
+def select_smallest(keys, select_num):
+    """最后一维(币种)上取最小的 select_num 个的下标，NaN 不选
+
+    :return: (... × k 的下标, 是否有效)，k = min(select_num, 币种数) """
+    keys = np.where(np.isnan(keys), np.inf, keys)
+    k = min(select_num, keys.shape[-1])
+    if k < keys.shape[-1]:
+        index = np.argpartition(keys, k - 1, axis=-1)[..., :k]
+    else:
+        index = np.broadcast_to(np.arange(k), keys.shape[:-1] + (k,))
+    valid = np.isfinite(np.take_along_axis(keys, index, axis=-1))
+    return index, valid
+
+
+def period_returns(change, long_index, long_valid, short_index, short_valid, c_rate):
+    """多空选中币种的本周期涨跌幅平均，change 为 时间 × 币种，下标可以多一维因子
+
+    :return: 每个周期的多空涨跌幅，没有选中的为 NaN """
+    long_change = np.take_along_axis(change, long_index, axis=-1)
+    short_change = np.take_along_axis(change, short_index, axis=-1)
+    long_return = np.where(long_valid, -c_rate + (1 + long_change) * (1 - c_rate) - 1, np.nan)
+    short_return = np.where(short_valid, -c_rate + (1 - short_change) * (1 - c_rate) - 1, np.nan)
+    all_return = np.concatenate((long_return, short_return), axis=-1)
+    count = (~np.isnan(all_return)).sum(axis=-1)
+    total = np.nansum(all_return, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+class SelectionPanel:
+    """一个 offset 的数据整理成 时间 × 币种 的稠密矩阵，同一份数据可以反复选币
+
+    :param df: 至少有 candle_begin_time / symbol / avg_price / 下个周期_avg_price 列，同一时间同一币种只有一行 """
+
+    def __init__(self, df: pd.DataFrame):
+        time_codes, self.times = pd.factorize(df['candle_begin_time'], sort=True)
+        symbol_codes, symbols = pd.factorize(df['symbol'])
+        self.symbols = np.asarray(symbols, dtype=object)
+        self.__rows = time_codes
+        self.__cols = symbol_codes
+        self.shape = (len(self.times), len(self.symbols))
+        # 每个时间的币数量，和原来 groupby().size() 一样，包括因子为空的
+        self.coin_count = np.bincount(time_codes, minlength=self.shape[0])
+        # 下个周期均价相对本周期均价的涨跌幅
+        self.change = self.matrix(df['下个周期_avg_price'].values / df['avg_price'].values - 1)
+
+    def matrix(self, values):
+        """按行对齐的一列 -> 时间 × 币种 矩阵，没有数据的为 NaN"""
+        result = np.full(self.shape, np.nan)
+        result[self.__rows, self.__cols] = values
+        return result
+
+    def select(self, factor, select_num, reverse=False, c_rate=0):
+        """按因子选币
+
+        :param factor: 和构造时 df 按行对齐的因子值，或已经是 时间 × 币种 的矩阵
+        :param select_num: 多空各选几个
+        :param reverse: 是否反转因子
+        :param c_rate: 手续费率
+        :return: Selection """
+        factor = np.asarray(factor, dtype=np.float64)
+        if factor.ndim == 1:
+            factor = self.matrix(factor)
+        factor = np.where(np.isinf(factor), np.nan, factor)
+        if reverse:
+            factor = -factor
+        # 因子最小的做多，最大的做空
+        long_index, long_valid = select_smallest(factor, select_num)
+        short_index, short_valid = select_smallest(-factor, select_num)
+        return Selection(self, factor, long_index, long_valid, short_index, short_valid, c_rate)
+
+    def batch_returns(self, factors, select_num, c_rate=0):
+        """多个因子一起选币，正反两个方向共用一次排序：反向就是把做多和做空的币对调
+
+        :param factors: 因子数 × 时间 × 币种
+        :return: (正向, 反向) 的每周期多空涨跌幅，都是 因子数 × 时间 """
+        factors = np.where(np.isinf(factors), np.nan, factors)
+        small_index, small_valid = select_smallest(factors, select_num)
+        large_index, large_valid = select_smallest(-factors, select_num)
+        change = self.change[np.newaxis]
+        normal = period_returns(change, small_index, small_valid, large_index, large_valid, c_rate)
+        reverse = period_returns(change, large_index, large_valid, small_index, small_valid, c_rate)
+        return normal, reverse
+
+
+class Selection:
+    """一次选币的结果，币种列表用到时才生成"""
+
+    def __init__(self, panel: SelectionPanel, factor, long_index, long_valid, short_index, short_valid, c_rate):
+        self.panel = panel
+        self.__factor = factor
+        self.long_index = long_index
+        self.long_valid = long_valid
+        self.short_index = short_index
+        self.short_valid = short_valid
+
+        # 每个选中的币本周期涨跌幅，多空一起平均
+        self.returns = period_returns(panel.change, long_index, long_valid, short_index, short_valid, c_rate)
+        self.equity = nan_cumprod(self.returns + 1)
+
+    def __symbols(self, index, valid, ascending):
+        """每个时间选中的币种，按因子排序，拼成 'a b ' 这样的字符串"""
+        values = np.take_along_axis(self.__factor, index, axis=1)
+        values = np.where(valid, values, np.inf if ascending else -np.inf)
+        order = np.argsort(values if ascending else -values, axis=1, kind='stable')
+        index = np.take_along_axis(index, order, axis=1)
+        valid = np.take_along_axis(valid, order, axis=1)
+        names = np.where(valid, (self.panel.symbols + ' ')[index], '')
+        return [''.join(row) or np.nan for row in names]
+
+    def long_symbols(self):
+        return self.__symbols(self.long_index, self.long_valid, True)
+
+    def short_symbols(self):
+        return self.__symbols(self.short_index, self.short_valid, False)
+
+    def to_select_df(self, with_symbols=True):
+        """-> 和 gen_select_df 一样的 DataFrame"""
+        select_c = pd.DataFrame({
+            'candle_begin_time': self.panel.times,
+            '币数量': self.panel.coin_count,
+        })
+        if with_symbols:
+            select_c['做多币种'] = self.long_symbols()
+            select_c['做空币种'] = self.short_symbols()
+        select_c['本周期多空涨跌幅'] = self.returns
+        select_c['资金曲线'] = self.equity
+        return select_c
@@ -7,7 +7,7 @@ from cy_data_access.models.quant import *
 from cy_data_access.models.config import *
 from cy_data_access.models.market import *
 from cy_data_access.models.position import *
-from ...util.helper import ProcedureHelper as ph
+from ...util.candle_cache import default_candle_cache
 from ...util.logger import *
 
 
@@ -68,21 +68,8 @@ class BaseBrickCarrier(ABC):
     def _fetch_candle_for_strategy(self, coin_pair: CoinPair, time_frame: TimeFrame, limit, tail=''):
         """取策略需要用的K线"""
         candle_cls = candle_record_class_with_components(self._ccxt_provider.ccxt_object_for_fetching.name, coin_pair, time_frame, tail)
-        # 取最后的 limit 条
-        pipeline = [{
-            '$sort': {
-                '_id': -1
-            }
-        }, {
-            "$limit": limit
-        }, {
-            '$sort': {
-                '_id': 1
-            }
-        }]
-        df = pd.DataFrame(list(candle_cls.objects.aggregate(*pipeline)))
-        # Tidy candle
-        ph.tidy_candle_from_database(df)
+        # 取最后的 limit 条，走本地缓存，只从库里取新增的
+        df = default_candle_cache().read(candle_cls, last_n=limit)
         return df
 
     @ abstractmethod
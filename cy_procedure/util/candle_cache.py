@@ -0,0 +1,288 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cy_components.defines.column_names import *
+from .candle_loader import load_candle_df
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能进程内互斥
+    fcntl = None
+
+# 缓存目录，可以用环境变量改
+CANDLE_CACHE_DIR = os.environ.get('CY_CANDLE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cy_procedure', 'candle_cache'))
+
+
+def utc_timestamp(date):
+    """-> UTC Timestamp，没有时区的按 UTC"""
+    date = pd.Timestamp(date)
+    return date.tz_localize('UTC') if date.tzinfo is None else date.tz_convert('UTC')
+
+
+class CandleCache:
+    """本地 Parquet K线缓存，放在 Mongo 读取前面（读穿）
+
+    1. 每个 数据库/collection 一个目录，按月分区，一个月一个 parquet 文件;
+    2. meta.json 记录缓存的头尾: head 为空表示已经缓存到最早一根，tail 是缓存的最后一根;
+    3. 每次读先做尾部增量刷新，只取 _id >= tail 的K线(最后一根可能还没走完，重新取);
+    4. 请求的数据比缓存的头更早时，再向前补;
+    5. 结果从 Arrow 直接转 DataFrame，candle_begin_time 是 UTC datetime64;
+    6. 写进 [head, tail) 中间的K线(如 CHECK_MISSING / WINDOWED 回补)由写入方调用 mark_written，
+       对应的月份记为 dirty，下次读时整月从 Mongo 重新取。
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir is not None else CANDLE_CACHE_DIR
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.__local_lock = threading.Lock()
+
+    # Paths & meta
+
+    def __collection_dir(self, collection):
+        # 不同数据库里同名的 collection 分开缓存
+        return os.path.join(self.cache_dir, collection.database.name, collection.name)
+
+    def __load_meta(self, path):
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['head'] = pd.Timestamp(meta['head']) if meta['head'] is not None else None
+        meta['tail'] = pd.Timestamp(meta['tail'])
+        meta['dirty'] = meta.get('dirty', [])
+        return meta
+
+    def __save_meta(self, path, meta):
+        meta = {
+            'head': meta['head'].isoformat() if meta['head'] is not None else None,
+            'tail': meta['tail'].isoformat(),
+            'dirty': sorted(set(meta.get('dirty', []))),
+        }
+        tmp_path = os.path.join(path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+    def __partition_files(self, path):
+        """按时间顺序的分区文件"""
+        return sorted(os.path.join(path, x) for x in os.listdir(path) if x.endswith('.parquet'))
+
+    # Lock
+
+    def __locked(self, path, func):
+        """同一个 collection 的缓存同时只有一个进程在改"""
+        os.makedirs(path, exist_ok=True)
+        if fcntl is None:
+            with self.__local_lock:
+                return func()
+        with open(os.path.join(path, '.lock'), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                return func()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Write
+
+    def __write_rows(self, path, df: pd.DataFrame):
+        """按月合并进分区文件，同一根K线以新的为准"""
+        months = df[COL_CANDLE_BEGIN_TIME].dt.strftime('%Y-%m').values
+        for month in np.unique(months):
+            part = df[months == month]
+            file_path = os.path.join(path, '{}.parquet'.format(month))
+            if os.path.exists(file_path):
+                cached = pq.read_table(file_path).to_pandas()
+                part = pd.concat([cached, part], ignore_index=True)
+                part.drop_duplicates(COL_CANDLE_BEGIN_TIME, keep='last', inplace=True)
+                part.sort_values(COL_CANDLE_BEGIN_TIME, inplace=True)
+            table = pa.Table.from_pandas(part, preserve_index=False)
+            tmp_path = file_path + '.tmp'
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, file_path)
+
+    # Refresh
+
+    def __refresh_tail(self, collection, path):
+        meta = self.__load_meta(path)
+        if meta is None:
+            return None
+        df = load_candle_df(collection, {'_id': {'$gte': meta['tail'].to_pydatetime()}})
+        if df.shape[0] > 0:
+            self.__write_rows(path, df)
+            meta['tail'] = df[COL_CANDLE_BEGIN_TIME].iloc[-1]
+            self.__save_meta(path, meta)
+        return meta
+
+    def __reload_dirty(self, collection, path, meta):
+        """dirty 的月份整月从 Mongo 重新取，替换分区文件"""
+        if meta is None or len(meta['dirty']) == 0:
+            return meta
+        for month in meta['dirty']:
+            month_start = pd.Timestamp(month + '-01', tz='UTC')
+            if meta['head'] is not None:
+                month_start = max(month_start, meta['head'])
+            month_end = pd.Timestamp(month + '-01', tz='UTC') + pd.offsets.MonthBegin(1)
+            df = load_candle_df(collection, {'_id': {'$gte': month_start.to_pydatetime(), '$lt': month_end.to_pydatetime()}})
+            file_path = os.path.join(path, '{}.parquet'.format(month))
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if df.shape[0] > 0:
+                self.__write_rows(path, df)
+        meta['dirty'] = []
+        self.__save_meta(path, meta)
+        return meta
+
+    def __extend_head(self, collection, path, meta, start_date=None, count=None):
+        """向前补到 start_date，或再补 count 根"""
+        query = {}
+        if meta is not None and meta['head'] is not None:
+            query['_id'] = {'$lt': meta['head'].to_pydatetime()}
+        if start_date is not None:
+            query.setdefault('_id', {})['$gte'] = start_date.to_pydatetime()
+            df = load_candle_df(collection, query)
+        else:
+            df = load_candle_df(collection, query, sort=-1, limit=count or 0)
+        # 取到的比要的少，说明已经到最早一根
+        reached_first = start_date is None and (count is None or df.shape[0] < count)
+        if reached_first:
+            head = None
+        elif start_date is not None:
+            head = start_date  # start_date 之后已经完整
+        else:
+            head = df[COL_CANDLE_BEGIN_TIME].iloc[0]
+        if df.shape[0] == 0:
+            if meta is None:
+                return None
+            meta = dict(meta, head=head)
+            self.__save_meta(path, meta)
+            return meta
+        self.__write_rows(path, df)
+        if meta is None:
+            meta = dict(tail=df[COL_CANDLE_BEGIN_TIME].iloc[-1], dirty=[])
+        meta = dict(meta, head=head)
+        self.__save_meta(path, meta)
+        return meta
+
+    # Read
+
+    def __read_table(self, path, start_date=None):
+        files = self.__partition_files(path)
+        if start_date is not None:
+            start_month = start_date.strftime('%Y-%m')
+            files = [x for x in files if os.path.basename(x)[:7] >= start_month]
+        if len(files) == 0:
+            return pd.DataFrame()
+        df = pa.concat_tables([pq.read_table(x) for x in files], promote_options='default').to_pandas()
+        if start_date is not None:
+            df = df[df[COL_CANDLE_BEGIN_TIME] >= start_date]
+        return df.reset_index(drop=True)
+
+    def __read_last(self, path, last_n, row_filter):
+        """从最新的分区往前读，直到有 last_n 根满足 row_filter 的K线"""
+        dfs = []
+        count = 0
+        for file_path in reversed(self.__partition_files(path)):
+            df = pq.read_table(file_path).to_pandas()
+            if row_filter is not None:
+                df = df[row_filter(df)]
+            dfs.insert(0, df)
+            count += df.shape[0]
+            if count >= last_n:
+                break
+        if len(dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True).tail(last_n).reset_index(drop=True)
+
+    def read(self, candle_cls, start_date=None, last_n=None, row_filter=None):
+        """读K线，缓存没有的部分先从 Mongo 补
+
+        Parameters
+        ----------
+        candle_cls : CandleRecord
+            candle_record_class(...) 生成的类
+        start_date : datetime, optional
+            取 >= start_date 的全部K线
+        last_n : int, optional
+            取最后 last_n 根
+        row_filter : df -> bool Series, optional
+            只和 last_n 一起用，先过滤再取最后 last_n 根，如 lambda df: df['volume'] > 0
+        """
+        collection = candle_cls._mongometa.collection
+        path = self.__collection_dir(collection)
+        start_date = utc_timestamp(start_date) if start_date is not None else None
+
+        def load():
+            meta = self.__reload_dirty(collection, path, self.__refresh_tail(collection, path))
+            if start_date is not None:
+                if meta is None or (meta['head'] is not None and meta['head'] > start_date):
+                    meta = self.__extend_head(collection, path, meta, start_date=start_date)
+                return self.__read_table(path, start_date) if meta is not None else pd.DataFrame()
+            if last_n is not None:
+                # 不够就往前补，直到够了或者到最早一根
+                while True:
+                    df = self.__read_last(path, last_n, row_filter) if meta is not None else pd.DataFrame()
+                    if df.shape[0] >= last_n or (meta is not None and meta['head'] is None):
+                        return df
+                    meta = self.__extend_head(collection, path, meta, count=last_n - df.shape[0])
+                    if meta is None:
+                        return df
+            # 全部历史
+            if meta is None or meta['head'] is not None:
+                meta = self.__extend_head(collection, path, meta)
+            return self.__read_table(path) if meta is not None else pd.DataFrame()
+
+        return self.__locked(path, load)
+
+    def invalidate(self, candle_cls):
+        """删掉某个 collection 的缓存，下次读时重建"""
+        path = self.__collection_dir(candle_cls._mongometa.collection)
+
+        def clear():
+            for file_path in self.__partition_files(path):
+                os.remove(file_path)
+            meta_path = os.path.join(path, 'meta.json')
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+        self.__locked(path, clear)
+
+    def mark_written(self, candle_cls, start_date, end_date):
+        """Mongo 里 [start_date, end_date] 的K线被写过(回补)，落在已缓存区间中间的月份下次读时重新取
+
+        tail 之后的由尾部刷新取到，head 之前的还没缓存，都不用管"""
+        path = self.__collection_dir(candle_cls._mongometa.collection)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return
+        start_date, end_date = utc_timestamp(start_date), utc_timestamp(end_date)
+
+        def mark():
+            meta = self.__load_meta(path)
+            if meta is None:
+                return
+            start = start_date if meta['head'] is None else max(start_date, meta['head'])
+            end = min(end_date, meta['tail'])
+            if start >= meta['tail'] or start > end:
+                return
+            months = pd.period_range(start.tz_localize(None), end.tz_localize(None), freq='M').strftime('%Y-%m')
+            dirty = set(meta['dirty']).union(months)
+            if dirty != set(meta['dirty']):
+                meta['dirty'] = list(dirty)
+                self.__save_meta(path, meta)
+
+        self.__locked(path, mark)
+
+
+__default_cache = None
+
+
+def default_candle_cache():
+    """进程内共用的缓存对象"""
+    global __default_cache
+    if __default_cache is None:
+        __default_cache = CandleCache()
+    return __default_cache
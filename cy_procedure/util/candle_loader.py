@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+from bson import decode_all
+from bson.codec_options import CodecOptions
+from bson.decimal128 import Decimal128
+from cy_components.defines.column_names import *
+
+# K线文档里的数值字段
+CANDLE_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'quote_volume', 'trade_num',
+                 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume']
+
+# 时间解成 naive UTC，最后整列再加时区，比逐个 tz-aware 快
+__codec_options = CodecOptions(tz_aware=False)
+
+
+def __decimal_to_float(value):
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    return value
+
+
+def __typed_column(values):
+    """list -> np.ndarray，数值列为 float64(None -> nan)，其他保持 object"""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return np.array([__decimal_to_float(x) for x in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array(values, dtype=object)
+
+
+def load_candle_df(collection, query=None, fields=None, time_field='_id', sort=1, limit=0, batch_size=50000):
+    """从 Mongo 读K线，直接解成按列的 numpy 数组
+
+    1. 只投影需要的字段，不取 _cls 等;
+    2. 用 find_raw_batches 按批取原始 BSON，不生成 model 对象，也不先拼 list(dict) 再转 DataFrame;
+    3. 时间列为 UTC 的 datetime64，名字统一为 candle_begin_time，数值列为 float64(Decimal128 也转成 float)。
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        如 candle_cls._mongometa.collection
+    query : dict, optional
+        查询条件
+    fields : [str], optional
+        要取的字段，默认 CANDLE_FIELDS
+    time_field : str
+        时间字段，K线表是 _id
+    sort : int, optional
+        按时间 1 升序 / -1 降序取，结果是升序；None 为不排序(没有时间索引的表)
+    limit : int
+        最多取多少条，0 为不限
+    """
+    fields = fields if fields is not None else CANDLE_FIELDS
+    projection = {field: 1 for field in fields}
+    projection[time_field] = 1
+    if time_field != '_id':
+        projection['_id'] = 0
+
+    times = []
+    columns = {field: [] for field in fields}
+    cursor = collection.find_raw_batches(query or {}, projection, sort=[(time_field, sort)] if sort else None, limit=limit, batch_size=batch_size)
+    for batch in cursor:
+        for doc in decode_all(batch, __codec_options):
+            times.append(doc[time_field])
+            for field in fields:
+                columns[field].append(doc.get(field))
+
+    if sort is not None and sort < 0:
+        times.reverse()
+        for values in columns.values():
+            values.reverse()
+
+    data = {COL_CANDLE_BEGIN_TIME: pd.DatetimeIndex(np.array(times, dtype='datetime64[ns]')).tz_localize('UTC')}
+    for field in fields:
+        values = columns[field]
+        # 库里没有的字段不返回
+        if len(values) > 0 and all(x is None for x in values):
+            continue
+        data[field] = __typed_column(values)
+    return pd.DataFrame(data)
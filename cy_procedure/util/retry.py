@@ -0,0 +1,111 @@
+import time
+import random
+from enum import Enum
+
+
+class RetryState(Enum):
+    READY = 'ready'          # 可以执行
+    BACKOFF = 'backoff'      # 失败后等待
+    SUCCEEDED = 'succeeded'  # 成功结束
+    GAVE_UP = 'gave_up'      # 超过次数或时间预算，放弃
+
+
+class RetryPolicy:
+    """重试策略：指数退避 + 抖动，次数和连续失败时长两个上限"""
+
+    def __init__(self, max_retries=10, base_delay=1, max_delay=60, max_elapsed=60 * 60, jitter=0.5):
+        """
+        Parameters
+        ----------
+        max_retries : int
+            连续失败的最大重试次数
+        base_delay : float
+            第一次重试的等待秒数，之后每次翻倍
+        max_delay : float
+            单次等待上限
+        max_elapsed : float
+            连续失败(从第一次失败算起)的最长时间
+        jitter : float
+            0~1，等待时间中随机部分的比例，避免多个进程同时重试
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """第 attempt(从 1 开始) 次重试前等待的秒数"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+
+class RetryMetrics:
+    """重试统计"""
+
+    def __init__(self):
+        self.retry_count = 0      # 总重试次数
+        self.time_lost = 0        # 失败的执行(从最后一次进展算起) + 退避等待 总共耗时(s)
+        self.last_error = None
+
+    def __str__(self):
+        return 'retries: {}, time lost: {}s, last error: {}'.format(self.retry_count, round(self.time_lost, 1), self.last_error)
+
+
+class Retrier:
+    """显式状态机的重试执行器，循环而不是递归，栈深度不随重试次数增长
+
+    READY --成功--> SUCCEEDED
+    READY --失败--> BACKOFF --等待--> READY
+    BACKOFF --超过次数/时间--> GAVE_UP
+
+    任务有进展时调用 progress()，连续失败的计数和计时清零，长时间任务只要还在推进就不会耗尽重试预算。
+    """
+
+    def __init__(self, policy: RetryPolicy = None, name=''):
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.name = name
+        self.metrics = RetryMetrics()
+        self.state = RetryState.READY
+        self.__attempt = 0
+        self.__failing_since = None
+        self.__last_progress = None
+
+    def progress(self):
+        """任务有进展"""
+        self.__attempt = 0
+        self.__failing_since = None
+        self.__last_progress = time.time()
+
+    def run(self, func):
+        """执行 func 直到成功或放弃，返回 (是否成功, 结果)"""
+        self.state = RetryState.READY
+        result = None
+        while self.state not in (RetryState.SUCCEEDED, RetryState.GAVE_UP):
+            if self.state == RetryState.READY:
+                start = time.time()
+                try:
+                    result = func()
+                    self.state = RetryState.SUCCEEDED
+                except Exception as e:
+                    # 最后一次进展之前的执行是有效的，不算损失
+                    lost_since = start if self.__last_progress is None else max(start, self.__last_progress)
+                    self.metrics.time_lost += time.time() - lost_since
+                    self.metrics.last_error = repr(e)
+                    if self.__failing_since is None:
+                        self.__failing_since = lost_since
+                    self.__attempt += 1
+                    print(f'[Retry] {self.name} failed ({self.__attempt}/{self.policy.max_retries}): {e}')
+                    self.state = RetryState.BACKOFF
+            elif self.state == RetryState.BACKOFF:
+                elapsed = time.time() - self.__failing_since
+                if self.__attempt > self.policy.max_retries or elapsed >= self.policy.max_elapsed:
+                    self.state = RetryState.GAVE_UP
+                    continue
+                delay = min(self.policy.delay(self.__attempt), max(0, self.policy.max_elapsed - elapsed))
+                time.sleep(delay)
+                self.metrics.time_lost += delay
+                self.metrics.retry_count += 1
+                self.state = RetryState.READY
+        print(f'[Retry] {self.name} {self.state.value}, {self.metrics}')
+        return self.state == RetryState.SUCCEEDED, result
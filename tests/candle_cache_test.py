@@ -0,0 +1,90 @@
+import types
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from cy_procedure.util import candle_cache
+from cy_procedure.util.candle_cache import CandleCache
+
+
+class FakeCollection:
+    """内存里的K线表，load_candle_df 的替身按 _id 的 $gte / $lt 过滤"""
+
+    def __init__(self, database, name):
+        self.database = types.SimpleNamespace(name=database)
+        self.name = name
+        self.df = pd.DataFrame({'candle_begin_time': pd.DatetimeIndex([], tz='UTC'), 'close': []})
+
+    def upsert(self, times, close):
+        df = pd.DataFrame({'candle_begin_time': pd.DatetimeIndex(times, tz='UTC'), 'close': np.asarray(close, dtype=float)})
+        df = pd.concat([self.df, df], ignore_index=True).drop_duplicates('candle_begin_time', keep='last')
+        self.df = df.sort_values('candle_begin_time').reset_index(drop=True)
+
+
+def fake_load_candle_df(collection, query=None, sort=1, limit=0, **kwargs):
+    df = collection.df
+    condition = (query or {}).get('_id', {})
+    if '$gte' in condition:
+        df = df[df['candle_begin_time'] >= pd.Timestamp(condition['$gte'])]
+    if '$lt' in condition:
+        df = df[df['candle_begin_time'] < pd.Timestamp(condition['$lt'])]
+    if sort == -1 and limit:
+        df = df.tail(limit)
+    return df.reset_index(drop=True)
+
+
+def candle_cls(collection):
+    return types.SimpleNamespace(_mongometa=types.SimpleNamespace(collection=collection))
+
+
+class CandleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(candle_cache, 'load_candle_df', fake_load_candle_df)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = CandleCache(tempfile.mkdtemp())
+        self.times = pd.date_range('2021-01-01', '2021-03-31', freq='D')
+
+    def test_mark_written_reloads_middle(self):
+        collection = FakeCollection('market', 'btc_usdt_1d')
+        holed = self.times.delete([20, 40, 41])
+        collection.upsert(holed, np.arange(len(holed)))
+        cls = candle_cls(collection)
+        self.assertEqual(len(self.cache.read(cls, start_date='2021-01-01')), len(holed))
+
+        # 回补中间的洞，没有标记时缓存看不到
+        collection.upsert(self.times[[20, 40, 41]], [-1, -2, -3])
+        self.assertEqual(len(self.cache.read(cls, start_date='2021-01-01')), len(holed))
+
+        self.cache.mark_written(cls, self.times[20], self.times[41])
+        df = self.cache.read(cls, start_date='2021-01-01')
+        self.assertEqual(len(df), len(self.times))
+        self.assertTrue((df['candle_begin_time'].values == self.times.tz_localize('UTC').values).all())
+        self.assertEqual(df.loc[df['candle_begin_time'] == self.times[40].tz_localize('UTC'), 'close'].item(), -2)
+        self.assertEqual(len(self.cache.read(cls, last_n=5)), 5)
+
+    def test_mark_written_outside_cached_range(self):
+        collection = FakeCollection('market', 'eth_usdt_1d')
+        collection.upsert(self.times, np.arange(len(self.times)))
+        cls = candle_cls(collection)
+        self.cache.mark_written(cls, self.times[0], self.times[-1])  # 还没有缓存，什么都不做
+        self.cache.read(cls, start_date='2021-02-01')
+        # tail 之后的由尾部刷新取到
+        collection.upsert(pd.date_range('2021-04-01', periods=3, freq='D'), [1, 2, 3])
+        self.cache.mark_written(cls, '2021-04-01', '2021-04-03')
+        self.assertEqual(len(self.cache.read(cls, start_date='2021-02-01')), len(self.times) - 31 + 3)
+
+    def test_databases_cached_separately(self):
+        a, b = FakeCollection('market_a', 'btc_usdt_1d'), FakeCollection('market_b', 'btc_usdt_1d')
+        a.upsert(self.times, np.zeros(len(self.times)))
+        b.upsert(self.times[:10], np.ones(10))
+        self.assertEqual(len(self.cache.read(candle_cls(a), start_date='2021-01-01')), len(self.times))
+        df = self.cache.read(candle_cls(b), start_date='2021-01-01')
+        self.assertEqual(len(df), 10)
+        self.assertTrue((df['close'] == 1).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.fetch_history.candle_sink import CandleSink, build_line_protocol
+
+
+class ListSink(CandleSink):
+    """写进 list 的 sink，fail_next 为 True 时下一次写入失败"""
+
+    def __init__(self):
+        self.written = []
+        self.fail_next = False
+        self.__pending = []
+        super().__init__(max_pending=8)
+
+    def _append(self, df, key):
+        self.__pending.append(df)
+
+    def _should_write(self, idle):
+        return True
+
+    def _write_pending(self):
+        if self.fail_next:
+            self.fail_next = False
+            raise IOError('write failed')
+        for df in self.__pending:
+            self.written += df['v'].tolist()
+        self.__pending = []
+        return {}
+
+    def _discard_pending(self):
+        self.__pending = []
+
+
+def frame(*values):
+    return pd.DataFrame({'v': values})
+
+
+class CandleSinkErrorTest(unittest.TestCase):
+
+    def test_put_raises_once(self):
+        sink = ListSink()
+        sink.fail_next = True
+        sink.put(frame(1))
+        sink.flush(raise_error=False)  # 等后台写完，错误丢掉
+        sink.put(frame(2))
+        sink.flush()
+        self.assertEqual(sink.written, [2])
+
+        sink.fail_next = True
+        sink.put(frame(3))
+        sink._CandleSink__queue.join()
+        with self.assertRaises(IOError):
+            sink.put(frame(4))
+        # 错误只抛一次，之后正常写
+        sink.put(frame(5))
+        sink.flush()
+        self.assertEqual(sink.written, [2, 5])
+        sink.close()
+
+    def test_flush_raises(self):
+        sink = ListSink()
+        sink.fail_next = True
+        sink.put(frame(1))
+        with self.assertRaises(IOError):
+            sink.flush()
+        sink.flush()
+        sink.put(frame(2))
+        sink.close()
+        self.assertEqual(sink.written, [2])
+
+
+class LineProtocolTest(unittest.TestCase):
+
+    def test_fields(self):
+        df = pd.DataFrame({
+            'candle_begin_time': pd.date_range('2021-01-01', periods=4, freq='h', tz='UTC'),
+            'close': [1.5, np.nan, 3.0, np.nan],
+            'note': ['a b', 'x"y\\', None, np.nan],
+            'flag': pd.Series(['q', None, 'z', None], dtype=object),
+        })
+        timestamps, lines = build_line_protocol(df, 'my market')
+        self.assertEqual(lines.tolist(), [
+            'my\\ market close=1.5,note="a b",flag="q" 1609459200000000000',
+            'my\\ market note="x\\"y\\\\" 1609462800000000000',
+            'my\\ market close=3.0,flag="z" 1609466400000000000',
+        ])
+        # 所有 field 都缺失的行去掉
+        self.assertEqual(timestamps.tolist(), [1609459200000000000, 1609462800000000000, 1609466400000000000])
+
+    def test_int_and_bool(self):
+        df = pd.DataFrame({
+            'candle_begin_time': pd.date_range('2021-01-01', periods=2, freq='h', tz='UTC'),
+            'count': np.array([1, 2], dtype=np.int64),
+            'up': [True, False],
+        })
+        _, lines = build_line_protocol(df, 'm')
+        self.assertEqual(lines.tolist(), ['m count=1i,up=true 1609459200000000000', 'm count=2i,up=false 1609462800000000000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.neutral.expression import cross_rank, cross_zscore
+
+
+class CrossSectionTest(unittest.TestCase):
+    """横截面变换和 pandas 按行计算的结果一致"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 5, size=(200, 12)).astype(np.float64)  # 有相同的值
+        values[rng.random(values.shape) < 0.2] = np.nan
+        values[rng.random(values.shape) < 0.05] = np.inf
+        values[rng.random(values.shape) < 0.05] = -np.inf
+        values[0] = np.nan
+        values[1] = [np.nan, np.inf, 1.0] + [np.nan] * 9
+        self.values = values
+
+    def test_cross_rank(self):
+        expected = pd.DataFrame(self.values).rank(axis=1, pct=True).values
+        np.testing.assert_allclose(cross_rank(self.values), expected)
+        self.assertEqual(cross_rank(self.values)[1, 1], 1.0)
+
+    def test_cross_zscore(self):
+        finite = np.where(np.isinf(self.values), np.nan, self.values)
+        df = pd.DataFrame(finite)
+        expected = df.sub(df.mean(axis=1), axis=0).div(df.std(axis=1), axis=0).to_numpy(copy=True)
+        expected[~np.isfinite(expected)] = np.nan
+        np.testing.assert_allclose(cross_zscore(finite), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.neutral.factor_store import FactorStore, FactorStoreWriter, compact_float
+
+
+def symbol_frame(symbol, periods, seed):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2021-01-01', periods=periods, freq='3h', tz='UTC')
+    avg_price = rng.uniform(1, 100, size=periods)
+    factor = rng.normal(size=periods)
+    factor[::7] = np.nan
+    return pd.DataFrame({
+        'candle_begin_time': times,
+        'symbol': symbol,
+        'offset': np.arange(periods, dtype=np.int64) % 3,
+        'volume': rng.uniform(0, 1e6, size=periods),
+        'avg_price': avg_price,
+        '下个周期_avg_price': np.append(avg_price[1:], np.nan),
+        '周期开始时间': times.floor('D'),
+        'f': factor,
+        'cond': factor > 0,
+        'count': np.arange(periods, dtype=np.int64),
+    })
+
+
+class CompactFloatTest(unittest.TestCase):
+
+    def test_downcast(self):
+        values = np.array([1.5, np.nan, -2.25, 0.0, np.inf, 1e30])
+        compact = compact_float(values)
+        self.assertEqual(compact.dtype, np.float32)
+        np.testing.assert_allclose(compact.astype(np.float64), values, rtol=1e-6)
+
+    def test_keep_float64(self):
+        # 溢出成 inf、下溢成 0 的都保持 float64
+        for values in [np.array([1.0, 1e300]), np.array([1.0, -1e300]), np.array([1.0, 1e-300])]:
+            self.assertEqual(compact_float(values).dtype, np.float64)
+        # 非 float64 原样返回
+        self.assertEqual(compact_float(np.arange(3)).dtype, np.arange(3).dtype)
+        # 误差在 tolerance 内
+        self.assertEqual(compact_float(np.array([0.1, 1 / 3])).dtype, np.float32)
+        self.assertEqual(compact_float(np.array([0.1, 1 / 3]), tolerance=0).dtype, np.float64)
+
+
+class FactorStoreWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.symbols = ['BTC-USDT', 'ETH-USDT', 'DOGE-USDT', 'ADA-USDT']
+        self.frames = [symbol_frame(symbol, 20 + i, seed=i) for i, symbol in enumerate(self.symbols)]
+        self.frames[1]['f'] = self.frames[1]['f'] * 1e300  # float32 放不下，整列升回 float64
+        self.frames[2] = self.frames[2].drop(columns=['cond'])
+        self.frames[3]['late'] = np.linspace(0, 1, len(self.frames[3]))
+
+    def merge(self):
+        """和 merge_factor_shards 一样: 每个币种先写一个分片，再按顺序追加到持币周期的库里"""
+        shards = []
+        for i, df in enumerate(self.frames):
+            shard = FactorStore.for_hold(self.data_path, f'3H_{i}')
+            shard.write_frame(df)
+            shards.append(shard)
+        store = FactorStore.for_hold(self.data_path, '3H')
+        with FactorStoreWriter(store) as writer:
+            for shard in shards:
+                writer.append(shard.frame(shard.factor_names))
+        # 重新打开，只从磁盘读
+        return FactorStore.for_hold(self.data_path, '3H')
+
+    def test_round_trip(self):
+        store = self.merge()
+        expected = pd.concat(self.frames, ignore_index=True)
+        self.assertEqual(store.rows, len(expected))
+        self.assertEqual(store.symbols, self.symbols)
+        self.assertEqual(sorted(store.factor_names), ['cond', 'count', 'f', 'late'])
+
+        df = store.frame(store.factor_names)
+        self.assertTrue((df['candle_begin_time'].values == expected['candle_begin_time'].values).all())
+        self.assertEqual(df['symbol'].astype(str).tolist(), expected['symbol'].tolist())
+        for name in ['offset', 'volume', 'avg_price', '下个周期_avg_price', 'count']:
+            np.testing.assert_array_equal(df[name].values.astype(np.float64), expected[name].values.astype(np.float64), err_msg=name)
+        np.testing.assert_allclose(df['f'].values, expected['f'].values, rtol=1e-6)
+        # 没有这列的币种补 NaN，bool 存成 0/1
+        cond = expected['cond'].astype(float).values
+        np.testing.assert_array_equal(df['cond'].values, cond)
+        self.assertTrue(np.isnan(df['late'].values[:-len(self.frames[3])]).all())
+        np.testing.assert_allclose(df['late'].values[-len(self.frames[3]):], self.frames[3]['late'].values, rtol=1e-6)
+
+    def test_dtypes_and_codes(self):
+        store = self.merge()
+        dtypes = {name: np.dtype(dtype) for name, dtype in store.meta['dtypes'].items()}
+        self.assertEqual(dtypes['candle_begin_time'], np.int64)
+        self.assertEqual(dtypes['symbol'], np.int32)
+        self.assertEqual(dtypes['offset'], np.int8)
+        self.assertEqual(dtypes['f'], np.float64)
+        self.assertEqual(dtypes['cond'], np.float32)
+        self.assertEqual(dtypes['count'], np.float32)
+        self.assertEqual(dtypes['late'], np.float32)
+        self.assertNotIn('周期开始时间', dtypes)
+
+        codes = np.asarray(store.column('symbol'))
+        expected = np.repeat(np.arange(len(self.symbols)), [len(df) for df in self.frames])
+        np.testing.assert_array_equal(codes, expected)
+        self.assertEqual(store.column('f').dtype, np.float64)
+
+
+if __name__ == '__main__':
+    unittest.main()
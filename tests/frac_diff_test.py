@@ -0,0 +1,69 @@
+import unittest
+import numpy as np
+from cy_procedure.subject.neutral.frac_diff import frac_diff_block, frac_diff_weights
+
+try:
+    from fracdiff import fdiff
+except ImportError:
+    fdiff = None
+
+
+def reference_weights(d, window):
+    """按公式逐项算 w0 = 1, wk = w(k-1) * (k - 1 - d) / k"""
+    weights = [1.0]
+    for k in range(1, window):
+        weights.append(weights[-1] * (k - 1 - d) / k)
+    return np.array(weights)
+
+
+def reference_frac_diff(values, d, window):
+    """逐点卷积 out[t] = sum(w[k] * x[t - k])，前 window - 1 行为 0，nan 为 0"""
+    weights = reference_weights(d, window)
+    out = np.zeros(len(values))
+    for t in range(window - 1, len(values)):
+        out[t] = sum(weights[k] * values[t - k] for k in range(window))
+    return np.nan_to_num(out, nan=0)
+
+
+class FracDiffTest(unittest.TestCase):
+
+    def test_weights(self):
+        for d in [0.3, 0.5, 0.7, 1.0]:
+            np.testing.assert_allclose(frac_diff_weights(d, 10), reference_weights(d, 10), rtol=1e-15)
+        # d = 1 就是一阶差分，d = 0 是原值
+        np.testing.assert_array_equal(frac_diff_weights(1.0, 4), [1, -1, 0, 0])
+        np.testing.assert_array_equal(frac_diff_weights(0.0, 4), [1, 0, 0, 0])
+
+    def test_block(self):
+        rng = np.random.default_rng(0)
+        block = rng.normal(size=(5, 200)).cumsum(axis=1)
+        block[1, 50] = np.nan
+        block[2, 120] = np.inf
+        d_list = [0.3, 0.5, 0.7]
+        out = frac_diff_block(block, d_list, window=10)
+        self.assertEqual(out.shape, (5, 200, 3))
+        for i in range(block.shape[0]):
+            for j, d in enumerate(d_list):
+                np.testing.assert_allclose(out[i, :, j], reference_frac_diff(block[i], d, 10), rtol=1e-10, atol=1e-12)
+        # nan 影响到的窗口为 0，inf 的和原来的 nan_to_num 一样变成最大的有限值
+        self.assertTrue((out[1, 50:60] == 0).all())
+        self.assertTrue((np.abs(out[2, 120:130]) == np.finfo(np.float64).max).all())
+        self.assertTrue(np.isfinite(out).all())
+
+    def test_out_and_short_rows(self):
+        block = np.arange(24, dtype=np.float64).reshape(2, 12)
+        out = np.full((2, 12, 1), np.nan)
+        self.assertIs(frac_diff_block(block, [0.5], window=10, out=out), out)
+        np.testing.assert_allclose(out[0, :, 0], reference_frac_diff(block[0], 0.5, 10))
+        # 行数不够一个窗口时全是 0
+        np.testing.assert_array_equal(frac_diff_block(block[:, :5], [0.5], window=10), np.zeros((2, 5, 1)))
+
+    @unittest.skipIf(fdiff is None, 'fracdiff 没有安装')
+    def test_fdiff(self):
+        values = np.random.default_rng(1).normal(size=100).cumsum()
+        expected = np.concatenate([np.zeros(9), fdiff(values, n=0.5, window=10, mode='valid')])
+        np.testing.assert_allclose(frac_diff_block(values[np.newaxis], [0.5])[0, :, 0], expected, rtol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
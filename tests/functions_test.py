@@ -0,0 +1,77 @@
+import itertools
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.neutral.functions import cal_ind, cal_ind_values, ind_kernel
+
+
+def reference_cal_ind(_select_c):
+    """改成 numpy 内核之前的 pandas 实现，只用来对比"""
+    select_coin = _select_c.copy()
+    results = pd.DataFrame()
+    results.loc[0, '累积净值'] = round(select_coin['资金曲线'].iloc[-1], 2)
+    select_coin['max2here'] = select_coin['资金曲线'].expanding().max()
+    select_coin['dd2here'] = select_coin['资金曲线'] / select_coin['max2here'] - 1
+    mean_draw_down = select_coin['dd2here'].mean()
+    end_date, max_draw_down = tuple(select_coin.sort_values(by=['dd2here']).iloc[0][['candle_begin_time', 'dd2here']])
+    start_date = select_coin[select_coin['candle_begin_time'] <= end_date].sort_values(
+        by='资金曲线', ascending=False).iloc[0]['candle_begin_time']
+    results.loc[0, '平均回撤'] = format(mean_draw_down, '.2%')
+    results.loc[0, '最大回撤'] = format(max_draw_down, '.2%')
+    results.loc[0, '最大回撤开始时间'] = str(start_date)
+    results.loc[0, '最大回撤结束时间'] = str(end_date)
+    returns = select_coin['本周期多空涨跌幅']
+    results.loc[0, '盈利周期数'] = len(select_coin.loc[returns > 0])
+    results.loc[0, '亏损周期数'] = len(select_coin.loc[returns <= 0])
+    results.loc[0, '胜率'] = format(results.loc[0, '盈利周期数'] / len(select_coin), '.2%')
+    results.loc[0, '每周期平均收益'] = format(returns.mean(), '.2%')
+    results.loc[0, '盈亏收益比'] = round(returns[returns > 0].mean() / returns[returns <= 0].mean() * (-1), 2)
+    results.loc[0, '单周期最大盈利'] = format(returns.max(), '.2%')
+    results.loc[0, '单周期大亏损'] = format(returns.min(), '.2%')
+    results.loc[0, '最大连续盈利周期数'] = max([len(list(v)) for k, v in itertools.groupby(np.where(returns > 0, 1, np.nan))])
+    results.loc[0, '最大连续亏损周期数'] = max([len(list(v)) for k, v in itertools.groupby(np.where(returns <= 0, 1, np.nan))])
+    return results
+
+
+def select_frame(returns):
+    returns = np.asarray(returns, dtype=np.float64)
+    return pd.DataFrame({
+        'candle_begin_time': pd.date_range('2021-01-01', periods=len(returns), freq='6h', tz='UTC'),
+        '本周期多空涨跌幅': returns,
+        '资金曲线': np.cumprod(returns + 1),
+    })
+
+
+class CalIndTest(unittest.TestCase):
+
+    def assert_same(self, select_c):
+        expected = reference_cal_ind(select_c).iloc[0]
+        actual = cal_ind(select_c).iloc[0]
+        self.assertEqual(list(actual.index), list(expected.index))
+        for name in expected.index:
+            if isinstance(expected[name], str):
+                self.assertEqual(actual[name], expected[name], name)
+            else:
+                self.assertAlmostEqual(float(actual[name]), float(expected[name]), places=9, msg=name)
+
+    def test_random_curve(self):
+        rng = np.random.default_rng(1)
+        for _ in range(20):
+            self.assert_same(select_frame(rng.normal(0.002, 0.03, size=300)))
+
+    def test_streaks_and_ties(self):
+        # 0 收益算亏损，回撤最低点出现两次取第一次
+        returns = [0.1, 0.1, -0.5, 1.0, 0, 0, 0, -0.5, 0.2, 0.2, 0.2]
+        self.assert_same(select_frame(returns))
+        values = cal_ind_values(select_frame(returns))
+        self.assertEqual(values['最大连续盈利周期数'], 3)
+        self.assertEqual(values['最大连续亏损周期数'], 4)
+
+    def test_kernel_drawdown_window(self):
+        values = ind_kernel(np.array([1.0, 1.2, 0.9, 1.1, 0.6, 1.3]), np.zeros(6))
+        self.assertEqual((values['最大回撤开始'], values['最大回撤结束']), (1, 4))
+        self.assertAlmostEqual(values['最大回撤'], 0.6 / 1.2 - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import numpy as np
+from cy_procedure.generic.missing_candle import expected_candle_ticks, find_missing_windows
+
+H = 60 * 60 * 1000
+W = 7 * 24 * H
+# 周线从 1970-01-05 周一开始，不从 epoch 对齐
+WEEK_ANCHOR = 4 * 24 * H
+
+
+class FindMissingWindowsTest(unittest.TestCase):
+
+    def test_expected_ticks(self):
+        np.testing.assert_array_equal(expected_candle_ticks(1, 4 * H, H), [H, 2 * H, 3 * H])
+        np.testing.assert_array_equal(expected_candle_ticks(0, 3 * W, W, WEEK_ANCHOR), WEEK_ANCHOR + W * np.arange(3))
+
+    def test_no_gap(self):
+        timestamps = np.arange(0, 10 * H, H)
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100), [])
+
+    def test_empty(self):
+        self.assertEqual(find_missing_windows([], 0, 5 * H, H, 100), [(0, 5)])
+        self.assertEqual(find_missing_windows([], 5 * H, 5 * H, H, 100), [])
+
+    def test_leading_gap(self):
+        timestamps = np.arange(3 * H, 10 * H, H)
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100), [(0, 3)])
+
+    def test_trailing_gap(self):
+        timestamps = np.arange(0, 6 * H, H)
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100), [(6 * H, 4)])
+
+    def test_inner_gaps(self):
+        timestamps = np.delete(np.arange(0, 10 * H, H), [2, 3, 7])
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100), [(2 * H, 2), (7 * H, 1)])
+
+    def test_merge_gap(self):
+        # 缺 2、3 和 6，中间只隔 4、5 两根
+        timestamps = np.delete(np.arange(0, 10 * H, H), [2, 3, 6])
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100, merge_gap=1), [(2 * H, 2), (6 * H, 1)])
+        self.assertEqual(find_missing_windows(timestamps, 0, 10 * H, H, 100, merge_gap=2), [(2 * H, 5)])
+
+    def test_batch_limit(self):
+        timestamps = np.arange(10 * H, 12 * H, H)
+        windows = find_missing_windows(timestamps, 0, 12 * H, H, 4)
+        self.assertEqual(windows, [(0, 4), (4 * H, 4), (8 * H, 2)])
+
+    def test_misaligned_phase(self):
+        # 已有的周线不从 epoch 对齐，乱序，还有一个不在网格上的时间戳
+        timestamps = WEEK_ANCHOR + W * np.array([9, 0, 1, 2, 5, 6, 7, 8])
+        timestamps = np.r_[WEEK_ANCHOR + 5, timestamps]
+        windows = find_missing_windows(timestamps, WEEK_ANCHOR, WEEK_ANCHOR + 10 * W, W, 100)
+        self.assertEqual(windows, [(WEEK_ANCHOR + 3 * W, 2)])
+
+    def test_ignores_out_of_range(self):
+        timestamps = np.r_[-H, np.arange(0, 5 * H, H), 20 * H]
+        self.assertEqual(find_missing_windows(timestamps, 0, 5 * H, H, 100), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
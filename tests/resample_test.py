@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.neutral.resample import resample_offsets
+
+ORIGIN = pd.Timestamp('2020-01-01 00:00:00', tz='UTC')
+AGG_DICT = {
+    'symbol': 'first',
+    'open': 'first',
+    'high': 'max',
+    'low': 'min',
+    'close': 'last',
+    'volume': 'sum',
+    'factor': 'last',
+}
+
+
+def hourly_frame(hours=24 * 10, seed=0):
+    """小时K线，中间有缺的小时和缺的一整段，数值列有 NaN"""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2021-01-01 05:00', periods=hours, freq='h', tz='UTC')
+    keep = rng.random(hours) > 0.1
+    keep[50:80] = False  # 超过一天的空档，有的周期一行都没有
+    times = times[keep]
+    close = rng.uniform(10, 20, size=len(times))
+    df = pd.DataFrame({
+        'candle_begin_time': times,
+        'symbol': 'BTC-USDT',
+        'open': close * rng.uniform(0.99, 1.01, size=len(times)),
+        'high': close * 1.02,
+        'low': close * 0.98,
+        'close': close,
+        'volume': rng.uniform(0, 100, size=len(times)),
+        'factor': rng.normal(size=len(times)),
+    })
+    for name in ['open', 'high', 'low', 'close', 'volume', 'factor']:
+        df.loc[rng.random(len(df)) < 0.15, name] = np.nan
+    df.loc[df.index[-3:], 'factor'] = np.nan  # 最后一个周期的 last 要往前找
+    return df
+
+
+def reference_resample(df, freq, offsets):
+    """逐个 offset 用 pandas resample，拼成和 resample_offsets 一样的格式"""
+    frames = []
+    for i, offset in enumerate(offsets):
+        period_df = df.resample(freq, on='candle_begin_time', origin=ORIGIN, offset=offset).agg(AGG_DICT)
+        period_df['offset'] = i
+        frames.append(period_df.reset_index())
+    return pd.concat(frames, ignore_index=True)
+
+
+class ResampleOffsetsTest(unittest.TestCase):
+
+    def assert_same(self, df, freq, offsets):
+        expected = reference_resample(df, freq, offsets)
+        actual = resample_offsets(df, AGG_DICT, freq, ORIGIN, offsets=offsets)
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        self.assertEqual(len(actual), len(expected))
+        self.assertTrue((actual['candle_begin_time'].values == expected['candle_begin_time'].values).all())
+        self.assertEqual(actual['offset'].tolist(), expected['offset'].tolist())
+        self.assertEqual(actual['symbol'].isna().tolist(), expected['symbol'].isna().tolist())
+        self.assertEqual(actual['symbol'].dropna().tolist(), expected['symbol'].dropna().tolist())
+        for name in ['open', 'high', 'low', 'close', 'volume', 'factor']:
+            np.testing.assert_allclose(actual[name].values.astype(np.float64), expected[name].values.astype(np.float64),
+                                       rtol=1e-12, equal_nan=True, err_msg=name)
+
+    def test_24h_all_offsets(self):
+        self.assert_same(hourly_frame(), '24h', [f'{i}h' for i in range(24)])
+
+    def test_short_and_long_holds(self):
+        df = hourly_frame(seed=1)
+        self.assert_same(df, '3h', [f'{i}h' for i in range(3)])
+        self.assert_same(df, '72h', [f'{i}h' for i in range(0, 72, 5)])
+
+    def test_empty(self):
+        df = hourly_frame().iloc[:0]
+        actual = resample_offsets(df, AGG_DICT, '24h', ORIGIN, offsets=[f'{i}h' for i in range(24)])
+        self.assertEqual(len(actual), 0)
+        self.assertEqual(list(actual.columns), ['candle_begin_time'] + list(AGG_DICT) + ['offset'])
+
+
+if __name__ == '__main__':
+    unittest.main()
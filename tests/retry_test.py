@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+from cy_procedure.util.retry import Retrier, RetryPolicy, RetryState
+
+
+class FakeClock:
+    """time.time / time.sleep 的替身，sleep 只把时间往前推"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class RetrierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('cy_procedure.util.retry.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def failing(self, cost=0, fail_times=None):
+        """每次执行花 cost 秒，前 fail_times 次失败(None 为一直失败)"""
+        calls = []
+
+        def func():
+            calls.append(self.clock.now)
+            self.clock.advance(cost)
+            if fail_times is None or len(calls) <= fail_times:
+                raise IOError('fail {}'.format(len(calls)))
+            return 'ok'
+        return func, calls
+
+    def test_success_after_retries(self):
+        retrier = Retrier(RetryPolicy(max_retries=5, base_delay=1, jitter=0))
+        func, calls = self.failing(cost=2, fail_times=2)
+        self.assertEqual(retrier.run(func), (True, 'ok'))
+        self.assertEqual(retrier.state, RetryState.SUCCEEDED)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.clock.sleeps, [1, 2])
+        self.assertEqual(retrier.metrics.retry_count, 2)
+        # 两次失败的执行 2 + 2，等待 1 + 2
+        self.assertEqual(retrier.metrics.time_lost, 7)
+        self.assertEqual(retrier.metrics.last_error, repr(IOError('fail 2')))
+
+    def test_retry_budget_exhausted(self):
+        retrier = Retrier(RetryPolicy(max_retries=3, base_delay=1, max_delay=60, jitter=0))
+        func, calls = self.failing()
+        self.assertEqual(retrier.run(func), (False, None))
+        self.assertEqual(retrier.state, RetryState.GAVE_UP)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(self.clock.sleeps, [1, 2, 4])
+        self.assertEqual(retrier.metrics.retry_count, 3)
+
+    def test_elapsed_budget_exhausted(self):
+        retrier = Retrier(RetryPolicy(max_retries=100, base_delay=10, max_delay=10, max_elapsed=25, jitter=0))
+        func, calls = self.failing()
+        self.assertEqual(retrier.run(func), (False, None))
+        # 等待不超过剩余的时间预算
+        self.assertEqual(self.clock.sleeps, [10, 10, 5])
+        self.assertEqual(len(calls), 4)
+
+    def test_progress_resets_budget_and_lost_time(self):
+        retrier = Retrier(RetryPolicy(max_retries=1, base_delay=1, jitter=0))
+        calls = []
+
+        def func():
+            calls.append(self.clock.now)
+            # 前三次都推进了 100s 才失败，只有进展之后的 3s 算损失
+            if len(calls) <= 3:
+                self.clock.advance(100)
+                retrier.progress()
+                self.clock.advance(3)
+                raise IOError('late failure')
+            return 'ok'
+
+        self.assertEqual(retrier.run(func), (True, 'ok'))
+        # max_retries=1，但每次都有进展，连续失败次数清零，不会放弃
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(self.clock.sleeps, [1, 1, 1])
+        self.assertEqual(retrier.metrics.retry_count, 3)
+        self.assertEqual(retrier.metrics.time_lost, 3 * 3 + 3 * 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import numpy as np
+import pandas as pd
+from cy_procedure.subject.neutral.functions import gen_select_df
+from cy_procedure.subject.neutral.selection import SelectionPanel
+
+
+def reference_gen_select_df(_df, _c_rate, _select_num, _factor, _reverse):
+    """改成矩阵选币之前的 pandas 实现，只用来对比"""
+    df = _df.copy()
+
+    select_c = pd.DataFrame()
+    select_c['币数量'] = df.groupby('candle_begin_time').size()
+    reverse_factor = -1 if _reverse else 1
+    df['因子'] = reverse_factor * df[_factor]
+    df = df.replace([np.inf, -np.inf], np.nan)
+    df.dropna(subset=[_factor], inplace=True)
+
+    df['排名1'] = df.groupby('candle_begin_time')['因子'].rank()
+    df1 = df[(df['排名1'] <= _select_num)].copy()
+    df1['方向'] = 1
+
+    df['排名2'] = df.groupby('candle_begin_time')['因子'].rank(ascending=False)
+    df2 = df[(df['排名2'] <= _select_num)].copy()
+    df2['方向'] = -1
+
+    df = pd.concat([df1, df2], ignore_index=True)
+    df.sort_values(by=['candle_begin_time', '方向'], inplace=True)
+    df['本周期涨跌幅'] = -(1 * _c_rate) + 1 * (
+        1 + (df['下个周期_avg_price'] / df['avg_price'] - 1) * df['方向']) * (1 - _c_rate) - 1
+
+    df['symbol'] += ' '
+    select_c['做多币种'] = df[df['方向'] == 1].groupby('candle_begin_time')['symbol'].sum()
+    select_c['做空币种'] = df[df['方向'] == -1].groupby('candle_begin_time')['symbol'].sum()
+    select_c['本周期多空涨跌幅'] = df.groupby('candle_begin_time')['本周期涨跌幅'].mean()
+
+    select_c.reset_index(inplace=True)
+    select_c['资金曲线'] = (select_c['本周期多空涨跌幅'] + 1).cumprod()
+    return select_c
+
+
+def panel_frame(factor, seed=0):
+    """时间 × 币种 的因子矩阵 -> 长表，因子为 NaN 的行也保留"""
+    factor = np.asarray(factor, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2021-01-01', periods=factor.shape[0], freq='6h', tz='UTC')
+    symbols = [f'C{i}-USDT' for i in range(factor.shape[1])]
+    avg_price = rng.uniform(1, 100, size=factor.shape)
+    return pd.DataFrame({
+        'candle_begin_time': np.repeat(times, factor.shape[1]),
+        'symbol': np.tile(symbols, factor.shape[0]),
+        'avg_price': avg_price.ravel(),
+        '下个周期_avg_price': (avg_price * rng.uniform(0.9, 1.1, size=factor.shape)).ravel(),
+        'factor': factor.ravel(),
+    })
+
+
+class SelectionTest(unittest.TestCase):
+
+    def assert_same(self, df, select_num, reverse, c_rate):
+        expected = reference_gen_select_df(df, c_rate, select_num, 'factor', reverse)
+        selection = SelectionPanel(df).select(df['factor'].values, select_num, reverse, c_rate)
+        np.testing.assert_allclose(selection.returns, expected['本周期多空涨跌幅'].values, rtol=1e-12)
+        np.testing.assert_allclose(selection.equity, expected['资金曲线'].values, rtol=1e-12)
+
+        actual = gen_select_df(df, c_rate, select_num, 'factor', reverse)
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        self.assertTrue((actual['candle_begin_time'].values == expected['candle_begin_time'].values).all())
+        self.assertEqual(actual['币数量'].tolist(), expected['币数量'].tolist())
+        # 币种按因子排序拼接，和原来按行顺序拼接的可能不同，比较集合
+        for column in ['做多币种', '做空币种']:
+            self.assertEqual([set(str(s).split()) for s in actual[column]], [set(str(s).split()) for s in expected[column]])
+
+    def test_random_factor(self):
+        rng = np.random.default_rng(2)
+        factor = rng.normal(size=(60, 12))
+        factor[rng.random(factor.shape) < 0.1] = np.nan
+        factor[3, 5] = np.inf
+        df = panel_frame(factor, seed=2)
+        for select_num in [1, 3, 6]:
+            for reverse in [False, True]:
+                self.assert_same(df, select_num, reverse, 0.001)
+
+    def test_few_valid_coins(self):
+        # 有效币种少于 2 * select_num 时多空会选到同一个币，整行为空时收益为 NaN
+        factor = np.array([
+            [1.0, np.nan, np.nan, np.nan],
+            [np.nan, 2.0, 3.0, np.nan],
+            [4.0, 1.0, 2.0, 3.0],
+        ])
+        df = panel_frame(factor, seed=3)
+        self.assert_same(df, 3, False, 0.002)
+
+    def test_ties_inside_selection(self):
+        # 并列的币都在前 N 个之内，和原来的结果一样
+        factor = np.array([
+            [1.0, 1.0, 5.0, 6.0, 9.0, 9.0],
+            [2.0, 2.0, 2.0, 7.0, 8.0, 8.0],
+            [0.0, 3.0, 3.0, 5.0, 8.0, 9.0],
+        ])
+        self.assert_same(panel_frame(factor, seed=4), 3, False, 0)
+
+    def test_tie_on_boundary_selects_n(self):
+        # 第 N 名有并列时，原来按平均排名可能多选或少选，现在正好选 N 个
+        factor = np.array([[1.0, 2.0, 2.0, 2.0, 5.0, 6.0]])
+        df = panel_frame(factor, seed=5)
+        expected = reference_gen_select_df(df, 0, 2, 'factor', False)
+        self.assertEqual(len(expected.loc[0, '做多币种'].split()), 1)  # 平均排名 3，只选到 C0
+
+        selection = SelectionPanel(df).select(df['factor'].values, 2, False, 0)
+        self.assertEqual(selection.long_valid.sum(), 2)
+        long_symbols = selection.long_symbols()[0].split()
+        self.assertEqual(long_symbols[0], 'C0-USDT')
+        self.assertIn(long_symbols[1], {'C1-USDT', 'C2-USDT', 'C3-USDT'})
+        self.assertEqual(set(selection.short_symbols()[0].split()), {'C5-USDT', 'C4-USDT'})
+        change = df['下个周期_avg_price'].values / df['avg_price'].values - 1
+        chosen = df['symbol'].values.tolist().index(long_symbols[1])
+        expected_return = np.mean([change[0], change[chosen], -change[4], -change[5]])
+        self.assertAlmostEqual(selection.returns[0], expected_return)
+
+
+if __name__ == '__main__':
+    unittest.main()